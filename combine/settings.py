@@ -91,6 +91,18 @@ DATABASES = {
 }
 # SILENCED_SYSTEM_CHECKS = ['mysql.E001']
 
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/#database-caching
+# Shared in DB by web workers, background tasks, and Spark jobs, such that invalidation in one process reaches all.
+# Table created by core/inc/combine_tables_prime.sql, or for existing installs, core/inc/combine_cache.sql
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'combine_cache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -1,7 +1,9 @@
 
 /* 
-  Add forgeign keys for `core_record` and `core_indexmappingfailure`
+  Add forgeign keys for `core_record`, `core_indexmappingfailure`, and `core_publishedrecordindex`
 */
 
 ALTER TABLE core_record ADD FOREIGN KEY (job_id) REFERENCES core_job(id) ON DELETE CASCADE;
 ALTER TABLE core_indexmappingfailure ADD FOREIGN KEY (job_id) REFERENCES core_job(id) ON DELETE CASCADE;
+ALTER TABLE core_publishedrecordindex ADD FOREIGN KEY (id) REFERENCES core_record(id) ON DELETE CASCADE;
+ALTER TABLE core_publishedrecordindex ADD FOREIGN KEY (job_id) REFERENCES core_job(id) ON DELETE CASCADE;
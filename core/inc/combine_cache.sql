@@ -0,0 +1,14 @@
+/* 
+  Upgrade existing install with `combine_cache`, table of Django's DatabaseCache backend.
+
+  Shared by web workers, background tasks, and Spark jobs, such that cached values, e.g. the job lineage graph,
+  are invalidated for all processes.  Equivalent to: python manage.py createcachetable
+*/
+
+CREATE TABLE `combine_cache` (
+  `cache_key` varchar(255) NOT NULL,
+  `value` longtext NOT NULL,
+  `expires` datetime(6) NOT NULL,
+  PRIMARY KEY (`cache_key`),
+  INDEX `combine_cache_expires_idx` (`expires`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -0,0 +1,25 @@
+/* 
+  Upgrade existing install with `core_publishedrecordindex`, index of published records by publish set.
+
+  Keyed by (`publish_set_id`, `id`), such that OAI set filters page published records of a set, and ListSets reads
+  distinct sets, from one table, without joining `core_record` through `core_job` to `core_recordgroup`.
+  Rows are maintained by Publish jobs, and when Publish jobs are removed, or Record Groups change publish set.
+*/
+
+CREATE TABLE `core_publishedrecordindex` (
+  `publish_set_id` varchar(128) NOT NULL,
+  `id` int(11) NOT NULL,
+  `job_id` int(11) NOT NULL,
+  PRIMARY KEY (`publish_set_id`, `id`),
+  INDEX `core_publishedrecordindex_job_id_idx` (`job_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+ALTER TABLE core_publishedrecordindex ADD FOREIGN KEY (id) REFERENCES core_record(id) ON DELETE CASCADE;
+ALTER TABLE core_publishedrecordindex ADD FOREIGN KEY (job_id) REFERENCES core_job(id) ON DELETE CASCADE;
+
+/* index records of existing Publish jobs */
+INSERT INTO core_publishedrecordindex (publish_set_id, id, job_id)
+  SELECT rg.publish_set_id, r.id, r.job_id FROM core_record r
+  JOIN core_job j ON j.id = r.job_id
+  JOIN core_recordgroup rg ON rg.id = j.record_group_id
+  WHERE j.job_type = 'PublishJob' AND r.published = 1 AND rg.publish_set_id IS NOT NULL;
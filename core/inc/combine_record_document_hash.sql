@@ -0,0 +1,12 @@
+
+/* 
+  Upgrade existing `core_record` table with `document_hash` column, an MD5 fingerprint of `document`, and
+  indexes on (`job_id`, `record_id`) and `document_hash`.
+
+  Hashes for existing records are populated with: python manage.py backfillrecordhashes
+*/
+
+ALTER TABLE core_record
+  ADD COLUMN `document_hash` char(32) DEFAULT NULL,
+  ADD INDEX `core_record_job_record_id_idx` (`job_id`, `record_id`(255)),
+  ADD INDEX `core_record_document_hash_idx` (`document_hash`);
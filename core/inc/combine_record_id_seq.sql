@@ -0,0 +1,13 @@
+/* 
+  Upgrade existing install with `core_record_id_seq`, single row allocator of `core_record` id blocks.
+
+  Jobs pre-assigning ids in Spark reserve blocks by moving `next_id` in one atomic UPDATE, instead of reading
+  AUTO_INCREMENT from information_schema and altering `core_record`.
+*/
+
+CREATE TABLE `core_record_id_seq` (
+  `next_id` bigint(20) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+INSERT INTO core_record_id_seq (next_id)
+  SELECT COALESCE(MAX(id), 0) + 1 FROM core_record;
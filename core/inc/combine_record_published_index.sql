@@ -0,0 +1,10 @@
+
+/* 
+  Upgrade existing `core_record` table with index on `published`.
+
+  As InnoDB secondary indexes include the primary key, this index serves OAI server pages of published records,
+  which page by `id` after the last `id` of the previous page, without scanning unpublished records.
+*/
+
+ALTER TABLE core_record
+  ADD INDEX `core_record_published_idx` (`published`);
@@ -1,6 +1,7 @@
 
 /* 
-	Table creation for `core_record` and `core_indexmappingfailure`
+	Table creation for `core_record`, `core_record_id_seq`, `core_indexmappingfailure`, `core_publishedrecordindex`,
+	and `combine_cache`
 
 	These are managed outside of Django due to high INSERT/DELETE demands these tables present.
 	Deleting rows through Django was prohibitively slow, where using InnoDB's internal
@@ -22,12 +23,23 @@ CREATE TABLE `core_record` (
   `published` tinyint(1) NOT NULL DEFAULT 0,
   `oai_set` varchar(255) DEFAULT NULL,
   `success` tinyint(1) DEFAULT 1 NOT NULL,
+  `document_hash` char(32) DEFAULT NULL,
   PRIMARY KEY (`id`),
   INDEX `core_record_job_id_idx` (`job_id`),
-  INDEX `core_record_job_success_idx` (`success`)
+  INDEX `core_record_job_success_idx` (`success`),
+  INDEX `core_record_job_record_id_idx` (`job_id`, `record_id`(255)),
+  INDEX `core_record_document_hash_idx` (`document_hash`),
+  INDEX `core_record_published_idx` (`published`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 
+/* single row allocator of core_record id blocks, for ids assigned in Spark */
+CREATE TABLE `core_record_id_seq` (
+  `next_id` bigint(20) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+INSERT INTO `core_record_id_seq` (`next_id`) VALUES (1);
+
+
 CREATE TABLE `core_indexmappingfailure` (
   `id` int(11) NOT NULL AUTO_INCREMENT,
   `record_id` varchar(1024) DEFAULT NULL,
@@ -36,3 +48,21 @@ CREATE TABLE `core_indexmappingfailure` (
   PRIMARY KEY (`id`),
   INDEX `core_indexmappingfailure_job_id_idx` (`job_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+
+CREATE TABLE `core_publishedrecordindex` (
+  `publish_set_id` varchar(128) NOT NULL,
+  `id` int(11) NOT NULL,
+  `job_id` int(11) NOT NULL,
+  PRIMARY KEY (`publish_set_id`, `id`),
+  INDEX `core_publishedrecordindex_job_id_idx` (`job_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+
+CREATE TABLE `combine_cache` (
+  `cache_key` varchar(255) NOT NULL,
+  `value` longtext NOT NULL,
+  `expires` datetime(6) NOT NULL,
+  PRIMARY KEY (`cache_key`),
+  INDEX `combine_cache_expires_idx` (`expires`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
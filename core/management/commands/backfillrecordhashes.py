@@ -0,0 +1,86 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+# import core
+from core.models import *
+
+class Command(BaseCommand):
+
+	help = 'Backfill document_hash, MD5 of document, for Records of existing Jobs saved before the column existed'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--job_id', nargs='*', type=int, help='Job ids to backfill, defaults to all Jobs')
+		parser.add_argument('--batch_size', type=int, default=10000, help='Records hashed per DB update')
+
+	def handle(self, *args, **options):
+
+		# get jobs
+		if options['job_id']:
+			jobs = Job.objects.filter(pk__in=options['job_id'])
+		else:
+			jobs = Job.objects.all()
+
+		for job in jobs.order_by('id'):
+
+			# skip jobs without records missing hashes
+			if not Record.objects.filter(job=job, document_hash__isnull=True).exists():
+				continue
+
+			# MySQL record store, hash in DB with MD5(), in batches by id range
+			if settings.RECORD_STORAGE_BACKEND != 'parquet':
+				updated = self.backfill_mysql(job, options['batch_size'])
+
+			# Parquet record store, documents are not in DB, hash from job partition
+			else:
+				updated = self.backfill_parquet(job, options['batch_size'])
+
+			self.stdout.write('Job %s: hashed %s records' % (job.id, updated))
+
+		# return
+		self.stdout.write(self.style.SUCCESS('Record document hashes backfilled.'))
+
+
+	def backfill_mysql(self, job, batch_size):
+
+		'''
+		Update document_hash with MySQL MD5() of document, in batches of ids
+		'''
+
+		updated = 0
+		with connection.cursor() as cursor:
+			cursor.execute('SELECT MIN(id), MAX(id) FROM core_record WHERE job_id = %s', [job.id])
+			min_id, max_id = cursor.fetchone()
+			for start_id in range(min_id, max_id + 1, batch_size):
+				cursor.execute(
+					'UPDATE core_record SET document_hash = MD5(document) WHERE job_id = %s AND id BETWEEN %s AND %s AND document_hash IS NULL',
+					[job.id, start_id, start_id + batch_size - 1])
+				updated += cursor.rowcount
+		return updated
+
+
+	def backfill_parquet(self, job, batch_size):
+
+		'''
+		Update document_hash from documents read in batches from the job's Parquet partition
+		'''
+
+		if pq is None:
+			raise CommandError('pyarrow is required to read documents from Parquet record store')
+
+		partition_path = '%s/job_id=%s' % (settings.RECORD_STORAGE_PARQUET_PATH.split('file://')[-1].rstrip('/'), job.id)
+		if not os.path.exists(partition_path):
+			return 0
+
+		updated = 0
+		with connection.cursor() as cursor:
+			for parquet_file in sorted(os.listdir(partition_path)):
+				if not parquet_file.endswith('.parquet'):
+					continue
+				for batch in pq.ParquetFile(os.path.join(partition_path, parquet_file)).iter_batches(batch_size=batch_size, columns=['id','document']):
+					rows = [
+						(hashlib.md5(row['document'].encode('utf-8')).hexdigest(), row['id'])
+						for row in batch.to_pylist() if row['document'] is not None
+					]
+					cursor.executemany('UPDATE core_record SET document_hash = %s WHERE id = %s AND document_hash IS NULL', rows)
+					updated += len(rows)
+		return updated
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+# import core
+from core.models import *
+
+class Command(BaseCommand):
+
+	help = 'Poll Livy for status of unfinished Jobs, one request per Livy session, updating Jobs in bulk, and schedule queued Jobs if LIVY_SCHEDULER_ENABLED'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--interval', type=float, default=settings.LIVY_STATUS_POLL_INTERVAL, help='Seconds between polls')
+		parser.add_argument('--once', action='store_true', help='Poll once and exit')
+
+	def handle(self, *args, **options):
+
+		poller = LivyStatusPoller()
+		scheduler = LivyScheduler()
+
+		while True:
+
+			# poll, continuing on errors such that poller outlives Livy restarts
+			try:
+				updated = poller.poll()
+				if updated > 0:
+					self.stdout.write('updated status of %s jobs' % updated)
+
+				# dispatch queued jobs to idle sessions of Livy session pool
+				if settings.LIVY_SCHEDULER_ENABLED:
+					dispatched = scheduler.schedule()
+					if dispatched > 0:
+						self.stdout.write('dispatched %s jobs' % dispatched)
+			except Exception as e:
+				if options['once']:
+					raise CommandError(str(e))
+				logger.debug('could not poll Livy for job status: %s' % str(e))
+
+			if options['once']:
+				break
+			time.sleep(options['interval'])
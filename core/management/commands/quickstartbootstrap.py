@@ -12,24 +12,12 @@ class Command(BaseCommand):
 
 	def handle(self, *args, **options):
 
-		## prepare demo MODS files		
-		# parse file
-		xml_tree = etree.parse('tests/data/mods_250.xml')
-		xml_root = xml_tree.getroot()		
-		# get namespaces
-		nsmap = {}
-		for ns in xml_root.xpath('//namespace::*'):
-			if ns[0]:
-				nsmap[ns[0]] = ns[1]
-		# find mods records
-		mods_roots = xml_root.xpath('//mods:mods', namespaces=nsmap)
+		## prepare demo MODS files, streamed to shards of JSON lines
 		# create temp dir
 		payload_dir = '/tmp/combine/qs/mods'
 		os.makedirs(payload_dir)
 		# write MODS to temp dir
-		for mods in mods_roots:
-			with open(os.path.join(payload_dir, '%s.xml' % uuid.uuid4().hex), 'w') as f:
-				f.write(etree.tostring(mods).decode('utf-8'))
+		StaticXMLSplitter('//mods:mods', payload_dir).split('tests/data/mods_250.xml')
 
 
 		## create demo XSLT transformation
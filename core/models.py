@@ -36,17 +36,25 @@ from django.apps import AppConfig
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth import signals
+from django.core.cache import cache
 from django.db import connection, models
 from django.db.models import Count
 from django.http import HttpResponse, JsonResponse
 from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.html import format_html
+from django.utils import timezone
 from django.views import View
 
 # Livy
 from livy.client import HttpClient
 
+# pyarrow, optional, for reading documents from Parquet record store
+try:
+	import pyarrow.parquet as pq
+except:
+	pq = None
+
 # import elasticsearch and handles
 from core.es import es_handle
 from elasticsearch_dsl import Search, A, Q
@@ -281,25 +289,10 @@ class RecordGroup(models.Model):
 		# debug
 		stime = time.time()
 
-		# create record group lineage dictionary
-		ld = {'edges':[], 'nodes':[]}
-
-		# get all jobs
-		record_group_jobs = self.job_set.order_by('-id').all()
-
-		# loop through jobs
-		for job in record_group_jobs:
-		    job_ld = job.get_lineage(directionality='downstream')
-		    ld['edges'].extend(job_ld['edges'])
-		    ld['nodes'].extend(job_ld['nodes'])
-
-		# filter for unique
-		ld['nodes'] = list({node['id']:node for node in ld['nodes']}.values())
-		ld['edges'] = list({edge['id']:edge for edge in ld['edges']}.values())
-
-		# sort by id
-		ld['nodes'].sort(key=lambda x: x['id'])
-		ld['edges'].sort(key=lambda x: x['id'])
+		# get lineage of all jobs from job lineage graph
+		ld = JobLineageGraph.get().get_lineage(
+			self.job_set.values_list('id', flat=True),
+			directionality='downstream')
 
 		# return
 		logger.debug('lineage calc time elapsed: %s' % (time.time()-stime))
@@ -615,6 +608,80 @@ class Job(models.Model):
 			self.save()
 
 
+	def remove_output(self):
+
+		'''
+		Method to remove output of job, such that it may be run again, e.g. after its Livy session died
+			- records, record validations, and index mapping failures from DB
+			- avro files, Parquet record store partition, and ES index, with remove_output_files()
+
+		Args:
+			None
+
+		Returns:
+			None
+		'''
+
+		# remove from DB, validations and published record set index before records they reference
+		RecordValidation.objects.filter(record__job=self).delete()
+		JobValidation.objects.filter(job=self).update(failure_count=None)
+		JobLineageGraph.invalidate()
+		with connection.cursor() as cursor:
+			cursor.execute('DELETE FROM core_publishedrecordindex WHERE job_id = %s', [self.id])
+			cursor.execute('DELETE FROM core_record WHERE job_id = %s', [self.id])
+			cursor.execute('DELETE FROM core_indexmappingfailure WHERE job_id = %s', [self.id])
+
+		# remove from disk and ES
+		self.remove_output_files()
+
+
+	def remove_output_files(self):
+
+		'''
+		Method to remove output of job outside of DB
+			- remove avro files from disk
+			- remove job partition from Parquet record store (if used)
+			- delete ES index (if present)
+
+		Args:
+			None
+
+		Returns:
+			None
+		'''
+
+		# remove avro files from disk
+		# if file://
+		if self.job_output and self.job_output.startswith('file://'):
+
+			try:
+				output_dir = self.job_output.split('file://')[-1]
+				if os.path.exists(output_dir):
+					shutil.rmtree(output_dir)
+			except:
+				logger.debug('could not remove job output directory at: %s' % self.job_output)
+
+
+		# remove job partition from Parquet record store
+		if settings.RECORD_STORAGE_BACKEND == 'parquet' and settings.RECORD_STORAGE_PARQUET_PATH.startswith('file://'):
+
+			try:
+				partition_dir = '%s/job_id=%s' % (settings.RECORD_STORAGE_PARQUET_PATH.split('file://')[-1].rstrip('/'), self.id)
+				if os.path.exists(partition_dir):
+					shutil.rmtree(partition_dir)
+			except:
+				logger.debug('could not remove record store partition for job id %s' % self.id)
+
+
+		# remove ES index if exists
+		try:
+			if es_handle.indices.exists('j%s' % self.id):
+				logger.debug('removing ES index: j%s' % self.id)
+				es_handle.indices.delete('j%s' % self.id)
+		except:
+			logger.debug('could not remove ES index: j%s' % self.id)
+
+
 	def job_output_as_filesystem(self):
 
 		'''
@@ -663,139 +730,94 @@ class Job(models.Model):
 		return '%s/organizations/%s/record_group/%s/jobs/indexing/%s' % (settings.BINARY_STORAGE.rstrip('/'), self.record_group.organization.id, self.record_group.id, self.id)
 
 
-	@property
-	def dpla_mapping(self):
+	def update_job_details(self, update_dict, save=True):
 
 		'''
-		Method to return DPLA mapping for this job
+		Method to merge dictionary into self.job_details, stored as JSON.
+		Reads current job_details from DB before merging, and if saving, updates only that column, as Spark jobs
+		and Django views may be holding different instances of this Job.
 
 		Args:
-			None
+			update_dict (dict): dictionary to merge into job_details
+			save (bool): if True, write job_details to DB
 
 		Returns:
-			(core.models.DPLAJobMap, None): Instance of DPLAJobMap if exists, else None
+			(dict): updated job_details
 		'''
 
-		if not hasattr(self, '_dpla_mapping'):
-			if self.dplajobmap_set.count() == 1:
-				self._dpla_mapping = self.dplajobmap_set.first()
-			else:
-				self._dpla_mapping = None
-
-		# return
-		return self._dpla_mapping
-
+		# get current job_details from DB
+		job_details = Job.objects.filter(pk=self.id).values_list('job_details', flat=True).first()
+		if job_details:
+			job_details = json.loads(job_details)
+		else:
+			job_details = {}
 
-	def get_lineage(self, directionality='downstream'):
+		# merge and set
+		job_details.update(update_dict)
+		self.job_details = json.dumps(job_details)
 
-		'''
-		Method to retrieve lineage of self
-		'''
+		# update column only
+		if save:
+			Job.objects.filter(pk=self.id).update(job_details=self.job_details)
 
-		# lineage dict
-		ld = {'nodes':[],'edges':[]}		
+		return job_details
 
-		# get validation results for self
-		validation_results = self.validation_results()
 
-		# prepare node dictionary
-		node_dict = {
-				'id':self.id,
-				'name':self.name,
-				'record_group_id':None,
-				'org_id':None,
-				'job_type':self.job_type,
-				'job_status':self.status,
-				'is_valid':validation_results['verdict'],				
-				'deleted':self.deleted
-			}
+	def get_pipeline_jobs(self):
 
-		# if not Analysis job, add org and record group
-		if self.job_type != 'AnalysisJob':
-			node_dict['record_group_id'] = self.record_group.id
-			node_dict['org_id'] = self.record_group.organization.id
+		'''
+		Method to return Jobs run in the same Livy statement as stages of a pipeline, see core.models.PipelineJob
 
-		# add self to lineage dictionary
-		ld['nodes'].append(node_dict)
+		Args:
+			None
 
-		# update lineage dictionary recursively
-		self._get_parent_jobs(self, ld, directionality=directionality)
+		Returns:
+			(django.db.models.query.QuerySet): Jobs of pipeline including this Job, or only this Job if not a stage
+		'''
 
-		# return
-		return ld
+		if self.job_details:
+			pipeline = json.loads(self.job_details).get('pipeline')
+			if pipeline:
+				return Job.objects.filter(pk__in=pipeline['stage_job_ids']).order_by('id')
+		return Job.objects.filter(pk=self.id)
 
 
-	def _get_parent_jobs(self, job, ld, directionality='downstream'):
+	@property
+	def dpla_mapping(self):
 
 		'''
-		Method to recursively find parent jobs and add to lineage dictionary
+		Method to return DPLA mapping for this job
 
 		Args:
-			job (core.models.Job): job to derive all upstream jobs from
-			ld (dict): lineage dictionary
-			directionality (str)['upstream','downstream']: directionality for edges
+			None
 
 		Returns:
-			(dict): lineage dictionary, updated with upstream parents
+			(core.models.DPLAJobMap, None): Instance of DPLAJobMap if exists, else None
 		'''
 
-		# get parent job(s)
-		parent_job_links = job.jobinput_set.all() # reverse many to one through JobInput model
-
-		# if parent jobs found
-		if parent_job_links.count() > 0:
-
-			# loop through
-			for link in parent_job_links:
-
-				# get parent job proper
-				pj = link.input_job
-
-				# add as node, if not already added to nodes list
-				if pj.id not in [ node['id'] for node in ld['nodes'] ]:
+		if not hasattr(self, '_dpla_mapping'):
+			if self.dplajobmap_set.count() == 1:
+				self._dpla_mapping = self.dplajobmap_set.first()
+			else:
+				self._dpla_mapping = None
 
-					# get validation results and add to node
-					validation_results = pj.validation_results()
+		# return
+		return self._dpla_mapping
 
-					# prepare node dictionary
-					node_dict = {
-						'id':pj.id,						
-						'name':pj.name,
-						'record_group_id':None,
-						'org_id':None,
-						'job_type':pj.job_type,
-						'job_status':self.status,
-						'is_valid':validation_results['verdict'],
-						'deleted':pj.deleted
-						}
 
-					# if not Analysis job, add org and record group
-					if pj.job_type != 'AnalysisJob':
-						node_dict['record_group_id'] = pj.record_group.id
-						node_dict['org_id'] = pj.record_group.organization.id
+	def get_lineage(self, directionality='downstream'):
 
-					# append to nodes
-					ld['nodes'].append(node_dict)
+		'''
+		Method to retrieve lineage of self, from job lineage graph
 
-				# determine directionality
-				if directionality == 'upstream':
-					from_node = job.id
-					to_node = pj.id
-				elif directionality == 'downstream':
-					from_node = pj.id
-					to_node = job.id
+		Args:
+			directionality (str)['upstream','downstream']: directionality for edges
 
-				# add edge
-				edge_id = '%s_to_%s' % (from_node, to_node)
-				if edge_id not in [ edge['id'] for edge in ld['edges'] ]:
-					ld['edges'].append({
-						'id':edge_id,
-						'from':from_node,
-						'to':to_node
-					})
+		Returns:
+			(dict): lineage dictionary of self and all upstream jobs as nodes, and input jobs as edges
+		'''
 
-				# recurse
-				self._get_parent_jobs(pj, ld, directionality=directionality)
+		return JobLineageGraph.get().get_lineage([self.id], directionality=directionality)
 
 
 	@staticmethod
@@ -841,25 +863,8 @@ class Job(models.Model):
 			if exclude_analysis_jobs:
 				jobs = jobs.exclude(job_type='AnalysisJob')
 
-		# create record group lineage dictionary
-		ld = {'edges':[], 'nodes':[]}
-
-		# loop through jobs
-		for job in jobs:
-		    job_ld = job.get_lineage(directionality=directionality)
-		    ld['edges'].extend(job_ld['edges'])
-		    ld['nodes'].extend(job_ld['nodes'])
-
-		# filter for unique
-		ld['nodes'] = list({node['id']:node for node in ld['nodes']}.values())
-		ld['edges'] = list({edge['id']:edge for edge in ld['edges']}.values())
-
-		# sort by id
-		ld['nodes'].sort(key=lambda x: x['id'])
-		ld['edges'].sort(key=lambda x: x['id'])
-
-		# return
-		return ld
+		# get lineage of all jobs from job lineage graph
+		return JobLineageGraph.get().get_lineage(jobs.values_list('id', flat=True), directionality=directionality)
 
 
 	def validation_results(self):
@@ -955,6 +960,26 @@ class JobPublish(models.Model):
 
 
 
+class JobQueue(models.Model):
+
+	'''
+	Model to manage Jobs queued for, or dispatched to, a session of the Livy session pool by core.models.LivyScheduler
+	'''
+
+	job = models.ForeignKey(Job, on_delete=models.CASCADE)
+	job_code = models.TextField(null=True, default=None) # JSON of code submitted to Livy
+	status = models.CharField(max_length=30, default='queued') # queued, dispatched, failed
+	expected_record_count = models.IntegerField(null=True, default=None) # resource hint, set when dispatched
+	attempts = models.IntegerField(default=0)
+	livy_session = models.ForeignKey(LivySession, null=True, default=None, on_delete=models.SET_NULL)
+	timestamp = models.DateTimeField(null=True, auto_now_add=True)
+	dispatched_timestamp = models.DateTimeField(null=True, default=None)
+
+	def __str__(self):
+		return 'JobQueue: job_id #%s, status: %s, attempts: %s' % (self.job_id, self.status, self.attempts)
+
+
+
 class OAIEndpoint(models.Model):
 
 	'''
@@ -967,6 +992,9 @@ class OAIEndpoint(models.Model):
 	metadataPrefix = models.CharField(max_length=128)
 	scope_type = models.CharField(max_length=128) # expecting one of setList, whiteList, blackList
 	scope_value = models.CharField(max_length=1024)
+	incremental = models.BooleanField(default=0) # if True, harvest only records changed since last harvest
+	last_harvest_datestamp = models.CharField(max_length=128, null=True, default=None)
+	last_harvest_job = models.ForeignKey(Job, null=True, default=None, on_delete=models.SET_NULL, related_name='+')
 
 
 	def __str__(self):
@@ -1015,23 +1043,61 @@ class Transformation(models.Model):
 class OAITransaction(models.Model):
 
 	'''
-	Model to manage transactions from OAI server, including all requests and resumption tokens when needed.
+	Model to record resumption tokens issued by OAI server, when OAI_RESUMPTION_TOKENS is 'db', as an audit trail.
+	With 'signed', the default, resumption tokens carry their own page parameters and no rows are written.
 
-	Improvement: expire resumption tokens after some time.
+	Each row stores the token and its page parameters, as compact JSON, until it expires.  Expired rows are purged
+	as tokens are issued, such that the table holds only tokens issued within OAI_RESUMPTION_TOKEN_TTL.
 	'''
 
 	verb = models.CharField(max_length=255)
-	start = models.IntegerField(null=True, default=None)
-	chunk_size = models.IntegerField(null=True, default=None)
 	publish_set_id = models.CharField(max_length=255, null=True, default=None)
-	token = models.CharField(max_length=1024, db_index=True)
-	args = models.CharField(max_length=1024)
-	
+	token = models.CharField(max_length=32, unique=True)
+	params = models.TextField()
+	timestamp = models.DateTimeField(auto_now_add=True)
+	expires = models.DateTimeField(db_index=True)
+
+	# time of last purge of expired rows, by this process
+	purged_at = 0
+
 
 	def __str__(self):
 		return 'OAI Transaction: %s, resumption token: %s' % (self.id, self.token)
 
 
+	@classmethod
+	def purge_expired(cls, interval=60):
+
+		'''
+		Delete expired rows, at most once per interval from this process
+
+		Args:
+			interval (int): seconds between purges
+
+		Returns:
+			None
+		'''
+
+		if time.time() - cls.purged_at >= interval:
+			cls.purged_at = time.time()
+			cls.objects.filter(expires__lte=timezone.now()).delete()
+
+
+
+class RecordManager(models.Manager):
+
+	'''
+	Manager for Record, deferring document and error when stored in Parquet record store.
+	Deferred fields are loaded lazily by Record.refresh_from_db(), or in bulk by Record.load_documents()
+	'''
+
+	def get_queryset(self):
+		qs = super().get_queryset()
+		if settings.RECORD_STORAGE_BACKEND == 'parquet':
+			qs = qs.defer('document','error')
+		return qs
+
+
 
 class Record(models.Model):
 
@@ -1052,6 +1118,10 @@ class Record(models.Model):
 	oai_set = models.CharField(max_length=255, null=True, default=None)
 	success = models.BooleanField(default=1)
 	published = models.BooleanField(default=0)
+	document_hash = models.CharField(max_length=32, null=True, default=None) # MD5 of document
+
+	# defers document and error with Parquet record store
+	objects = RecordManager()
 
 
 	# this model is managed outside of Django
@@ -1063,71 +1133,138 @@ class Record(models.Model):
 		return 'Record: #%s, record_id: %s, job_id: %s, job_type: %s' % (self.id, self.record_id, self.job.id, self.job.job_type)
 
 
-	def get_record_stages(self, input_record_only=False):
+	def refresh_from_db(self, using=None, fields=None):
 
 		'''
-		Method to return all upstream and downstreams stages of this record
+		Override to load deferred document and error from Parquet record store, when used
+		'''
+
+		if settings.RECORD_STORAGE_BACKEND == 'parquet' and fields and set(fields) <= {'document','error'}:
+			Record.load_documents([self])
+		else:
+			super().refresh_from_db(using=using, fields=fields)
+
+
+	@staticmethod
+	def load_documents(records):
+
+		'''
+		Method to load document and error for Records in bulk, from Parquet record store reading once per job, or
+		from MySQL in one query where deferred
 
 		Args:
-			input_record_only (bool): If True, return only immediate record that served as input for this record.
+			records (list): list of Record instances
 
 		Returns:
-			(list): ordered list of Record instances from first created (e.g. Harvest), to last (e.g. Publish).
-			This record is included in the list.
+			None
+				- sets document and error on each Record instance
 		'''
 
-		record_stages = []
-
-		def get_upstream(record, input_record_only):
+		# MySQL record store, documents deferred by query are loaded in one query
+		if settings.RECORD_STORAGE_BACKEND != 'parquet':
+			documents = { row[0]:row[1:] for row in Record.objects.filter(id__in=[ record.id for record in records ]).values_list('id','document','error') }
+			for record in records:
+				record.document, record.error = documents.get(record.id, (None, None))
+			return
 
-			# check for upstream job
-			upstream_job_query = record.job.jobinput_set
+		if pq is None:
+			raise Exception('pyarrow is required to read documents from Parquet record store')
 
-			# if upstream jobs found, continue
-			if upstream_job_query.count() > 0:
+		# group records by job, as Parquet store is partitioned by job_id
+		jobs = {}
+		for record in records:
+			jobs.setdefault(record.job_id, []).append(record)
 
-				logger.debug('upstream jobs found, checking for record_id')
+		for job_id, job_records in jobs.items():
 
-				# loop through upstream jobs, look for record id
-				for upstream_job in upstream_job_query.all():
-					upstream_record_query = Record.objects.filter(
-						job=upstream_job.input_job).filter(record_id=self.record_id)
+			# read only requested rows and columns from job partition
+			partition_path = '%s/job_id=%s' % (settings.RECORD_STORAGE_PARQUET_PATH.split('file://')[-1].rstrip('/'), job_id)
+			table = pq.read_table(
+				partition_path,
+				columns=['id','document','error'],
+				filters=[('id', 'in', [ record.id for record in job_records ])]
+			)
+			documents = { row['id']:row for row in table.to_pylist() }
 
-					# if count found, save record to record_stages and re-run
-					if upstream_record_query.count() > 0:
-						upstream_record = upstream_record_query.first()
-						record_stages.insert(0, upstream_record)
-						if not input_record_only:
-							get_upstream(upstream_record, input_record_only)
+			# set on records, missing rows left as None
+			for record in job_records:
+				row = documents.get(record.id, {})
+				record.document = row.get('document', None)
+				record.error = row.get('error', None)
 
 
-		def get_downstream(record):
+	def get_record_stages(self, input_record_only=False):
 
-			# check for downstream job
-			downstream_job_query = JobInput.objects.filter(input_job=record.job)
+		'''
+		Method to return all upstream and downstreams stages of this record
 
-			# if downstream jobs found, continue
-			if downstream_job_query.count() > 0:
+		Job lineage is loaded from JobInput once, and this record's record_id is retrieved for all upstream and
+		downstream jobs in a single query, backed by the (job_id, record_id) index of core_record.  Stages are
+		then resolved in memory, following input jobs upstream and downstream jobs downstream, in JobInput order.
 
-				logger.debug('downstream jobs found, checking for record_id')
+		Args:
+			input_record_only (bool): If True, return only immediate record that served as input for this record.
 
-				# loop through downstream jobs
-				for downstream_job in downstream_job_query.all():
+		Returns:
+			(list): ordered list of Record instances from first created (e.g. Harvest), to last (e.g. Publish).
+			This record is included in the list.
+		'''
 
-					downstream_record_query = Record.objects.filter(
-						job=downstream_job.job).filter(record_id=self.record_id)
+		record_stages = []
 
-					# if count found, save record to record_stages and re-run
-					if downstream_record_query.count() > 0:
-						downstream_record = downstream_record_query.first()
-						record_stages.append(downstream_record)
-						get_downstream(downstream_record)
+		# load job DAG once, as input jobs and downstream jobs for each job
+		input_jobs = {}
+		downstream_jobs = {}
+		for job_id, input_job_id in JobInput.objects.order_by('id').values_list('job_id', 'input_job_id'):
+			input_jobs.setdefault(job_id, []).append(input_job_id)
+			downstream_jobs.setdefault(input_job_id, []).append(job_id)
+
+		def get_lineage_job_ids(job_id, edges, lineage_job_ids):
+			for next_job_id in edges.get(job_id, []):
+				if next_job_id not in lineage_job_ids:
+					lineage_job_ids.add(next_job_id)
+					get_lineage_job_ids(next_job_id, edges, lineage_job_ids)
+			return lineage_job_ids
+
+		# collect upstream and downstream jobs
+		if input_record_only:
+			lineage_job_ids = set(input_jobs.get(self.job_id, []))
+		else:
+			lineage_job_ids = get_lineage_job_ids(self.job_id, input_jobs, set()) | get_lineage_job_ids(self.job_id, downstream_jobs, set())
+
+		# retrieve records for all lineage jobs in one query, keeping first record per job
+		stage_records = {}
+		if len(lineage_job_ids) > 0:
+			lineage_records = Record.objects.filter(job_id__in=lineage_job_ids, record_id=self.record_id)\
+				.select_related('job__record_group__organization').order_by('id')
+			for record in lineage_records:
+				stage_records.setdefault(record.job_id, record)
+
+		def get_upstream(job_id):
+			for input_job_id in input_jobs.get(job_id, []):
+				if input_job_id in stage_records:
+					record_stages.insert(0, stage_records[input_job_id])
+					if not input_record_only:
+						get_upstream(input_job_id)
+
+		def get_downstream(job_id):
+			for downstream_job_id in downstream_jobs.get(job_id, []):
+				if downstream_job_id in stage_records:
+					record_stages.append(stage_records[downstream_job_id])
+					get_downstream(downstream_job_id)
 
 		# run
-		get_upstream(self, input_record_only)
+		get_upstream(self.job_id)
 		if not input_record_only:
 			record_stages.append(self)
-			get_downstream(self)
+			get_downstream(self.job_id)
+
+		# flag stages where document changed from previous stage, by document hash, None if not yet hashed
+		for i, record_stage in enumerate(record_stages):
+			if i == 0 or record_stage.document_hash is None or record_stages[i-1].document_hash is None:
+				record_stage.document_changed = None
+			else:
+				record_stage.document_changed = record_stage.document_hash != record_stages[i-1].document_hash
 		
 		# return		
 		return record_stages
@@ -1393,6 +1530,32 @@ class IndexMappingFailure(models.Model):
 
 
 
+class PublishedRecordIndex(models.Model):
+
+	'''
+	Model for index of published records by publish set, keyed by (publish_set_id, id), such that OAI set filters
+	and ListSets read one table instead of joining Records through Jobs to Record Groups.
+	Maintained by PublishedRecords.update_set_index() when jobs are published, or Record Groups change set.
+
+	NOTE: This DB model is not managed by Django for performance reasons.  The SQL for table creation is included in
+	combine/core/inc/combine_tables_prime.sql
+	'''
+
+	id = models.IntegerField(primary_key=True) # id of published Record
+	publish_set_id = models.CharField(max_length=128)
+	job = models.ForeignKey(Job, on_delete=models.DO_NOTHING)
+
+
+	# this model is managed outside of Django
+	class Meta:
+		managed = False
+
+
+	def __str__(self):
+		return 'Published Record Index: #%s, publish_set_id: %s, job_id: %s' % (self.id, self.publish_set_id, self.job_id)
+
+
+
 class DPLAJobMap(models.Model):
 
 	'''
@@ -1862,6 +2025,7 @@ def delete_job_pre_delete(sender, instance, **kwargs):
 		- if job is queued or running, stop
 		- if Publish job, remove symlinks
 		- remove avro files from disk
+		- remove job partition from Parquet record store (if used)
 		- delete ES indexes (if present)
 
 	Args:
@@ -1926,29 +2090,43 @@ def delete_job_pre_delete(sender, instance, **kwargs):
 			logger.debug(str(e))
 
 
+		# remove cached OAI record fragments of unpublished records
+		OAIRecordFragmentCache.invalidate(instance.id)
+
+		# remove unpublished records from published record set index
+		PublishedRecords.remove_set_index([instance.id])
+
 		# when removing publish job, unset RecordGroup publish_set_id
 		logger.debug('Unsetting RecordGroup publish_set_id')
 		instance.record_group.publish_set_id = None
 		instance.record_group.save()
 
-	# remove avro files from disk
-	# if file://
-	if instance.job_output and instance.job_output.startswith('file://'):
+	# remove native OAI harvester shards and checkpoints, if present
+	try:
+		harvest_dir = '%s/oai_harvest/j%s' % (settings.BINARY_STORAGE.split('file://')[-1].rstrip('/'), instance.id)
+		if os.path.exists(harvest_dir):
+			shutil.rmtree(harvest_dir)
+	except:
+		logger.debug('could not remove OAI harvest directory for job id %s' % instance.id)
 
-		try:
-			output_dir = instance.job_output.split('file://')[-1]
-			shutil.rmtree(output_dir)
-		except:
-			logger.debug('could not remove job output directory at: %s' % instance.job_output)
 
+	# remove avro files, Parquet record store partition, and ES index
+	instance.remove_output_files()
 
-	# remove ES index if exists
-	try:
-		if es_handle.indices.exists('j%s' % instance.id):
-			logger.debug('removing ES index: j%s' % instance.id)
-			es_handle.indices.delete('j%s' % instance.id)
-	except:
-		logger.debug('could not remove ES index: j%s' % instance.id)
+
+@receiver(models.signals.post_save, sender=Job)
+@receiver(models.signals.post_delete, sender=Job)
+@receiver(models.signals.post_save, sender=JobInput)
+@receiver(models.signals.post_delete, sender=JobInput)
+@receiver(models.signals.post_save, sender=JobValidation)
+@receiver(models.signals.post_delete, sender=JobValidation)
+def invalidate_job_lineage_graph(sender, instance, **kwargs):
+
+	'''
+	When Jobs, input Jobs, or Job validations change, invalidate cached job lineage graph
+	'''
+
+	JobLineageGraph.invalidate()
 
 
 @receiver(models.signals.post_delete, sender=Job)
@@ -1973,6 +2151,25 @@ def update_uniqueness_of_published_records(sender, instance, **kwargs):
 		pr.update_published_uniqueness()
 
 
+@receiver(models.signals.post_save, sender=RecordGroup)
+def update_published_record_set_index(sender, instance, **kwargs):
+
+	'''
+	After Record Group save, if publish_set_id differs from published record set index, re-index its Publish jobs
+	'''
+
+	# get publish jobs of record group
+	publish_job_ids = list(instance.job_set.filter(job_type='PublishJob').values_list('id', flat=True))
+	if len(publish_job_ids) == 0:
+		return
+
+	# compare publish set ids in index with publish_set_id of record group
+	indexed_set_ids = set(PublishedRecordIndex.objects.filter(job_id__in=publish_job_ids).values_list('publish_set_id', flat=True).distinct())
+	if indexed_set_ids != ({instance.publish_set_id} if instance.publish_set_id else set()):
+		logger.debug('publish_set_id of %s changed, updating published record set index' % instance)
+		PublishedRecords.update_set_index(publish_job_ids)
+
+
 @receiver(models.signals.pre_save, sender=Transformation)
 def save_transformation_to_disk(sender, instance, **kwargs):
 
@@ -2073,6 +2270,9 @@ class LivyClient(object):
 	server_port = settings.LIVY_PORT 
 	default_session_config = settings.LIVY_DEFAULT_SESSION_CONFIG
 
+	# pooled HTTP session, reused for all requests to Livy
+	session = requests.Session()
+
 
 	@classmethod
 	def http_request(self,
@@ -2101,7 +2301,6 @@ class LivyClient(object):
 			data = json.dumps(data)
 
 		# build request
-		session = requests.Session()
 		request = requests.Request(http_method, "http://%s:%s/%s" % (
 			self.server_host,
 			self.server_port,
@@ -2109,8 +2308,8 @@ class LivyClient(object):
 			data=data,
 			headers=headers,
 			files=files)
-		prepped_request = request.prepare() # or, with session, session.prepare_request(request)
-		response = session.send(
+		prepped_request = self.session.prepare_request(request)
+		response = self.session.send(
 			prepped_request,
 			stream=stream,
 		)
@@ -2193,7 +2392,7 @@ class LivyClient(object):
 
 
 	@classmethod
-	def get_jobs(self, session_id, python_code):
+	def get_jobs(self, session_id, python_code=None):
 
 		'''
 		Get all jobs (statements) for a session
@@ -2207,7 +2406,7 @@ class LivyClient(object):
 
 		# statement
 		jobs = self.http_request('GET', 'sessions/%s/statements' % session_id)
-		return job
+		return jobs
 
 
 	@classmethod
@@ -2267,71 +2466,619 @@ class LivyClient(object):
 		# statement
 		statement = self.http_request('POST', '%s/cancel' % job_url)
 		return statement
-		
 
 
-####################################################################
-# Combine Models 												   #
-####################################################################
 
-class ESIndex(object):
+class LivyStatusPoller(object):
 
 	'''
-	Model to aggregate methods useful for accessing and analyzing ElasticSearch indices
+	Poll Livy for status of all unfinished Jobs, with one request per Livy session for all of its statements, and
+	update Jobs in bulk, such that views read Job status from DB without requests to Livy.
+
+	Run periodically with management command: python manage.py polllivystatus
 	'''
 
-	def __init__(self, es_index):
+	# statuses of Jobs that may yet change in Livy
+	polled_statuses = ['initializing','waiting','pending','starting','running','available']
 
-		self.es_index = es_index
+	# parse session and statement ids from Job url, e.g. /sessions/0/statements/3
+	statement_url_re = re.compile(r'sessions/([0-9]+)/statements/([0-9]+)')
 
 
-	def get_index_fields(self):
+	def poll(self):
 
 		'''
-		Get list of all fields for index
+		Poll Livy and update status, finished, elapsed, and record_count of unfinished Jobs
 
 		Args:
 			None
 
 		Returns:
-			(list): list of field names
+			(int): count of Jobs with changed status
 		'''
 
-		if es_handle.indices.exists(index=self.es_index) and es_handle.search(index=self.es_index)['hits']['total'] > 0:
+		# get unfinished jobs, grouped by Livy session
+		session_jobs = {}
+		jobs = Job.objects.filter(deleted=False, finished=False, status__in=self.polled_statuses, url__isnull=False)
+		for job in jobs.only('id','url','status','finished','record_count'):
+			url_match = self.statement_url_re.search(job.url)
+			if url_match:
+				session_jobs.setdefault(int(url_match.group(1)), []).append((job, int(url_match.group(2))))
 
-			# get mappings for job index
-			es_r = es_handle.indices.get(index=self.es_index)
-			self.index_mappings = es_r[self.es_index]['mappings']['record']['properties']
+		# get statements for each session, and determine job status from statement
+		status_updates = {}
+		polled_jobs = []
+		for session_id, jobs_statements in session_jobs.items():
 
-			# sort alphabetically that influences results list
-			field_names = list(self.index_mappings.keys())
-			field_names.sort()
+			statements = self.get_session_statements(session_id)
+			if statements is False:
+				continue
 
-			return field_names
+			for job, statement_id in jobs_statements:
 
+				# session or statement not found, set as gone
+				if statements is None or statement_id not in statements:
+					status = 'gone'
+				else:
+					status = statements[statement_id]['state']
 
-	def _calc_field_metrics(self,
-			sr_dict,
-			field_name,
-			one_per_doc_offset=settings.ONE_PER_DOC_OFFSET
-		):
+				# if state is available, assume finished
+				finished = status == 'available'
+				if status != job.status or finished:
+					status_updates.setdefault((status, finished), []).append(job.id)
+				job.status = status
+				job.finished = finished
+				polled_jobs.append(job)
+
+		# update status in bulk
+		for (status, finished), job_ids in status_updates.items():
+			Job.objects.filter(pk__in=job_ids).update(status=status, finished=finished)
+
+		# update elapsed from job tracks, and record count of finished jobs
+		self.update_elapsed(polled_jobs)
+		for job in polled_jobs:
+			if job.finished and job.record_count == 0:
+				Job.objects.filter(pk=job.id).update(record_count=job.record_set.count())
+
+		# bulk updates do not send signals, invalidate job lineage graph
+		if len(status_updates) > 0:
+			JobLineageGraph.invalidate()
+
+		return sum([ len(job_ids) for job_ids in status_updates.values() ])
+
+
+	def get_session_statements(self, session_id):
 
 		'''
-		Calculate metrics for a given field.
+		Return statements of Livy session, keyed by statement id
 
 		Args:
-			sr_dict (dict): ElasticSearch search results dictionary
-			field_name (str): Field name to analyze metrics for
-			one_per_doc_offset (float): Offset from 1.0 that is used to guess if field is unique for all documents
+			session_id (int): Livy session id
 
 		Returns:
-			(dict): Dictionary of metrics for given field
+			(dict): statements keyed by id, None if session is gone, False if status could not be retrieved
 		'''
-		
-		if sr_dict['aggregations']['%s_doc_instances' % field_name]['doc_count'] > 0:
-				
-			# add that don't require calculation
-			field_dict = {
+
+		livy_response = LivyClient.get_jobs(session_id)
+
+		# session likely not active, or not found
+		if livy_response.status_code in [400, 404]:
+			logger.debug('Livy session %s not found, setting jobs to gone' % session_id)
+			return None
+
+		elif livy_response.status_code == 200:
+			return { statement['id']:statement for statement in livy_response.json()['statements'] }
+
+		else:
+			logger.debug('error retrieving statements for Livy session %s: %s' % (session_id, livy_response.status_code))
+			return False
+
+
+	@staticmethod
+	def update_elapsed(jobs):
+
+		'''
+		Update elapsed of Jobs from their first JobTrack, retrieved in one query
+
+		Args:
+			jobs (list): Job instances, with finished set
+
+		Returns:
+			None
+		'''
+
+		job_tracks = {}
+		for job_track in JobTrack.objects.filter(job_id__in=[ job.id for job in jobs ]).order_by('id'):
+			job_tracks.setdefault(job_track.job_id, job_track)
+
+		for job in jobs:
+			job_track = job_tracks.get(job.id)
+			if job_track is None:
+				continue
+			if not job.finished:
+				elapsed = (datetime.datetime.now() - job_track.start_timestamp.replace(tzinfo=None)).seconds
+			else:
+				elapsed = (job_track.finish_timestamp - job_track.start_timestamp).seconds
+			Job.objects.filter(pk=job.id).update(elapsed=elapsed)
+
+
+
+class LivyScheduler(object):
+
+	'''
+	Schedule queued Jobs on a pool of LIVY_SESSION_POOL_SIZE Livy sessions, such that Jobs run concurrently.
+
+	Jobs are queued in DB as core.models.JobQueue by CombineJob.submit_job_to_livy.  Each run of schedule():
+		- maintains the pool, starting sessions until LIVY_SESSION_POOL_SIZE are active
+		- requeues Jobs whose session died (status 'gone'), up to LIVY_SCHEDULER_MAX_ATTEMPTS
+		- dispatches queued Jobs, in order queued, to idle sessions, once their input Jobs are finished, running
+		at most LIVY_SCHEDULER_MAX_LARGE_JOBS Jobs expecting LIVY_SCHEDULER_LARGE_JOB_RECORDS or more records, counted
+		from input Jobs when dispatched, or from the previous run of Jobs without input Jobs
+		- leaves Jobs queued when submitting to Livy fails, failing them after LIVY_SCHEDULER_MAX_ATTEMPTS attempts
+
+	Run with Livy status polling: python manage.py polllivystatus
+	'''
+
+	# statuses of Jobs not yet finished in Livy
+	running_statuses = ['waiting','pending','starting','running']
+
+	# statuses of input Jobs that will not finish
+	failed_statuses = ['error','cancelling','cancelled','failed','gone']
+
+
+	@staticmethod
+	def submit(job, livy_session, job_code):
+
+		'''
+		Submit job code to Livy session, and update Job with statement
+
+		Args:
+			job (core.models.Job): Job
+			livy_session (core.models.LivySession): Livy session
+			job_code (dict): code for Livy statement
+
+		Returns:
+			None
+		'''
+
+		# submit job
+		submit = LivyClient().submit_job(livy_session.session_id, job_code)
+		response = submit.json()
+		headers = submit.headers
+
+		# update job in DB
+		job.spark_code = job_code
+		job.job_id = int(response['id'])
+		job.status = response['state']
+		job.url = headers['Location']
+		job.headers = headers
+		job.save()
+
+		# stages of a pipeline run in the same statement
+		job.get_pipeline_jobs().exclude(pk=job.id).update(
+			spark_code=job_code,
+			job_id=job.job_id,
+			status=job.status,
+			url=job.url,
+			headers=str(headers)
+		)
+		JobLineageGraph.invalidate()
+
+
+	@staticmethod
+	def enqueue(job, job_code):
+
+		'''
+		Queue Job for dispatch, with expected record count as known when queued, refreshed when dispatched
+
+		Args:
+			job (core.models.Job): Job
+			job_code (dict): code for Livy statement
+
+		Returns:
+			(core.models.JobQueue)
+		'''
+
+		queue_entry = JobQueue(
+			job=job,
+			job_code=json.dumps(job_code),
+			expected_record_count=LivyScheduler.get_expected_record_count(job)
+		)
+		queue_entry.save()
+
+		# update job in DB, with stages of a pipeline
+		job.spark_code = job_code
+		job.status = 'queued'
+		job.save()
+		job.get_pipeline_jobs().exclude(pk=job.id).update(status='queued')
+		JobLineageGraph.invalidate()
+
+		return queue_entry
+
+
+	def schedule(self):
+
+		'''
+		Maintain session pool, requeue Jobs of dead sessions, and dispatch queued Jobs to idle sessions
+
+		Args:
+			None
+
+		Returns:
+			(int): count of Jobs dispatched
+		'''
+
+		livy_sessions = self.maintain_session_pool()
+		self.requeue_gone_jobs()
+
+		# dispatched jobs still running, by session
+		running_entries = JobQueue.objects.filter(status='dispatched', job__status__in=self.running_statuses).select_related('job')
+		busy_session_ids = set([ entry.livy_session_id for entry in running_entries ])
+		large_running = len([ entry for entry in running_entries if self.is_large(entry) ])
+
+		# idle sessions, per Livy and without running jobs from queue
+		idle_sessions = [ ls for ls in livy_sessions if ls.status == 'idle' and ls.id not in busy_session_ids ]
+
+		dispatched = 0
+		for queue_entry in JobQueue.objects.filter(status='queued').select_related('job').order_by('id'):
+
+			if len(idle_sessions) == 0:
+				break
+
+			# wait for input jobs to finish, failing if an input job will not
+			inputs_status = self.get_inputs_status(queue_entry.job)
+			if inputs_status == 'failed':
+				self.fail(queue_entry, 'input job failed')
+				continue
+			elif inputs_status == 'waiting':
+				continue
+
+			# expected record count, now that input jobs are finished
+			queue_entry.expected_record_count = self.get_expected_record_count(queue_entry.job)
+
+			# limit concurrent large jobs
+			is_large = self.is_large(queue_entry)
+			if is_large:
+				if large_running >= settings.LIVY_SCHEDULER_MAX_LARGE_JOBS:
+					continue
+				large_running += 1
+
+			# dispatch, counting attempt
+			livy_session = idle_sessions.pop(0)
+			queue_entry.attempts += 1
+			try:
+				self.submit(queue_entry.job, livy_session, json.loads(queue_entry.job_code))
+			except Exception as e:
+				logger.debug('could not dispatch job %s to Livy session %s: %s' % (queue_entry.job_id, livy_session.session_id, str(e)))
+
+				# return session to idle sessions, and release large job slot
+				idle_sessions.insert(0, livy_session)
+				if is_large:
+					large_running -= 1
+
+				# leave queued for next pass, or fail after max attempts
+				if queue_entry.attempts >= settings.LIVY_SCHEDULER_MAX_ATTEMPTS:
+					self.fail(queue_entry, 'could not dispatch after %s attempts' % queue_entry.attempts)
+				else:
+					queue_entry.save()
+				continue
+			queue_entry.status = 'dispatched'
+			queue_entry.livy_session = livy_session
+			queue_entry.dispatched_timestamp = datetime.datetime.now()
+			queue_entry.save()
+			dispatched += 1
+
+		return dispatched
+
+
+	def maintain_session_pool(self):
+
+		'''
+		Refresh status of active Livy sessions, deactivating dead sessions, and start sessions to fill pool
+
+		Returns:
+			(list): active Livy sessions
+		'''
+
+		livy_sessions = []
+		for livy_session in LivySession.objects.filter(active=True):
+			livy_session.refresh_from_livy()
+			if livy_session.status in ['starting','idle','busy']:
+				livy_sessions.append(livy_session)
+			else:
+				livy_session.active = False
+				livy_session.save()
+
+		# start sessions to fill pool
+		while len(livy_sessions) < settings.LIVY_SESSION_POOL_SIZE:
+			livy_session = LivySession()
+			livy_session.start_session()
+			livy_sessions.append(livy_session)
+
+		return livy_sessions
+
+
+	def requeue_gone_jobs(self):
+
+		'''
+		Requeue dispatched Jobs whose session died, removing partial output, or fail after max attempts
+		'''
+
+		for queue_entry in JobQueue.objects.filter(status='dispatched', job__status='gone').select_related('job'):
+
+			if queue_entry.attempts >= settings.LIVY_SCHEDULER_MAX_ATTEMPTS:
+				self.fail(queue_entry, 'Livy session gone after %s attempts' % queue_entry.attempts)
+				continue
+
+			logger.debug('Livy session gone for job %s, requeuing' % queue_entry.job_id)
+			queue_entry.status = 'queued'
+			queue_entry.livy_session = None
+			queue_entry.save()
+
+			# reset job, with stages of a pipeline
+			for job in queue_entry.job.get_pipeline_jobs():
+				job.remove_output()
+				job.status = 'queued'
+				job.job_id = None
+				job.url = None
+				job.finished = False
+				job.record_count = 0
+				job.save()
+
+
+	@staticmethod
+	def get_inputs_status(job):
+
+		'''
+		Return 'finished' if all input Jobs finished, 'failed' if any will not finish, else 'waiting'
+		'''
+
+		input_jobs = Job.objects.filter(pk__in=JobInput.objects.filter(job=job).values_list('input_job_id', flat=True))
+		for input_job in input_jobs:
+			if input_job.finished:
+				continue
+			if input_job.status in LivyScheduler.failed_statuses:
+				if not JobQueue.objects.filter(job=input_job, status__in=['queued','dispatched']).exists():
+					return 'failed'
+			return 'waiting'
+		return 'finished'
+
+
+	@staticmethod
+	def get_expected_record_count(job):
+
+		'''
+		Return expected record count of Job, as resource hint: sum of input Jobs' record counts, or for Jobs without
+		input Jobs, as harvests and pipelines, record count of last finished Job of same type in Record Group
+
+		Args:
+			job (core.models.Job): Job
+
+		Returns:
+			(int): expected record count, or None if not known
+		'''
+
+		input_job_ids = JobInput.objects.filter(job=job).values_list('input_job_id', flat=True)
+		if len(input_job_ids) > 0:
+			return Job.objects.filter(pk__in=input_job_ids).aggregate(models.Sum('record_count'))['record_count__sum']
+
+		previous_job = Job.objects.filter(record_group_id=job.record_group_id, job_type=job.job_type, finished=True, record_count__gt=0)\
+			.exclude(pk=job.pk).order_by('-id').first()
+		return previous_job.record_count if previous_job is not None else None
+
+
+	@staticmethod
+	def is_large(queue_entry):
+		return queue_entry.expected_record_count is not None and queue_entry.expected_record_count >= settings.LIVY_SCHEDULER_LARGE_JOB_RECORDS
+
+
+	@staticmethod
+	def fail(queue_entry, reason):
+		logger.debug('job %s failed in Livy scheduler: %s' % (queue_entry.job_id, reason))
+		queue_entry.status = 'failed'
+		queue_entry.save()
+		queue_entry.job.status = 'failed'
+		queue_entry.job.save()
+
+
+
+####################################################################
+# Combine Models 												   #
+####################################################################
+
+class JobLineageGraph(object):
+
+	'''
+	Model for lineage of all Jobs, as a directed graph of Jobs as nodes and input Jobs as edges.
+
+	The graph is built in memory from Job, JobInput, and JobValidation, one query each, plus one aggregate of
+	RecordValidation for failures not yet counted, without writing rows, and cached with Django's cache, shared by
+	all processes, for JOB_LINEAGE_CACHE_TIMEOUT seconds.  The cache is invalidated when a Job, JobInput, or
+	JobValidation is saved or deleted, and explicitly after bulk updates, which do not send signals.
+	'''
+
+	cache_key = 'combine_job_lineage_graph'
+
+
+	def __init__(self):
+
+		# nodes, keyed by Job id
+		self.nodes = {}
+
+		# input Job ids, keyed by Job id
+		self.input_jobs = {}
+
+		# jobs as nodes
+		for job in Job.objects.values('id','name','job_type','status','deleted','record_group_id','record_group__organization_id'):
+			node_dict = {
+				'id':job['id'],
+				'name':job['name'],
+				'record_group_id':None,
+				'org_id':None,
+				'job_type':job['job_type'],
+				'job_status':job['status'],
+				'is_valid':True,
+				'deleted':job['deleted']
+			}
+
+			# if not Analysis job, add org and record group
+			if job['job_type'] != 'AnalysisJob':
+				node_dict['record_group_id'] = job['record_group_id']
+				node_dict['org_id'] = job['record_group__organization_id']
+
+			self.nodes[job['id']] = node_dict
+
+		# input jobs as edges
+		for job_id, input_job_id in JobInput.objects.order_by('id').values_list('job_id', 'input_job_id'):
+			self.input_jobs.setdefault(job_id, []).append(input_job_id)
+
+		# validation verdicts, with failures not yet counted for finished jobs counted in one aggregate, without saving
+		job_validations = list(JobValidation.objects.select_related('job'))
+		uncounted_job_ids = [ jv.job_id for jv in job_validations if jv.failure_count is None and jv.job.finished ]
+		failure_counts = {}
+		if len(uncounted_job_ids) > 0:
+			for row in RecordValidation.objects.filter(record__job_id__in=uncounted_job_ids)\
+				.values('record__job_id','validation_scenario_id').annotate(Count('id')).order_by():
+				failure_counts[(row['record__job_id'], row['validation_scenario_id'])] = row['id__count']
+		for jv in job_validations:
+			failure_count = jv.failure_count
+			if failure_count is None and jv.job.finished:
+				failure_count = failure_counts.get((jv.job_id, jv.validation_scenario_id), 0)
+			if failure_count and jv.job_id in self.nodes:
+				self.nodes[jv.job_id]['is_valid'] = False
+
+
+	@classmethod
+	def get(cls):
+
+		'''
+		Return job lineage graph from cache, building if not cached
+
+		Returns:
+			(core.models.JobLineageGraph)
+		'''
+
+		graph = cache.get(cls.cache_key)
+		if graph is None:
+			graph = cls()
+			cache.set(cls.cache_key, graph, settings.JOB_LINEAGE_CACHE_TIMEOUT)
+		return graph
+
+
+	@classmethod
+	def invalidate(cls):
+		cache.delete(cls.cache_key)
+
+
+	def get_lineage(self, job_ids, directionality='downstream'):
+
+		'''
+		Return lineage of Jobs, with all upstream Jobs
+
+		Args:
+			job_ids (list): Job ids
+			directionality (str)['upstream','downstream']: directionality for edges
+
+		Returns:
+			(dict): lineage dictionary of nodes (jobs) and edges (input jobs as edges), sorted by id
+		'''
+
+		nodes = {}
+		edges = {}
+
+		# walk upstream from each job, visiting each job once
+		to_visit = [ job_id for job_id in job_ids if job_id in self.nodes ]
+		while len(to_visit) > 0:
+			job_id = to_visit.pop()
+			if job_id in nodes:
+				continue
+			nodes[job_id] = self.nodes[job_id]
+
+			for input_job_id in self.input_jobs.get(job_id, []):
+
+				# determine directionality
+				if directionality == 'upstream':
+					from_node = job_id
+					to_node = input_job_id
+				elif directionality == 'downstream':
+					from_node = input_job_id
+					to_node = job_id
+
+				# add edge
+				edge_id = '%s_to_%s' % (from_node, to_node)
+				edges[edge_id] = {
+					'id':edge_id,
+					'from':from_node,
+					'to':to_node
+				}
+
+				to_visit.append(input_job_id)
+
+		# sort by id
+		return {
+			'nodes':[ nodes[job_id] for job_id in sorted(nodes.keys()) ],
+			'edges':[ edges[edge_id] for edge_id in sorted(edges.keys()) ]
+		}
+
+
+class ESIndex(object):
+
+	'''
+	Model to aggregate methods useful for accessing and analyzing ElasticSearch indices
+	'''
+
+	def __init__(self, es_index):
+
+		self.es_index = es_index
+
+
+	def get_index_fields(self):
+
+		'''
+		Get list of all fields for index
+
+		Args:
+			None
+
+		Returns:
+			(list): list of field names
+		'''
+
+		if es_handle.indices.exists(index=self.es_index) and es_handle.search(index=self.es_index)['hits']['total'] > 0:
+
+			# get mappings for job index
+			es_r = es_handle.indices.get(index=self.es_index)
+			self.index_mappings = es_r[self.es_index]['mappings']['record']['properties']
+
+			# sort alphabetically that influences results list
+			field_names = list(self.index_mappings.keys())
+			field_names.sort()
+
+			return field_names
+
+
+	def _calc_field_metrics(self,
+			sr_dict,
+			field_name,
+			one_per_doc_offset=settings.ONE_PER_DOC_OFFSET
+		):
+
+		'''
+		Calculate metrics for a given field.
+
+		Args:
+			sr_dict (dict): ElasticSearch search results dictionary
+			field_name (str): Field name to analyze metrics for
+			one_per_doc_offset (float): Offset from 1.0 that is used to guess if field is unique for all documents
+
+		Returns:
+			(dict): Dictionary of metrics for given field
+		'''
+		
+		if sr_dict['aggregations']['%s_doc_instances' % field_name]['doc_count'] > 0:
+				
+			# add that don't require calculation
+			field_dict = {
 				'field_name':field_name,
 				'doc_instances':sr_dict['aggregations']['%s_doc_instances' % field_name]['doc_count'],
 				'val_instances':sr_dict['aggregations']['%s_val_instances' % field_name]['value'],
@@ -2527,25 +3274,56 @@ class PublishedRecords(object):
 
 		self.record_group = 0
 
-		# get published jobs
-		self.publish_links = JobPublish.objects.all()
+		# get published jobs, with record groups and jobs loaded in same query
+		self.publish_links = JobPublish.objects.select_related('record_group','job')
+
+		# setup ESIndex instance
+		self.esi = ESIndex('published')
+
+
+	@property
+	def sets(self):
+
+		'''
+		Property to return dictionary of publish set ids, and list of Publish jobs for each, from record group of published jobs
+		'''
 
-		# get set IDs from record group of published jobs
-		# self.sets = { publish_link.record_group.publish_set_id:publish_link.job for publish_link in self.publish_links }
 		sets = {}
 		for publish_link in self.publish_links:
 			publish_set_id = publish_link.record_group.publish_set_id
-			
+
 			# if set not seen, add as list
 			if publish_set_id not in sets.keys():
 				sets[publish_set_id] = []
 
 			# add publish job
-			sets[publish_set_id].append(publish_link.job)	
-		self.sets = sets
+			sets[publish_set_id].append(publish_link.job)
+		return sets
 
-		# setup ESIndex instance
-		self.esi = ESIndex('published')
+
+	@property
+	def set_ids(self):
+
+		'''
+		Property to return list of publish set ids with published records, from published record set index
+		'''
+
+		return list(PublishedRecordIndex.objects.order_by('publish_set_id').values_list('publish_set_id', flat=True).distinct())
+
+
+	def get_set_index(self, publish_set_id):
+
+		'''
+		Return QuerySet of published record set index for publish set, ordered by Record id
+
+		Args:
+			publish_set_id (str): publish set id
+
+		Returns:
+			(django.db.models.query.QuerySet): PublishedRecordIndex instances, with id of published Record
+		'''
+
+		return PublishedRecordIndex.objects.filter(publish_set_id=publish_set_id).order_by('id')
 
 
 	@property
@@ -2621,40 +3399,181 @@ class PublishedRecords(object):
 		set_false = self.records.filter(record_id__in=[item['record_id'] for item in dupes])		
 		set_false.update(unique_published=False)
 
-		logger.debug('uniqueness update elapsed: %s' % (time.time()-stime))
+		logger.debug('uniqueness update elapsed: %s' % (time.time()-stime))
+
+
+	def set_published_field(self, job_id=None):
+
+		'''
+		Method to set 'published' for all Records with Publish Job parent
+		'''
+
+		to_set_published = Record.objects.filter(job__job_type='PublishJob')
+
+		# if job_id
+		if job_id:
+			to_set_published = to_set_published.filter(job__id=job_id)
+
+			# remove any cached OAI record fragments of job
+			OAIRecordFragmentCache.invalidate(job_id)
+
+		# update
+		to_set_published.update(published=True)
+
+
+	@staticmethod
+	def update_set_index(job_ids):
+
+		'''
+		Static method to rebuild published record set index for Publish jobs, from published Records of jobs and
+		current publish_set_id of their Record Group, in one INSERT ... SELECT
+
+		Args:
+			job_ids (list): ids of Publish jobs
+
+		Returns:
+			(int): count of Records indexed
+		'''
+
+		# remove rows of jobs, then insert published records of jobs with publish set
+		PublishedRecords.remove_set_index(job_ids)
+		with connection.cursor() as cursor:
+			cursor.execute(
+				'''
+				INSERT INTO core_publishedrecordindex (publish_set_id, id, job_id)
+				SELECT rg.publish_set_id, r.id, r.job_id FROM core_record r
+				JOIN core_job j ON j.id = r.job_id
+				JOIN core_recordgroup rg ON rg.id = j.record_group_id
+				WHERE r.job_id IN (%s) AND r.published = 1 AND rg.publish_set_id IS NOT NULL
+				''' % ','.join(['%s'] * len(job_ids)), list(job_ids))
+			return cursor.rowcount
+
+
+	@staticmethod
+	def remove_set_index(job_ids):
+
+		'''
+		Static method to remove Publish jobs from published record set index
+
+		Args:
+			job_ids (list): ids of Publish jobs
+
+		Returns:
+			None
+		'''
+
+		PublishedRecordIndex.objects.filter(job_id__in=job_ids).delete()
+
+
+	@staticmethod
+	def get_publish_set_ids():
+
+		'''
+		Static method to return unique, not Null publish set ids
+
+		Args:
+			None
+
+		Returns:
+			(list): list of publish set ids
+		'''
+
+		publish_set_ids = RecordGroup.objects.exclude(publish_set_id=None).values('publish_set_id').distinct()
+		return publish_set_ids
+
+
+
+class OAIRecordFragmentCache(object):
+
+	'''
+	Optional on-disk cache of rendered <metadata> fragments of published Records, such that the OAI server does not
+	load documents of cached Records.  Fragments are keyed by Record id and document_hash, in a directory per Publish
+	Job that is removed when the Job's records are published or unpublished.
+
+	Enabled with OAI_RECORD_FRAGMENT_CACHE, at OAI_RECORD_FRAGMENT_CACHE_DIR.
+	'''
+
+	@staticmethod
+	def job_dir(job_id):
+		return '%s/j%s' % (settings.OAI_RECORD_FRAGMENT_CACHE_DIR.split('file://')[-1].rstrip('/'), job_id)
+
+
+	@staticmethod
+	def fragment_path(record):
+
+		'''
+		Return path of fragment for Record, sharded by id, or None if Record has no document_hash
+		'''
+
+		if record.document_hash is None:
+			return None
+		return '%s/%s/%s_%s.xml' % (OAIRecordFragmentCache.job_dir(record.job_id), record.id // 10000, record.id, record.document_hash)
+
+
+	@staticmethod
+	def get(record):
+
+		'''
+		Return cached fragment of Record as bytes, or None if not cached
+
+		Args:
+			record (core.models.Record): published Record
+
+		Returns:
+			(bytes)
+		'''
 
+		fragment_path = OAIRecordFragmentCache.fragment_path(record)
+		if fragment_path is None:
+			return None
+		try:
+			with open(fragment_path, 'rb') as f:
+				return f.read()
+		except FileNotFoundError:
+			return None
 
-	def set_published_field(self, job_id=None):
+
+	@staticmethod
+	def set(record, fragment):
 
 		'''
-		Method to set 'published' for all Records with Publish Job parent
-		'''
+		Write fragment of Record to cache, via temporary file such that partial fragments are not read
 
-		to_set_published = Record.objects.filter(job__job_type='PublishJob')
+		Args:
+			record (core.models.Record): published Record
+			fragment (bytes): rendered <metadata> fragment
 
-		# if job_id
-		if job_id:
-			to_set_published.filter(job__id=job_id)
+		Returns:
+			None
+		'''
 
-		# update
-		to_set_published.update(published=True)
+		fragment_path = OAIRecordFragmentCache.fragment_path(record)
+		if fragment_path is None:
+			return
+		try:
+			os.makedirs(os.path.dirname(fragment_path), exist_ok=True)
+			tmp_path = '%s.%s' % (fragment_path, uuid.uuid4().hex)
+			with open(tmp_path, 'wb') as f:
+				f.write(fragment)
+			os.replace(tmp_path, fragment_path)
+		except OSError as e:
+			logger.debug('could not write OAI record fragment for record %s: %s' % (record.id, str(e)))
 
 
 	@staticmethod
-	def get_publish_set_ids():
+	def invalidate(job_id):
 
 		'''
-		Static method to return unique, not Null publish set ids
+		Remove cached fragments of Publish Job
 
 		Args:
-			None
+			job_id (int): Publish Job ID
 
 		Returns:
-			(list): list of publish set ids
+			None
 		'''
 
-		publish_set_ids = RecordGroup.objects.exclude(publish_set_id=None).values('publish_set_id').distinct()
-		return publish_set_ids
+		shutil.rmtree(OAIRecordFragmentCache.job_dir(job_id), ignore_errors=True)
 
 
 
@@ -2673,7 +3592,12 @@ class CombineJob(object):
 	def __init__(self, user=None, job_id=None, parse_job_output=True):
 
 		self.user = user
-		self.livy_session = self._get_active_livy_session()
+
+		# with Livy scheduler, jobs are queued and dispatched to a pool of sessions
+		if settings.LIVY_SCHEDULER_ENABLED:
+			self.livy_session = None
+		else:
+			self.livy_session = self._get_active_livy_session()
 		self.df = None
 		self.job_id = job_id
 
@@ -2780,8 +3704,8 @@ class CombineJob(object):
 			None
 		'''
 
-		# if active livy session
-		if self.livy_session:
+		# if Livy scheduler, or active livy session
+		if settings.LIVY_SCHEDULER_ENABLED or self.livy_session:
 			self.prepare_job()
 
 		else:
@@ -2799,23 +3723,21 @@ class CombineJob(object):
 			job_code (str): String of python code to submit to Spark
 			job_output (str): location for job output (NOTE: No longer used)
 
+		If LIVY_SCHEDULER_ENABLED, job is queued in DB for core.models.LivyScheduler to dispatch to an idle Livy
+		session, with expected record count from input jobs as a resource hint.
+
 		Returns:
 			None
 				- sets attributes to self
 		'''
 
-		# submit job
-		submit = LivyClient().submit_job(self.livy_session.session_id, job_code)
-		response = submit.json()
-		headers = submit.headers
+		# queue job for Livy scheduler
+		if settings.LIVY_SCHEDULER_ENABLED:
+			LivyScheduler.enqueue(self.job, job_code)
 
-		# update job in DB
-		self.job.spark_code = job_code
-		self.job.job_id = int(response['id'])
-		self.job.status = response['state']
-		self.job.url = headers['Location']
-		self.job.headers = headers
-		self.job.save()
+		# submit job
+		else:
+			LivyScheduler.submit(self.job, self.livy_session, job_code)
 
 
 	def get_job(self, job_id):
@@ -3186,7 +4108,8 @@ class HarvestOAIJob(HarvestJob):
 		index_mapper=None,
 		oai_endpoint=None,
 		overrides=None,
-		validation_scenarios=[]):
+		validation_scenarios=[],
+		full_harvest=False):
 
 		'''
 		Args:
@@ -3197,6 +4120,7 @@ class HarvestOAIJob(HarvestJob):
 				oai_endpoint (core.models.OAIEndpoint): OAI endpoint to be used for OAI harvest
 				overrides (dict): optional dictionary of overrides to OAI endpoint
 				validation_scenarios (list): List of ValidationScenario ids to perform after job completion
+				full_harvest (bool): if True, harvest in full even if OAI endpoint is set incremental
 
 		Returns:
 			None
@@ -3221,6 +4145,7 @@ class HarvestOAIJob(HarvestJob):
 			self.oai_endpoint = oai_endpoint
 			self.overrides = overrides
 			self.validation_scenarios = validation_scenarios
+			self.full_harvest = full_harvest
 
 			# write validation links
 			if len(self.validation_scenarios) > 0:
@@ -3245,29 +4170,83 @@ class HarvestOAIJob(HarvestJob):
 				- submits job to Livy
 		'''
 
-		# create shallow copy of oai_endpoint and mix in overrides
-		harvest_vars = self.oai_endpoint.__dict__.copy()
-		harvest_vars.update(self.overrides)
-
 		# prepare job code
 		job_code = {
-			'code':'from jobs import HarvestOAISpark\nHarvestOAISpark.spark_function(spark, endpoint="%(endpoint)s", verb="%(verb)s", metadataPrefix="%(metadataPrefix)s", scope_type="%(scope_type)s", scope_value="%(scope_value)s", job_id="%(job_id)s", index_mapper="%(index_mapper)s", validation_scenarios="%(validation_scenarios)s")' % 
-			{
-				'endpoint':harvest_vars['endpoint'],
-				'verb':harvest_vars['verb'],
-				'metadataPrefix':harvest_vars['metadataPrefix'],
-				'scope_type':harvest_vars['scope_type'],
-				'scope_value':harvest_vars['scope_value'],
-				'job_id':self.job.id,
-				'index_mapper':self.index_mapper,
-				'validation_scenarios':str([ int(vs_id) for vs_id in self.validation_scenarios ])
-			}
+			'code':'from jobs import HarvestOAISpark\nHarvestOAISpark.spark_function(spark, endpoint="%(endpoint)s", verb="%(verb)s", metadataPrefix="%(metadataPrefix)s", scope_type="%(scope_type)s", scope_value="%(scope_value)s", job_id="%(job_id)s", index_mapper="%(index_mapper)s", validation_scenarios="%(validation_scenarios)s", oai_endpoint_id="%(oai_endpoint_id)s", from_date="%(from_date)s", previous_job_id="%(previous_job_id)s")' % self.get_spark_kwargs()
 		}
 
 		# submit job
 		self.submit_job_to_livy(job_code, self.job.job_output)
 
 
+	def get_spark_kwargs(self):
+
+		'''
+		Return args for core.spark.jobs.HarvestOAISpark, saving harvest parameters to job_details
+
+		Args:
+			None
+
+		Returns:
+			(dict)
+		'''
+
+		# create shallow copy of oai_endpoint and mix in overrides
+		harvest_vars = self.oai_endpoint.__dict__.copy()
+		harvest_vars.update(self.overrides)
+
+		# save harvest parameters, and determine if incremental harvest
+		oai_params = { k:harvest_vars[k] for k in ['endpoint','verb','metadataPrefix','scope_type','scope_value'] }
+		previous_job, from_date = self.get_incremental_harvest(oai_params)
+		self.job.update_job_details({'oai_params':oai_params})
+
+		return {
+			'endpoint':harvest_vars['endpoint'],
+			'verb':harvest_vars['verb'],
+			'metadataPrefix':harvest_vars['metadataPrefix'],
+			'scope_type':harvest_vars['scope_type'],
+			'scope_value':harvest_vars['scope_value'],
+			'job_id':self.job.id,
+			'index_mapper':self.index_mapper,
+			'validation_scenarios':str([ int(vs_id) for vs_id in self.validation_scenarios ]),
+			'oai_endpoint_id':self.oai_endpoint.id,
+			'from_date':from_date or '',
+			'previous_job_id':previous_job.id if previous_job else ''
+		}
+
+
+	def get_incremental_harvest(self, oai_params):
+
+		'''
+		Determine if harvest is incremental: OAI endpoint is set incremental, full harvest not requested, and the
+		endpoint's last successful harvest is a Job in this Record Group, harvested with the same parameters
+
+		Args:
+			oai_params (dict): OAI harvest parameters, endpoint values mixed with overrides
+
+		Returns:
+			(tuple): previous harvest Job and datestamp to harvest from, or (None, None) for full harvest
+		'''
+
+		if not self.oai_endpoint.incremental or self.full_harvest:
+			return (None, None)
+
+		# previous harvest, as recorded on OAI endpoint when harvest finished
+		previous_job = self.oai_endpoint.last_harvest_job
+		if previous_job is None or previous_job.deleted or previous_job.record_group_id != self.record_group.id:
+			return (None, None)
+
+		# previous harvest must have same harvest parameters
+		if previous_job.job_details:
+			previous_oai_params = json.loads(previous_job.job_details).get('oai_params')
+		else:
+			previous_oai_params = None
+		if previous_oai_params != oai_params:
+			return (None, None)
+
+		return (previous_job, self.oai_endpoint.last_harvest_datestamp)
+
+
 	def get_job_errors(self):
 
 		'''
@@ -3357,18 +4336,17 @@ class HarvestStaticXMLJob(HarvestJob):
 
 		Accepts three scenarios:
 			- zip / tar file with discrete files, one record per file
-			- aggregate XML file, containing multiple records
-			- location of directory on disk, with files pre-arranged to match structure above
-
-		########################################################################################################
-		QUESTION: Should this be in Spark?  What if 500k, 1m records provided here?
-		Job will not start until this is finished...
-		########################################################################################################
+			- aggregate XML file, containing multiple records, streamed to shards of JSON lines
+			- location of directory on disk, with files pre-arranged to match structure above, or shards of
+			JSON lines as written by StaticXMLSplitter
 		'''
 
 		# payload dictionary handle
 		p = self.payload_dict
 
+		# default to one record per file
+		p['payload_format'] = 'files'
+
 		# handle uploads
 		if p['type'] == 'upload':
 			logger.debug('static harvest, processing upload type')
@@ -3388,6 +4366,10 @@ class HarvestStaticXMLJob(HarvestJob):
 		if p['type'] == 'location':
 			logger.debug('static harvest, processing location type')
 
+			# if directory contains JSON lines shards, as written by StaticXMLSplitter, read as such
+			if len([ f for f in os.listdir(p['payload_dir']) if f.endswith('.jsonl') ]) > 0:
+				p['payload_format'] = 'jsonl'
+
 
 	def _handle_archive_upload(self, p, fpath):
 
@@ -3445,7 +4427,7 @@ class HarvestStaticXMLJob(HarvestJob):
 
 		'''
 		Handle uploads of XML files with group of discrete records.
-		Using xpath_document_root query from user, parse records and write to discrete files on disk,
+		Using xpath_document_root query from user, stream records to shards of JSON lines on disk,
 		then delete the aggregate file.
 
 		Args:
@@ -3457,28 +4439,9 @@ class HarvestStaticXMLJob(HarvestJob):
 
 		logger.debug('handling aggregate XML file')
 
-		# parse file
-		tree = etree.parse(fpath)
-
-		# get xml root 
-		xml_root = tree.getroot()
-
-		# programattically extract namespaces
-		nsmap = {}
-		for ns in xml_root.xpath('//namespace::*'):
-			if ns[0]:
-				nsmap[ns[0]] = ns[1]
-
-		# get list of documents as elements
-		doc_search = xml_root.xpath(p['xpath_document_root'], namespaces=nsmap)
-
-		# if docs founds, loop through and write to disk as discrete XML files
-		if len(doc_search) > 0:
-			for doc_ele in doc_search:
-				record_string = etree.tostring(doc_ele)
-				filename = hashlib.md5(record_string).hexdigest()
-				with open(os.path.join(p['payload_dir'],'%s.xml' % filename), 'w') as f:
-					f.write(record_string.decode('utf-8'))
+		# stream records from file to shards of JSON lines
+		StaticXMLSplitter(p['xpath_document_root'], p['payload_dir']).split(fpath)
+		p['payload_format'] = 'jsonl'
 
 		# after parsing file, set xpath_document_root --> '/*'
 		p['xpath_document_root'] = '/*'
@@ -3502,10 +4465,11 @@ class HarvestStaticXMLJob(HarvestJob):
 
 		# prepare job code
 		job_code = {
-			'code':'from jobs import HarvestStaticXMLSpark\nHarvestStaticXMLSpark.spark_function(spark, static_type="%(static_type)s", static_payload="%(static_payload)s", xpath_document_root="%(xpath_document_root)s", xpath_record_id="%(xpath_record_id)s", job_id="%(job_id)s", index_mapper="%(index_mapper)s", validation_scenarios="%(validation_scenarios)s")' % 
+			'code':'from jobs import HarvestStaticXMLSpark\nHarvestStaticXMLSpark.spark_function(spark, static_type="%(static_type)s", static_payload="%(static_payload)s", payload_format="%(payload_format)s", xpath_document_root="%(xpath_document_root)s", xpath_record_id="%(xpath_record_id)s", job_id="%(job_id)s", index_mapper="%(index_mapper)s", validation_scenarios="%(validation_scenarios)s")' % 
 			{
 				'static_type':self.payload_dict['type'],
 				'static_payload':self.payload_dict['payload_dir'],
+				'payload_format':self.payload_dict['payload_format'],
 				'xpath_document_root':self.payload_dict['xpath_document_root'],
 				'xpath_record_id':self.payload_dict['xpath_record_id'],
 				'job_id':self.job.id,
@@ -3635,20 +4599,34 @@ class TransformJob(CombineJob):
 
 		# prepare job code
 		job_code = {
-			'code':'from jobs import TransformSpark\nTransformSpark.spark_function(spark, transformation_id="%(transformation_id)s", input_job_id="%(input_job_id)s", job_id="%(job_id)s", index_mapper="%(index_mapper)s", validation_scenarios="%(validation_scenarios)s")' % 
-			{
-				'transformation_id':self.transformation.id,				
-				'input_job_id':self.input_job.id,
-				'job_id':self.job.id,
-				'index_mapper':self.index_mapper,
-				'validation_scenarios':str([ int(vs_id) for vs_id in self.validation_scenarios ])
-			}
+			'code':'from jobs import TransformSpark\nTransformSpark.spark_function(spark, transformation_id="%(transformation_id)s", input_job_id="%(input_job_id)s", job_id="%(job_id)s", index_mapper="%(index_mapper)s", validation_scenarios="%(validation_scenarios)s")' % self.get_spark_kwargs()
 		}
 
 		# submit job
 		self.submit_job_to_livy(job_code, self.job.job_output)
 
 
+	def get_spark_kwargs(self):
+
+		'''
+		Return args for core.spark.jobs.TransformSpark
+
+		Args:
+			None
+
+		Returns:
+			(dict)
+		'''
+
+		return {
+			'transformation_id':self.transformation.id,
+			'input_job_id':self.input_job.id,
+			'job_id':self.job.id,
+			'index_mapper':self.index_mapper,
+			'validation_scenarios':str([ int(vs_id) for vs_id in self.validation_scenarios ])
+		}
+
+
 	def get_job_errors(self):
 
 		'''
@@ -3883,17 +4861,31 @@ class PublishJob(CombineJob):
 
 		# prepare job code
 		job_code = {
-			'code':'from jobs import PublishSpark\nPublishSpark.spark_function(spark, input_job_id="%(input_job_id)s", job_id="%(job_id)s")' % 
-			{
-				'input_job_id':self.input_job.id,
-				'job_id':self.job.id
-			}
+			'code':'from jobs import PublishSpark\nPublishSpark.spark_function(spark, input_job_id="%(input_job_id)s", job_id="%(job_id)s")' % self.get_spark_kwargs()
 		}
 
 		# submit job
 		self.submit_job_to_livy(job_code, self.job.job_output)
 
 
+	def get_spark_kwargs(self):
+
+		'''
+		Return args for core.spark.jobs.PublishSpark
+
+		Args:
+			None
+
+		Returns:
+			(dict)
+		'''
+
+		return {
+			'input_job_id':self.input_job.id,
+			'job_id':self.job.id
+		}
+
+
 	def get_job_errors(self):
 
 		'''
@@ -3904,6 +4896,163 @@ class PublishJob(CombineJob):
 
 
 
+class PipelineJob(CombineJob):
+
+	'''
+	Run an ordered chain of stages, e.g. HarvestOAIJob -> TransformJob(s) -> PublishJob, as a single Livy statement,
+	passing records from stage to stage as DataFrames cached in Spark, instead of each stage saving records for the
+	next to read back.
+
+	Each stage is a Job of its own type, with the previous stage as input job, and its own record count.  Saving
+	records of a stage to the record store, and indexing them to ES, is optional per stage, though Publish stages are
+	always saved, and validation scenarios require a stage to be saved.
+
+	Note: PipelineJob is not a Job type, stages are loaded as their own Job types
+	'''
+
+	def __init__(self,
+		user=None,
+		record_group=None,
+		stages=None,
+		index_mapper=None):
+
+		'''
+		Args:
+			user (auth.models.User): user that will issue job
+			record_group (core.models.RecordGroup): record group instance stages belong to
+			stages (list): ordered list of dictionaries, one per stage, with:
+				job_type (str)['HarvestOAIJob','TransformJob','PublishJob']: Job type of stage
+				persist (bool): save records of stage to record store, defaults to True
+				index (bool): index records of stage to ES, if saved, defaults to True
+				other args of Job type, e.g. job_name, oai_endpoint, transformation, validation_scenarios, or
+				input_job for a first stage that is not a harvest
+			index_mapper (str): String of index mapper clsas from core.spark.es
+
+		Returns:
+			None
+				- creates Job of each stage
+		'''
+
+		# perform CombineJob initialization
+		super().__init__(user=user)
+
+		self.record_group = record_group
+		self.index_mapper = index_mapper
+		self.validate_stages(stages)
+
+		# create Job of each stage, with previous stage as input job
+		self.stages = []
+		input_job = None
+		for stage in stages:
+
+			stage_args = stage.copy()
+			job_type = stage_args.pop('job_type')
+			persist = stage_args.pop('persist', True) or job_type == 'PublishJob'
+			index = stage_args.pop('index', True) and persist
+			stage_args.update({'user':user, 'record_group':record_group})
+			if job_type != 'PublishJob':
+				stage_args['index_mapper'] = index_mapper
+			if input_job is not None:
+				stage_args['input_job'] = input_job
+
+			combine_job = globals()[job_type](**stage_args)
+			self.stages.append({
+				'job_type':job_type,
+				'combine_job':combine_job,
+				'persist':persist,
+				'index':index
+			})
+			input_job = combine_job.job
+
+		# Job of first stage is submitted to Livy, for all stages
+		self.job = self.stages[0]['combine_job'].job
+
+		# save pipeline to job_details of stages
+		stage_job_ids = [ stage['combine_job'].job.id for stage in self.stages ]
+		for i, stage in enumerate(self.stages):
+			stage['combine_job'].job.update_job_details({'pipeline':{
+				'stage':i,
+				'stage_job_ids':stage_job_ids,
+				'persist':stage['persist'],
+				'index':stage['index']
+			}})
+
+
+	@staticmethod
+	def validate_stages(stages):
+
+		'''
+		Raise exception if stages are not a supported chain: an optional HarvestOAIJob first, TransformJobs, and an
+		optional PublishJob last
+
+		Args:
+			stages (list): stage dictionaries, see PipelineJob.__init__
+
+		Returns:
+			None
+		'''
+
+		if not stages:
+			raise Exception('pipeline requires at least one stage')
+
+		for i, stage in enumerate(stages):
+
+			if stage['job_type'] not in ['HarvestOAIJob','TransformJob','PublishJob']:
+				raise Exception('job type not supported as pipeline stage: %s' % stage['job_type'])
+			if stage['job_type'] == 'HarvestOAIJob' and i != 0:
+				raise Exception('HarvestOAIJob must be first stage of pipeline')
+			if stage['job_type'] == 'PublishJob' and i != len(stages) - 1:
+				raise Exception('PublishJob must be last stage of pipeline')
+			if i == 0 and stage['job_type'] != 'HarvestOAIJob' and stage.get('input_job') is None:
+				raise Exception('first stage of pipeline requires input_job, if not a harvest')
+			if not stage.get('persist', True) and len(stage.get('validation_scenarios', [])) > 0:
+				raise Exception('validation scenarios require records of stage be saved, set persist')
+
+
+	def prepare_job(self):
+
+		'''
+		Prepare limited python code that is serialized and sent to Livy, triggering spark jobs from core.spark.jobs
+
+		Args:
+			None
+
+		Returns:
+			None
+				- submits job to Livy
+		'''
+
+		# args of each stage, as passed to their Spark jobs
+		stages = []
+		for stage in self.stages:
+
+			spark_kwargs = { k:str(v) for k,v in stage['combine_job'].get_spark_kwargs().items() }
+			spark_kwargs['index_mapper'] = str(self.index_mapper)
+
+			# harvest not saved is not a starting point for next incremental harvest
+			if not stage['persist'] and 'oai_endpoint_id' in spark_kwargs:
+				spark_kwargs['oai_endpoint_id'] = ''
+
+			stages.append({
+				'job_type':stage['job_type'],
+				'persist':stage['persist'],
+				'index':stage['index'],
+				'kwargs':spark_kwargs
+			})
+
+		# prepare job code
+		job_code = {
+			'code':'from jobs import PipelineSpark\nPipelineSpark.spark_function(spark, stages=%(stages)r)' %
+			{
+				'stages':json.dumps(stages)
+			}
+		}
+
+		# submit job
+		self.submit_job_to_livy(job_code, self.job.job_output)
+
+
+
 class AnalysisJob(CombineJob):
 	
 	'''
@@ -4092,6 +5241,159 @@ class AnalysisJob(CombineJob):
 
 
 
+####################################################################
+# Static XML splitting 											   #
+####################################################################
+
+class StaticXMLSplitter(object):
+
+	'''
+	Streaming splitter of aggregate XML files into shards of JSON lines, one record document per line,
+	for splittable reading by HarvestStaticXMLSpark with payload_format 'jsonl'.
+
+	Records are selected with etree.iterparse, matching the last step of xpath_document_root, and each element
+	is cleared as soon as it is written, such that memory use does not grow with the size of the file.  Streaming
+	is supported for xpaths of simple steps, e.g. '//mods:mods' or '/collection/record', where records are matched
+	by tag at any depth, outermost first.  Other xpaths, e.g. with predicates, fall back to parsing the whole file.
+
+	Args:
+		xpath_document_root (str): xpath for records within aggregate file
+		output_dir (str): directory to write shards
+		records_per_shard (int): records written per shard, defaults to settings.STATIC_HARVEST_RECORDS_PER_SHARD
+	'''
+
+	# simple xpath steps, optional prefix, no wildcards or predicates
+	simple_xpath = re.compile(r'^(//?[\w.-]+(:[\w.-]+)?)+$')
+
+	def __init__(self, xpath_document_root, output_dir, records_per_shard=None):
+
+		self.xpath_document_root = xpath_document_root
+		self.output_dir = output_dir
+		if records_per_shard is None:
+			records_per_shard = settings.STATIC_HARVEST_RECORDS_PER_SHARD
+		self.records_per_shard = records_per_shard
+
+		# shard handles
+		self.shard_handle = None
+		self.shard_count = 0
+		self.shard_records = 0
+		self.record_count = 0
+
+
+	def split(self, fpath):
+
+		'''
+		Split aggregate XML file into shards
+
+		Args:
+			fpath (str): location of aggregate XML file
+
+		Returns:
+			(int): count of records written
+		'''
+
+		try:
+			if self.simple_xpath.match(self.xpath_document_root):
+				self._split_streaming(fpath)
+			else:
+				logger.debug('xpath %s not supported for streaming, parsing whole file' % self.xpath_document_root)
+				self._split_parsed(fpath)
+		finally:
+			self._close_shard()
+
+		logger.debug('wrote %s records to %s shards' % (self.record_count, self.shard_count))
+		return self.record_count
+
+
+	def _split_streaming(self, fpath):
+
+		'''
+		Split with etree.iterparse, clearing elements as they are completed
+		'''
+
+		# target tag from last step of xpath, namespace resolved from prefix as declared in file
+		target_step = self.xpath_document_root.split('/')[-1]
+		if ':' in target_step:
+			target_prefix, target_name = target_step.split(':')
+		else:
+			target_prefix, target_name = None, target_step
+		target_tag = None if target_prefix else target_name
+
+		open_targets = 0
+		for event, elem in etree.iterparse(fpath, events=('start-ns', 'start', 'end'), huge_tree=True):
+
+			# resolve target namespace from first declaration of prefix
+			if event == 'start-ns':
+				prefix, uri = elem
+				if target_tag is None and prefix == target_prefix:
+					target_tag = '{%s}%s' % (uri, target_name)
+				continue
+
+			if event == 'start':
+				if elem.tag == target_tag:
+					open_targets += 1
+				continue
+
+			# end of element
+			if elem.tag == target_tag:
+				open_targets -= 1
+
+				# write outermost target elements only
+				if open_targets == 0:
+					self._write_record(etree.tostring(elem))
+
+			# clear completed elements outside of target elements, with previous siblings
+			if open_targets == 0:
+				elem.clear()
+				while elem.getprevious() is not None:
+					del elem.getparent()[0]
+
+
+	def _split_parsed(self, fpath):
+
+		'''
+		Split by parsing whole file, for xpaths not supported for streaming
+		'''
+
+		# parse file
+		xml_root = etree.parse(fpath).getroot()
+
+		# programattically extract namespaces
+		nsmap = {}
+		for ns in xml_root.xpath('//namespace::*'):
+			if ns[0]:
+				nsmap[ns[0]] = ns[1]
+
+		for doc_ele in xml_root.xpath(self.xpath_document_root, namespaces=nsmap):
+			self._write_record(etree.tostring(doc_ele))
+
+
+	def _write_record(self, record_bytes):
+
+		'''
+		Write record to current shard as JSON line, rolling to new shard when full
+		'''
+
+		if self.shard_handle is None or self.shard_records >= self.records_per_shard:
+			self._close_shard()
+			self.shard_handle = open(os.path.join(self.output_dir, 'records_%05d.jsonl' % self.shard_count), 'w')
+			self.shard_count += 1
+			self.shard_records = 0
+
+		self.shard_handle.write(json.dumps(record_bytes.decode('utf-8')))
+		self.shard_handle.write('\n')
+		self.shard_records += 1
+		self.record_count += 1
+
+
+	def _close_shard(self):
+
+		if self.shard_handle is not None:
+			self.shard_handle.close()
+			self.shard_handle = None
+
+
+
 ####################################################################
 # ElasticSearch DataTables connector 							   #
 ####################################################################
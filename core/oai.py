@@ -5,11 +5,14 @@ import hashlib
 import json
 import logging
 from lxml import etree
+import re
 import time
 import uuid
+from xml.sax.saxutils import escape
 
 # django settings
 from django.conf import settings
+from django.core import signing
 from django.urls import reverse
 
 # import models
@@ -48,6 +51,9 @@ class OAIProvider(object):
 	easier to keep the HTTP request args to work with as a dictionary, and maintain the original OAI-PMH vocab.
 	'''
 
+	# salt of signed resumption tokens
+	token_salt = 'core.oai.resumptionToken'
+
 	def __init__(self, args):
 
 		# read args, route verb to verb handler
@@ -60,17 +66,27 @@ class OAIProvider(object):
 			'ListSets':self._ListSets
 		}
 
+		# verbs with records streamed by generate_response_stream(), and if records include metadata
+		self.stream_verbs = {
+			'ListIdentifiers':False,
+			'ListRecords':True
+		}
+
 		# debug
 		logger.debug(args)
 
 		self.args = args.copy()
 		self.request_timestamp = datetime.datetime.now()
 		self.request_timestamp_string = self.request_timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')
-		self.record_nodes = []
+		self.record_fragments = []
 
-		# published dataframe slice parameters
+		# published records page parameters: cursor, page size, id of last record of previous page, and list size
 		self.start = 0
 		self.chunk_size = settings.OAI_RESPONSE_SIZE
+		self.last_id = None
+		self.complete_list_size = None
+		self.has_more = False
+		self.set_index = None
 		self.publish_set_id = None
 		if 'set' in self.args.keys():
 			self.publish_set_id = self.args['set']
@@ -149,48 +165,215 @@ class OAIProvider(object):
 
 		Returns:
 			None
-				- adds record(s) to self.record_nodes
+				- adds record(s) to self.record_fragments
 		'''
 
 		stime = time.time()
 		logger.debug("retrieving records for verb %s" % (self.args['verb']))
 
-		# get records
-		records = self.published.records
+		# read page of records
+		records = self.get_records(include_metadata=include_metadata)
+		page_records = self.read_records(records, self.chunk_size)
+		self.count_records(records)
 
-		# if set present, filter by this set
-		if self.publish_set_id:
-			logger.debug('applying publish_set_id filter')
-			records = records.filter(job__record_group__publish_set_id = self.publish_set_id)
+		# render records
+		self.record_fragments.extend(self.render_records(page_records, include_metadata=include_metadata))
+
+		# finally, set resumption token
+		self.set_resumption_token()
+
+		# report
+		etime = time.time()
+		logger.debug("%s record(s) returned in %sms" % (len(self.record_fragments), (float(etime) - float(stime)) * 1000))
 
-		# loop through rows, limited by current OAI transaction start / chunk
-		for record in records[self.start:(self.start+self.chunk_size)]:
 
-			record = OAIRecord(args=self.args, record_id=record.record_id, document=record.document, timestamp=self.request_timestamp_string)
+	def stream_records(self, include_metadata=False):
 
-			# include full metadata in record
-			if include_metadata:
-				 record.include_metadata()
+		'''
+		Generate page of record(s) for response, reading and rendering records in batches of OAI_STREAM_BATCH_SIZE,
+		such that memory does not grow with OAI_RESPONSE_SIZE
 
-			# append to record_nodes
-			self.record_nodes.append(record.oai_record_node)
+		Args:
+			include_metadata (bool): If False, return only identifiers, if True, include record document as well
 
-		# add to verb node
-		for oai_record_node in self.record_nodes:
-			self.verb_node.append(oai_record_node)
+		Returns:
+			(generator): record fragments of each batch, as bytes
+				- sets resumption token once page is read
+		'''
+
+		stime = time.time()
+		logger.debug("streaming records for verb %s" % (self.args['verb']))
+
+		# read page of records in batches
+		records = self.get_records(include_metadata=include_metadata)
+		record_count = 0
+		while record_count < self.chunk_size:
+			batch_records = self.read_records(records, min(settings.OAI_STREAM_BATCH_SIZE, self.chunk_size - record_count))
+			record_count += len(batch_records)
+			yield b''.join(self.render_records(batch_records, include_metadata=include_metadata))
+			if not self.has_more:
+				break
+		self.count_records(records)
 
 		# finally, set resumption token
 		self.set_resumption_token()
 
 		# report
 		etime = time.time()
-		logger.debug("%s record(s) returned in %sms" % (len(self.record_nodes), (float(etime) - float(stime)) * 1000))
+		logger.debug("%s record(s) streamed in %sms" % (record_count, (float(etime) - float(stime)) * 1000))
+
+
+	def get_records(self, include_metadata=False):
+
+		'''
+		Return QuerySet of published records for request, ordered by id for paging
+
+		Args:
+			include_metadata (bool): If False, defer documents
+
+		Returns:
+			(django.db.models.query.QuerySet)
+				- sets self.set_index, published record set index of set, if set requested
+		'''
+
+		# get records, deferring documents not needed or loaded only if not cached
+		records = self.published.records.order_by('id')
+		if not include_metadata or settings.OAI_RECORD_FRAGMENT_CACHE:
+			records = records.defer('document','error')
+
+		# if set present, page over published record set index of set, instead of joining records to record groups
+		if self.publish_set_id:
+			logger.debug('applying publish_set_id filter')
+			self.set_index = self.published.get_set_index(self.publish_set_id)
+
+		return records
+
+
+	def read_records(self, records, count):
+
+		'''
+		Read next records, after id of last record read, such that pages do not scan preceding records, or by
+		offset for resumption tokens issued without id.  For set, ids are read from published record set index,
+		then records by id.
+
+		Args:
+			records (django.db.models.query.QuerySet): records, from get_records()
+			count (int): count of records to read
+
+		Returns:
+			(list): Record instances
+				- sets self.last_id, and self.has_more if records continue
+		'''
+
+		# page over published record set index for set, else over records
+		page = records if self.set_index is None else self.set_index
+		if self.last_id is not None:
+			page = page.filter(id__gt = self.last_id)
+		elif self.start > 0:
+			page = page[self.start:]
+
+		# read one record past count, to determine if list continues
+		page = list(page[:(count + 1)])
+		self.has_more = len(page) > count
+		page = page[:count]
+		if len(page) > 0:
+			self.last_id = page[-1].id
+
+		# for set, read records of page by id
+		if self.set_index is not None:
+			page = list(records.filter(id__in = [ i.id for i in page ]))
+
+		return page
+
+
+	def count_records(self, records):
+
+		'''
+		Count complete list once, for first page that continues, carried by resumption token thereafter
+
+		Args:
+			records (django.db.models.query.QuerySet): records, from get_records()
+
+		Returns:
+			None
+				- sets self.complete_list_size
+		'''
+
+		if self.has_more and self.complete_list_size is None:
+			self.complete_list_size = (records if self.set_index is None else self.set_index).count()
+
+
+	def render_records(self, records, include_metadata=False):
+
+		'''
+		Render records as XML fragments, with header fragment prebuilt for request
+
+		Args:
+			records (list): Record instances
+			include_metadata (bool): If False, return only identifiers, if True, include record document as well
+
+		Returns:
+			(list): record fragments, as bytes
+		'''
+
+		# get rendered metadata of records
+		if include_metadata:
+			metadata_fragments = self.get_metadata_fragments(records)
+
+		header_tail = OAIRecord.render_header_tail(self.args, self.request_timestamp_string)
+		return [
+			OAIRecord(
+				args=self.args,
+				record_id=record.record_id,
+				timestamp=self.request_timestamp_string,
+				header_tail=header_tail,
+				metadata_fragment=metadata_fragments[record.id] if include_metadata else None
+			).oai_record_fragment
+			for record in records
+		]
+
+
+	def get_metadata_fragments(self, records):
+
+		'''
+		Return rendered <metadata> fragments of records, from OAI record fragment cache if enabled, loading documents
+		only of records not cached
+
+		Args:
+			records (list): Record instances
+
+		Returns:
+			(dict): fragments as bytes, keyed by Record id
+		'''
+
+		fragments = {}
+
+		# get cached fragments
+		if settings.OAI_RECORD_FRAGMENT_CACHE:
+			for record in records:
+				fragment = models.OAIRecordFragmentCache.get(record)
+				if fragment is not None:
+					fragments[record.id] = fragment
+
+		# load documents of records not cached in bulk, where deferred
+		uncached = [ record for record in records if record.id not in fragments ]
+		if len(uncached) > 0 and (settings.OAI_RECORD_FRAGMENT_CACHE or settings.RECORD_STORAGE_BACKEND == 'parquet'):
+			models.Record.load_documents(uncached)
+
+		# render, and cache
+		for record in uncached:
+			fragments[record.id] = OAIRecord.render_metadata(record.document)
+			if settings.OAI_RECORD_FRAGMENT_CACHE:
+				models.OAIRecordFragmentCache.set(record, fragments[record.id])
+
+		return fragments
 
 
 	def set_resumption_token(self):
 
 		'''
-		Set resumption tokens in DB under OAITransaction model
+		Set resumption token, carrying request args and page parameters of next page, and expiring after
+		OAI_RESUMPTION_TOKEN_TTL seconds
 
 		Args:
 			None
@@ -201,31 +384,94 @@ class OAIProvider(object):
 		'''
 
 		# set resumption token
-		if self.start + self.chunk_size < self.published.records.count():
-
-			# set token and slice parameters to DB
-			token = str(uuid.uuid4())
+		if self.has_more:
+
+			# page parameters of next page
+			expires = int(time.time()) + settings.OAI_RESUMPTION_TOKEN_TTL
+			token = self.encode_resumption_token({
+				'args':self.args,
+				'start':self.start + self.chunk_size,
+				'chunk_size':self.chunk_size,
+				'last_id':self.last_id,
+				'complete_list_size':self.complete_list_size,
+				'expires':expires
+			})
 			logger.debug('setting resumption token: %s' % token)
-			oai_trans = models.OAITransaction(
-				verb = self.args['verb'],
-				start = self.start + self.chunk_size,
-				chunk_size = self.chunk_size,
-				publish_set_id = self.publish_set_id,
-				token = token,
-				args = json.dumps(self.args)
-			)
-			oai_trans.save()
 
 			# set resumption token node and attributes
 			self.resumptionToken_node = etree.Element('resumptionToken')
-			self.resumptionToken_node.attrib['expirationDate'] = (self.request_timestamp + datetime.timedelta(0,3600))\
+			self.resumptionToken_node.attrib['expirationDate'] = datetime.datetime.utcfromtimestamp(expires)\
 			.strftime('%Y-%m-%dT%H:%M:%SZ')
-			self.resumptionToken_node.attrib['completeListSize'] = str(self.published.records.count())
+			self.resumptionToken_node.attrib['completeListSize'] = str(self.complete_list_size)
 			self.resumptionToken_node.attrib['cursor'] = str(self.start)
 			self.resumptionToken_node.text = token
 			self.verb_node.append(self.resumptionToken_node)
 
 
+	def encode_resumption_token(self, params):
+
+		'''
+		Encode page parameters as resumption token, per OAI_RESUMPTION_TOKENS:
+			- 'signed': parameters signed with SECRET_KEY, compressed into the token itself, such that no DB write
+			happens per page
+			- 'db': random token, with parameters saved to OAITransaction as audit trail, purging expired rows
+
+		Args:
+			params (dict): request args and page parameters, with expiry as epoch seconds
+
+		Returns:
+			(str): resumption token
+		'''
+
+		# signed, stateless token
+		if settings.OAI_RESUMPTION_TOKENS == 'signed':
+			return signing.dumps(params, salt=self.token_salt, compress=True)
+
+		# token saved to DB
+		token = uuid.uuid4().hex
+		models.OAITransaction(
+			verb = self.args['verb'],
+			publish_set_id = self.publish_set_id,
+			token = token,
+			params = json.dumps(params, separators=(',',':')),
+			expires = datetime.datetime.fromtimestamp(params['expires'], tz=datetime.timezone.utc)
+		).save()
+		models.OAITransaction.purge_expired()
+		return token
+
+
+	def decode_resumption_token(self, token):
+
+		'''
+		Decode page parameters from resumption token, if token is valid and not expired
+
+		Args:
+			token (str): resumption token
+
+		Returns:
+			(dict): request args and page parameters, or None if token is invalid or expired
+		'''
+
+		# signed, stateless token
+		if settings.OAI_RESUMPTION_TOKENS == 'signed':
+			try:
+				params = signing.loads(token, salt=self.token_salt)
+			except signing.BadSignature:
+				return None
+
+		# token saved to DB, looked up by unique token
+		else:
+			ot = models.OAITransaction.objects.filter(token=token).first()
+			if ot is None:
+				return None
+			params = json.loads(ot.params)
+
+		# check expiry
+		if params['expires'] < time.time():
+			return None
+		return params
+
+
 	# convenience function to run all internal methods
 	def generate_response(self):
 
@@ -239,6 +485,61 @@ class OAIProvider(object):
 			(str): XML response
 		'''
 
+		# check verb and resumption token
+		error_response = self.prepare_request()
+		if error_response is not None:
+			return error_response
+
+		# fire verb reponse building
+		self.verb_routes[self.args['verb']]()
+		return self.serialize()
+
+
+	def generate_response_stream(self):
+
+		'''
+		Generate OAI response as XML in parts, for StreamingHttpResponse.  For ListRecords and ListIdentifiers, the
+		envelope, each batch of records, and the resumption token are written as they are ready, other verbs are
+		written whole.
+
+		Args:
+			None
+
+		Returns:
+			(generator): XML response, as bytes
+		'''
+
+		# check verb and resumption token
+		error_response = self.prepare_request()
+		if error_response is not None:
+			yield error_response
+			return
+
+		# list verbs, stream records
+		if self.args['verb'] in self.stream_verbs.keys():
+			yield self.serialize_envelope()[0]
+			for records_fragment in self.stream_records(include_metadata=self.stream_verbs[self.args['verb']]):
+				yield records_fragment
+			yield self.serialize_envelope()[1]
+
+		# else, fire verb reponse building
+		else:
+			self.verb_routes[self.args['verb']]()
+			yield self.serialize()
+
+
+	def prepare_request(self):
+
+		'''
+		Check verb, and follow resumption token if present
+
+		Args:
+			None
+
+		Returns:
+			(str): XML error response, or None if request is valid
+		'''
+
 		# check verb
 		if self.args['verb'] not in self.verb_routes.keys():
 			return self.raise_error(
@@ -250,26 +551,25 @@ class OAIProvider(object):
 		if 'resumptionToken' in self.args.keys():
 
 			# retrieve token params and alter args and search_params
-			ot_query = models.OAITransaction.objects.filter(token=self.args['resumptionToken'])
-			if ot_query.count() == 1:				 
-				ot = ot_query.first()
+			params = self.decode_resumption_token(self.args['resumptionToken'])
+			if params is not None and params['args']['verb'] == self.args['verb']:
 
-				# set args and start and chunk_size
-				self.args = json.loads(ot.args)
-				self.start = ot.start
-				self.chunk_size = ot.chunk_size
-				self.publish_set_id = ot.publish_set_id
+				# set args and page parameters
+				self.args = params['args']
+				self.start = params['start']
+				self.chunk_size = params['chunk_size']
+				self.publish_set_id = self.args.get('set')
+				self.last_id = params['last_id']
+				self.complete_list_size = params['complete_list_size']
 
-				logger.debug('following resumption token, altering dataframe slice params:')
-				logger.debug([self.start, self.chunk_size, self.publish_set_id])
+				logger.debug('following resumption token, altering page params:')
+				logger.debug([self.start, self.chunk_size, self.publish_set_id, self.last_id])
 
 			# raise error
 			else:
-				return self.raise_error('badResumptionToken', 'The resumptionToken %s is not found' % self.args['resumptionToken'])
+				return self.raise_error('badResumptionToken', 'The resumptionToken %s is invalid or expired' % self.args['resumptionToken'])
 
-		# fire verb reponse building
-		self.verb_routes[self.args['verb']]()
-		return self.serialize()
+		return None
 
 
 	def raise_error(self, error_code, error_msg):
@@ -285,11 +585,12 @@ class OAIProvider(object):
 			(str): XML response
 		'''
 
-		# remove verb node
+		# remove verb node, and any records
 		try:
 			self.root_node.remove(self.verb_node)
 		except:
 			logger.debug('verb_node not found')
+		self.record_fragments = []
 
 		# create error node and append
 		error_node = etree.SubElement(self.root_node, 'error')
@@ -304,7 +605,8 @@ class OAIProvider(object):
 	def serialize(self):
 
 		'''
-		Serialize all nodes as XML for returning
+		Serialize all nodes as XML for returning, with record fragments spliced in as first children of verb node,
+		such that record documents are not parsed and serialized again
 
 		Args:
 			None
@@ -313,7 +615,32 @@ class OAIProvider(object):
 			(str): XML response
 		'''
 
-		return etree.tostring(self.root_node)
+		if len(self.record_fragments) == 0:
+			return etree.tostring(self.root_node)
+
+		envelope_head, envelope_tail = self.serialize_envelope()
+		return envelope_head + b''.join(self.record_fragments) + envelope_tail
+
+
+	def serialize_envelope(self):
+
+		'''
+		Serialize all nodes as XML, split where records are written as first children of verb node
+
+		Args:
+			None
+
+		Returns:
+			(tuple): XML before and after records, as bytes
+		'''
+
+		# serialize with placeholder for records
+		placeholder = uuid.uuid4().hex
+		self.verb_node.insert(0, etree.Comment(placeholder))
+		envelope_head, envelope_tail = etree.tostring(self.root_node).split(('<!--%s-->' % placeholder).encode('utf-8'), 1)
+		del self.verb_node[0]
+
+		return (envelope_head, envelope_tail)
 
 
 	# GetRecord
@@ -340,30 +667,23 @@ class OAIProvider(object):
 		# if single record found
 		if single_record:
 
-			# open as OAIRecord 
+			# open as OAIRecord, with metadata
 			record = OAIRecord(
 					args=self.args,
 					record_id=single_record.record_id,
-					document=single_record.document,
-					timestamp=self.request_timestamp_string
+					timestamp=self.request_timestamp_string,
+					metadata_fragment=self.get_metadata_fragments([single_record])[single_record.id]
 				)
 
-			# include metadata
-			record.include_metadata()
-
-			# append to record_nodes
-			self.record_nodes.append(record.oai_record_node)
-
-			# add to verb node
-			for oai_record_node in self.record_nodes:
-				self.verb_node.append(oai_record_node)
+			# append to record_fragments
+			self.record_fragments.append(record.oai_record_fragment)
 
 		else:
 			logger.debug('record not found for id: %s, not appending node' % self.args['identifier'])
 
 		# report
 		etime = time.time()
-		logger.debug("%s record(s) returned in %sms" % (len(self.record_nodes), (float(etime) - float(stime)) * 1000))
+		logger.debug("%s record(s) returned in %sms" % (len(self.record_fragments), (float(etime) - float(stime)) * 1000))
 
 
 	# Identify
@@ -452,7 +772,7 @@ class OAIProvider(object):
 
 		'''
 		OAI-PMH verb: ListSets
-		Lists available sets.  Sets are derived from the associated Record Groups of all Publish jobs.
+		Lists available sets.  Sets are read from published record set index, of published records of all Publish jobs.
 
 		Args:
 			None
@@ -463,7 +783,7 @@ class OAIProvider(object):
 		'''
 		
 		# generate response
-		for publish_set_id in self.published.sets:
+		for publish_set_id in self.published.set_ids:
 			set_node = etree.Element('set')
 			setSpec = etree.SubElement(set_node,'setSpec')
 			setSpec.text = publish_set_id
@@ -476,77 +796,97 @@ class OAIProvider(object):
 class OAIRecord(object):
 
 	'''
-	Initialize OAIRecord with pid and args
+	Render OAI record as XML fragment, from header fragment prebuilt per request and document, without parsing
+	document.  Documents of published records are well formed, having been parsed by the jobs that wrote them.
 	'''
 
-	def __init__(self, args=None, record_id=None, document=None, timestamp=None):
+	# XML declaration, not allowed within response
+	xml_declaration_re = re.compile(r'^\s*<\?xml[^>]*\?>\s*')
+
+	def __init__(self, args=None, record_id=None, document=None, timestamp=None, header_tail=None, metadata_fragment=None):
 
 		self.args = args
 		self.record_id = record_id
 		self.document = document
 		self.timestamp = timestamp
-		self.oai_record_node = None
 
-		# build record node
-		self.init_record_node()
+		# header after identifier, same for all records of request
+		if header_tail is None:
+			header_tail = self.render_header_tail(self.args, self.timestamp)
+		self.header_tail = header_tail
+
+		# metadata, if included
+		self.metadata_fragment = metadata_fragment
 
 
-	def init_record_node(self):
+	@staticmethod
+	def render_header_tail(args, timestamp):
 
 		'''
-		Initialize and scaffold record node
+		Render header following identifier: datestamp, and setSpec if set requested
 
 		Args:
-			None
+			args (dict): OAI request args
+			timestamp (str): datestamp
 
 		Returns:
-			None
-				sets self.oai_record_node
+			(bytes)
 		'''
 
-		# init node
-		self.oai_record_node = etree.Element('record')
+		header_tail = '</identifier><datestamp>%s</datestamp>' % escape(timestamp)
+		if 'set' in args.keys():
+			header_tail += '<setSpec>%s</setSpec>' % escape(args['set'])
+		return ('%s</header>' % header_tail).encode('utf-8')
 
-		# header node
-		header_node = etree.Element('header')
-		
-		# identifier 
-		identifier_node = etree.Element('identifier')
-		identifier_node.text = self.record_id
-		header_node.append(identifier_node)
 
-		# datestamp
-		datestamp_node = etree.Element('datestamp')
-		datestamp_node.text = self.timestamp
-		header_node.append(datestamp_node)
+	@staticmethod
+	def render_metadata(document):
 
-		if 'set' in self.args.keys():
-			setSpec_node = etree.Element('setSpec')
-			setSpec_node.text = self.args['set']
-			header_node.append(setSpec_node)
+		'''
+		Render <metadata> fragment from document, less any XML declaration
 
-		self.oai_record_node.append(header_node)
+		Args:
+			document (str): record document
+
+		Returns:
+			(bytes)
+		'''
+
+		return b'<metadata>' + OAIRecord.xml_declaration_re.sub('', document, count=1).encode('utf-8') + b'</metadata>'
 
 
 	def include_metadata(self):
 
 		'''
-		Method to retrieve metadata from record.document, and include in XML response (for GetRecord and ListRecords)
+		Method to render metadata from record.document, and include in XML response (for GetRecord and ListRecords)
 
 		Args:
 			None
 
 		Returns:
 			None
-				sets self.oai_record_node
+				sets self.metadata_fragment
 		'''
 
-		# metadate node
-		metadata_node = etree.Element('metadata')
-		metadata_node.append(etree.fromstring(self.document.encode('utf-8')))
-		self.oai_record_node.append(metadata_node)
+		self.metadata_fragment = self.render_metadata(self.document)
 
 
+	@property
+	def oai_record_fragment(self):
+
+		'''
+		Record as XML fragment
+
+		Returns:
+			(bytes)
+		'''
 
+		return b''.join([
+			b'<record><header><identifier>',
+			escape(self.record_id).encode('utf-8'),
+			self.header_tail,
+			self.metadata_fragment or b'',
+			b'</record>'
+		])
 
 
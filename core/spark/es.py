@@ -1,12 +1,14 @@
 # imports
 import django
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
 import json
 from lxml import etree
 import os
 import re
 import requests
 import sys
+import time
 import xmltodict
 
 # pyjxslt
@@ -14,11 +16,12 @@ import pyjxslt
 
 # import Row from pyspark
 try:
+	from pyspark import AccumulatorParam
 	from pyspark.sql import Row
 	from pyspark.sql.types import StringType, IntegerType
 	from pyspark.sql.functions import udf
 except:
-	pass
+	AccumulatorParam = object
 
 # check for registered apps signifying readiness, if not, run django.setup() to run as standalone
 if not hasattr(django, 'apps'):
@@ -30,6 +33,23 @@ if not hasattr(django, 'apps'):
 from django.conf import settings
 
 
+class IndexCountAccumulatorParam(AccumulatorParam):
+
+	'''
+	Accumulator to sum documents indexed and failed, from Spark partitions
+	'''
+
+	def zero(self, value):
+		return {}
+
+
+	def addInPlace(self, counts_a, counts_b):
+		for k, count in counts_b.items():
+			counts_a[k] = counts_a.get(k, 0) + count
+		return counts_a
+
+
+
 class ESIndex(object):
 
 	'''
@@ -42,6 +62,11 @@ class ESIndex(object):
 		'''
 		Method to index records dataframe into ES
 
+		Records are mapped with one index mapper instance per partition, and loaded to ES with the engine
+		selected by settings.ES_INDEXING_MODE:
+			- 'bulk': each partition streams mapped documents to ES via the bulk API
+			- 'es-hadoop': mapped documents are written via elasticsearch-hadoop's EsOutputFormat
+
 		Args:
 			spark (pyspark.sql.session.SparkSession): spark instance from static job methods
 			job (core.models.Job): Job for records
@@ -53,16 +78,13 @@ class ESIndex(object):
 				- indexes records to ES
 		'''
 
-		# get index mapper
-		index_mapper_handle = globals()[index_mapper]
+		# get publish set id once, not per record on executors
+		publish_set_id = job.record_group.publish_set_id
 
-		# create rdd from index mapper
-		mapped_records_rdd = records_df.rdd.map(lambda row: index_mapper_handle().map_record(
-				row.id,
-				row.record_id,
-				row.document,
-				job.record_group.publish_set_id
-			))
+		# map records, one index mapper per partition, persisted as used for both failures and indexing
+		map_records_partition = ESIndex.map_records_partition # must pass static method not attached to self
+		mapped_records_rdd = records_df.rdd.mapPartitions(
+			lambda rows: map_records_partition(rows, index_mapper, publish_set_id)).persist()
 
 		# attempt to write index mapping failures to DB
 
@@ -71,22 +93,7 @@ class ESIndex(object):
 
 		# if failures, write
 		if not failures_rdd.isEmpty():
-
-			failures_df = failures_rdd.map(lambda row: Row(record_id=row[1]['record_id'], mapping_error=row[1]['mapping_error'])).toDF()
-
-			# add job_id as column
-			job_id = job.id
-			job_id_udf = udf(lambda id: job_id, IntegerType())
-			failures_df = failures_df.withColumn('job_id', job_id_udf(failures_df.record_id))
-
-			# write mapping failures to DB
-			failures_df.withColumn('record_id', failures_df.record_id).select(['record_id', 'job_id', 'mapping_error'])\
-			.write.jdbc(
-					settings.COMBINE_DATABASE['jdbc_url'],
-					'core_indexmappingfailure',
-					properties=settings.COMBINE_DATABASE,
-					mode='append'
-				)
+			ESIndex.write_indexing_failures(job, failures_rdd.map(lambda row: (row[1]['record_id'], row[1]['mapping_error'])))
 		
 		# retrieve successes to index
 		to_index_rdd = mapped_records_rdd.filter(lambda row: row[0] == 'success')
@@ -111,19 +118,165 @@ class ESIndex(object):
 			# create index
 			es_handle_temp.indices.create(index_name, body=json.dumps(mapping))
 
-		# index to ES
-		to_index_rdd.saveAsNewAPIHadoopFile(
-			path='-',
-			outputFormatClass="org.elasticsearch.hadoop.mr.EsOutputFormat",
-			keyClass="org.apache.hadoop.io.NullWritable",
-			valueClass="org.elasticsearch.hadoop.mr.LinkedMapWritable",
-			conf={
-					"es.resource":"%s/record" % index_name,
-					"es.nodes":"%s:9200" % settings.ES_HOST,
-					"es.mapping.exclude":"temp_id",
-					"es.mapping.id":"temp_id",
+		# disable refresh and replicas while loading, restoring when finished
+		index_settings = es_handle_temp.indices.get_settings(index=index_name)[index_name]['settings']['index']
+		restore_settings = {
+			'refresh_interval':index_settings.get('refresh_interval', '1s'),
+			'number_of_replicas':index_settings.get('number_of_replicas', 1)
+		}
+		es_handle_temp.indices.put_settings(index=index_name, body={'index':{'refresh_interval':'-1', 'number_of_replicas':0}})
+
+		stime = time.time()
+		try:
+
+			# index to ES via bulk API, per partition
+			if settings.ES_INDEXING_MODE == 'bulk':
+
+				index_counts = spark.sparkContext.accumulator({}, IndexCountAccumulatorParam())
+				bulk_index_partition = ESIndex.bulk_index_partition # must pass static method not attached to self
+				bulk_failures_rdd = to_index_rdd.mapPartitions(lambda rows: bulk_index_partition(rows, index_name, index_counts))\
+					.persist()
+
+				# index, once, then write documents rejected by ES as indexing failures
+				if bulk_failures_rdd.count() > 0:
+					ESIndex.write_indexing_failures(job, bulk_failures_rdd)
+				bulk_failures_rdd.unpersist()
+				indexing_metrics = dict(index_counts.value)
+
+			# index to ES via es-hadoop
+			elif settings.ES_INDEXING_MODE == 'es-hadoop':
+
+				to_index_rdd.saveAsNewAPIHadoopFile(
+					path='-',
+					outputFormatClass="org.elasticsearch.hadoop.mr.EsOutputFormat",
+					keyClass="org.apache.hadoop.io.NullWritable",
+					valueClass="org.elasticsearch.hadoop.mr.LinkedMapWritable",
+					conf={
+							"es.resource":"%s/record" % index_name,
+							"es.nodes":"%s:9200" % settings.ES_HOST,
+							"es.mapping.exclude":"temp_id",
+							"es.mapping.id":"temp_id",
+						}
+				)
+				indexing_metrics = {}
+
+			else:
+				raise Exception('ES_INDEXING_MODE not recognized: %s' % settings.ES_INDEXING_MODE)
+
+		finally:
+
+			# restore index settings, and refresh
+			es_handle_temp.indices.put_settings(index=index_name, body={'index':restore_settings})
+			es_handle_temp.indices.refresh(index=index_name)
+
+			# release mapped records
+			mapped_records_rdd.unpersist()
+
+		# save indexing metrics to job
+		indexing_metrics.update({
+			'mode':settings.ES_INDEXING_MODE,
+			'elapsed':round(time.time() - stime, 3)
+		})
+		job.update_job_details({'es_indexing_metrics':indexing_metrics})
+
+
+	@staticmethod
+	def write_indexing_failures(job, failures_rdd):
+
+		'''
+		Write indexing failures, from mapping or from ES bulk requests, to DB as IndexMappingFailure rows
+
+		Args:
+			job (core.models.Job): Job for records
+			failures_rdd (pyspark.rdd.RDD): failures, as (record_id, error) tuples
+
+		Returns:
+			None
+		'''
+
+		job_id = job.id
+		failures_rdd.map(lambda failure: Row(record_id=failure[0], job_id=job_id, mapping_error=failure[1])).toDF()\
+		.select(['record_id', 'job_id', 'mapping_error'])\
+		.write.jdbc(
+				settings.COMBINE_DATABASE['jdbc_url'],
+				'core_indexmappingfailure',
+				properties=settings.COMBINE_DATABASE,
+				mode='append'
+			)
+
+
+	@staticmethod
+	def map_records_partition(rows, index_mapper, publish_set_id):
+
+		'''
+		Map partition of records, with one index mapper instance for all records in partition
+
+		Args:
+			rows (iterator): partition of records as pyspark Rows
+			index_mapper (str): string of indexing mapper to use (e.g. MODSMapper)
+			publish_set_id (str): core.models.RecordGroup.published_set_id, used to build OAI identifier
+
+		Returns:
+			(generator): results of mapper's map_record()
+		'''
+
+		mapper = globals()[index_mapper]()
+		for row in rows:
+			yield mapper.map_record(
+				row.id,
+				row.record_id,
+				row.document,
+				publish_set_id
+			)
+
+
+	@staticmethod
+	def bulk_index_partition(rows, index_name, index_counts):
+
+		'''
+		Index partition of mapped records to ES via bulk API, with one ES connection per partition.
+		Batch size, bytes per batch, and concurrent requests are set by ES_BULK_CHUNK_SIZE, ES_BULK_MAX_CHUNK_BYTES,
+		and ES_BULK_THREAD_COUNT.
+
+		Args:
+			rows (iterator): partition of mapped records, as ('success', mapped dict) tuples
+			index_name (str): ES index
+			index_counts (pyspark.Accumulator): accumulator, with IndexCountAccumulatorParam, for indexed and failed
+
+		Returns:
+			(generator): documents rejected by ES, as (record_id, error) tuples
+		'''
+
+		es_handle_temp = Elasticsearch(hosts=[settings.ES_HOST], timeout=60)
+
+		# generate bulk actions, using temp_id as document id
+		def gen_actions():
+			for row in rows:
+				doc = dict(row[1])
+				doc_id = doc.pop('temp_id')
+				yield {
+					'_index':index_name,
+					'_type':'record',
+					'_id':doc_id,
+					'_source':doc
 				}
-		)
+
+		# stream to ES, counting results
+		partition_counts = {'indexed':0, 'failed':0}
+		for ok, info in parallel_bulk(
+				es_handle_temp,
+				gen_actions(),
+				thread_count=settings.ES_BULK_THREAD_COUNT,
+				chunk_size=settings.ES_BULK_CHUNK_SIZE,
+				max_chunk_bytes=settings.ES_BULK_MAX_CHUNK_BYTES,
+				raise_on_error=False):
+			if ok:
+				partition_counts['indexed'] += 1
+			else:
+				partition_counts['failed'] += 1
+				op_info = list(info.values())[0]
+				yield (op_info.get('_id'), json.dumps(op_info.get('error', op_info)))
+		index_counts.add(partition_counts)
 
 
 	@staticmethod
@@ -237,6 +390,10 @@ class GenericMapper(BaseMapper):
 	classname = "GenericMapper" # must be same as class name
 	name = "Generic XPath based mapper"
 
+	# pre-compiled checkers for blank text and repeating xpath indexes
+	blank_check = re.compile(r"[^ \t\n]")
+	index_check = re.compile(r'\[[0-9]+\]')
+
 
 	def __init__(self):
 
@@ -246,6 +403,9 @@ class GenericMapper(BaseMapper):
 		# empty formatted elems dict, grouping by flat, formatted element
 		self.formatted_elems = {}
 
+		# memoized flat field names, keyed by (tag path, attribute signature), for life of mapper (e.g. partition)
+		self.field_names = {}
+
 
 	def flatten_record(self):
 
@@ -308,63 +468,199 @@ class GenericMapper(BaseMapper):
 		# loop through flattened elements
 		for elem in self.flat_elems:
 
-			# split on slashes
-			xpath_comps = elem['xpath'].lstrip('/').split('/')
+			# derive flat field name, skipping if None
+			flat_field = self.format_xpath(elem['xpath'], elem['attributes'], include_attributes)
+			if flat_field is not None:
+				self.add_formatted_elem(flat_field, elem['text'])
 
-			# proceed if not entirely asterisks
-			if set(xpath_comps) != set('*'):
+		# convert all lists to tuples (required for saveAsNewAPIHadoopFile() method)
+		self.finalize_formatted_elems()
 
-				# remove namespaces if present
-				for i,comp in enumerate(xpath_comps):
-					if ':' in comp:
-						xpath_comps[i] = comp.split(':')[-1]
 
-				# remove asterisks from xpath_comps, as they are unhelpful
-				xpath_comps = [ c for c in xpath_comps if c != '*' ]
+	@staticmethod
+	def format_xpath(xpath, attributes, include_attributes):
 
-				# if include attributes
-				if include_attributes:
+		'''
+		Derive flat field name from element xpath and attributes
 
-					# convert attributes dictionary to sortable list of tuples
-					attribs = [ (k,v) for k,v in elem['attributes'].items() ]
+		Args:
+			xpath (str): xpath of element, with repeating indexes stripped
+			attributes (dict): attributes of element
+			include_attributes (bool): include attributes in flat field name
 
-					# sort alphabetically by attribute name
-					attribs.sort(key=lambda x: x[0])
+		Returns:
+			(str, None): flat field name, or None if xpath is entirely asterisks
+		'''
 
-					for attribute, value in attribs:
+		# split on slashes
+		xpath_comps = xpath.lstrip('/').split('/')
 
-						# replace whitespace in attribute or value with underscore
-						attribute = attribute.replace(' ','_')
-						value = value.replace(' ','_')						
+		# proceed if not entirely asterisks
+		if set(xpath_comps) == set('*'):
+			return None
 
-						# append to xpath_comps
-						xpath_comps.append('@%s_%s' % (attribute,value))
+		# remove namespaces if present
+		for i,comp in enumerate(xpath_comps):
+			if ':' in comp:
+				xpath_comps[i] = comp.split(':')[-1]
 
-				# derive flat field name
-				flat_field = '_'.join(xpath_comps)
+		# remove asterisks from xpath_comps, as they are unhelpful
+		xpath_comps = [ c for c in xpath_comps if c != '*' ]
 
-				# replace any periods in flat field name with underscore
-				flat_field = flat_field.replace('.','_')
-				
-				# if not yet seen, add to dictionary as single element
-				if flat_field not in self.formatted_elems.keys():
-					self.formatted_elems[flat_field] = elem['text']
+		# if include attributes
+		if include_attributes:
 
-				# elif, field exists, but not yet list, convert to list and append value
-				elif flat_field in self.formatted_elems.keys() and type(self.formatted_elems[flat_field]) != list:
-					temp_val = self.formatted_elems[flat_field]
-					self.formatted_elems[flat_field] = [temp_val, elem['text']]
+			# convert attributes dictionary to sortable list of tuples
+			attribs = [ (k,v) for k,v in attributes.items() ]
 
-				# else, append to already present list
-				else:
-					self.formatted_elems[flat_field].append(elem['text'])
+			# sort alphabetically by attribute name
+			attribs.sort(key=lambda x: x[0])
+
+			for attribute, value in attribs:
+
+				# replace whitespace in attribute or value with underscore
+				attribute = attribute.replace(' ','_')
+				value = value.replace(' ','_')						
+
+				# append to xpath_comps
+				xpath_comps.append('@%s_%s' % (attribute,value))
+
+		# derive flat field name, replacing any periods with underscore
+		return '_'.join(xpath_comps).replace('.','_')
+
+
+	def add_formatted_elem(self, flat_field, text):
+
+		'''
+		Add value to self.formatted_elems, converting to list if field repeats
+		'''
+
+		# if not yet seen, add to dictionary as single element
+		if flat_field not in self.formatted_elems:
+			self.formatted_elems[flat_field] = text
+
+		# elif, field exists, but not yet list, convert to list and append value
+		elif type(self.formatted_elems[flat_field]) != list:
+			self.formatted_elems[flat_field] = [self.formatted_elems[flat_field], text]
+
+		# else, append to already present list
+		else:
+			self.formatted_elems[flat_field].append(text)
+
+
+	def finalize_formatted_elems(self):
+
+		'''
+		Convert all lists to tuples (required for saveAsNewAPIHadoopFile() method)
+		'''
 
-		# convert all lists to tuples (required for saveAsNewAPIHadoopFile() method)
 		for k,v in self.formatted_elems.items():
 			if type(v) == list:
 				self.formatted_elems[k] = tuple(v)
 
 
+	def walk_record(self, include_attributes=settings.INCLUDE_ATTRIBUTES_GENERIC_MAPPER):
+
+		'''
+		Flatten and format record in a single recursive walk of the XML tree, equivalent to flatten_record()
+		followed by format_record().
+
+		Instead of an xpath per element, names of ancestors are carried down the tree as a tuple, the tag path,
+		and flat field names are memoized in self.field_names by tag path and attribute signature.  Following
+		format_record(), elements in a default namespace (an asterisk in the xpath) do not contribute to the field
+		name, and namespace prefixes are dropped.  Comments and processing instructions, which are rare, fall back
+		to their xpath from the tree.
+
+		Args:
+			include_attributes (bool): include attributes in flat field name
+
+		Returns:
+			None
+				- sets self.formatted_elems
+		'''
+
+		# reset formatted elems
+		self.formatted_elems = {}
+
+		# bound memoized field names, as attribute values may vary widely
+		if len(self.field_names) > 100000:
+			self.field_names = {}
+
+		# walk descendants of root, carrying tag path of root
+		self._walk_children(self.xml_root, self._tag_path_comp(self.xml_root), include_attributes)
+
+		# convert all lists to tuples (required for saveAsNewAPIHadoopFile() method)
+		self.finalize_formatted_elems()
+
+
+	@staticmethod
+	def _tag_path_comp(elem):
+
+		'''
+		Return element's contribution to tag path: local name, or empty tuple if in default namespace
+		'''
+
+		tag = elem.tag
+		if tag[0] == '{':
+			if elem.prefix is None:
+				return ()
+			return (tag.split('}', 1)[1],)
+		return (tag,)
+
+
+	def _walk_children(self, parent, tag_path, include_attributes):
+
+		'''
+		Recursively add text of children of parent to self.formatted_elems, in document order
+
+		Args:
+			parent (lxml.etree._Element): parent element
+			tag_path (tuple): tag path of parent
+			include_attributes (bool): include attributes in flat field name
+		'''
+
+		for elem in parent:
+
+			# comments and processing instructions, fall back to xpath from tree
+			if not isinstance(elem.tag, str):
+				if elem.text and self.blank_check.search(elem.text) is not None:
+					flat_field = self.format_xpath(
+						self.index_check.sub('', self.xml_tree.getpath(elem)),
+						elem.attrib,
+						include_attributes)
+					if flat_field is not None:
+						self.add_formatted_elem(flat_field, elem.text)
+				continue
+
+			elem_tag_path = tag_path + self._tag_path_comp(elem)
+
+			# if text value present for element, add with flat field name
+			if elem.text and self.blank_check.search(elem.text) is not None:
+
+				# entirely default namespace, skip
+				if len(elem_tag_path) > 0:
+
+					# attribute signature, sorted by attribute name
+					if include_attributes and len(elem.attrib) > 0:
+						attrib_sig = tuple(sorted(elem.attrib.items()))
+					else:
+						attrib_sig = ()
+
+					# get memoized flat field name, or derive
+					key = (elem_tag_path, attrib_sig)
+					flat_field = self.field_names.get(key)
+					if flat_field is None:
+						flat_field = '_'.join(
+							list(elem_tag_path) + [ '@%s_%s' % (k.replace(' ','_'), v.replace(' ','_')) for k,v in attrib_sig ]
+						).replace('.','_')
+						self.field_names[key] = flat_field
+
+					self.add_formatted_elem(flat_field, elem.text)
+
+			# walk children
+			self._walk_children(elem, elem_tag_path, include_attributes)
+
+
 	def map_record(self, combine_db_id, record_id, record_string, publish_set_id):
 
 		'''
@@ -393,11 +689,8 @@ class GenericMapper(BaseMapper):
 			# get tree
 			self.xml_tree = self.xml_root.getroottree()
 
-			# flatten record
-			self.flatten_record()
-
-			# format for return
-			self.format_record()
+			# flatten and format record
+			self.walk_record()
 
 			# add temporary id field
 			self.formatted_elems['temp_id'] = record_id
@@ -1,8 +1,10 @@
 # imports
 import ast
+from collections import OrderedDict
 import datetime
 import django
 from elasticsearch import Elasticsearch
+from functools import reduce
 import hashlib
 import json
 from lxml import etree
@@ -18,17 +20,19 @@ import pyjxslt
 # load elasticsearch spark code
 try:
 	from es import ESIndex
+	from oai_harvester import OAIHarvester
 	from record_validation import ValidationScenarioSpark
 except:
 	from core.spark.es import ESIndex
+	from core.spark.oai_harvester import OAIHarvester
 	from core.spark.record_validation import ValidationScenarioSpark
 
 # import Row from pyspark
+from pyspark import AccumulatorParam, StorageLevel
 from pyspark.sql import Row
-from pyspark.sql.types import StringType, StructField, StructType, BooleanType, ArrayType, IntegerType
+from pyspark.sql.types import StringType, StructField, StructType, BooleanType, ArrayType, IntegerType, LongType
 import pyspark.sql.functions as pyspark_sql_functions
 from pyspark.sql.functions import udf
-from pyspark.sql.window import Window
 
 # check for registered apps signifying readiness, if not, run django.setup() to run as standalone
 if not hasattr(django, 'apps'):
@@ -41,7 +45,7 @@ from django.conf import settings
 from django.db import connection
 
 # import select models from Core
-from core.models import CombineJob, Job, JobTrack, Transformation, PublishedRecords
+from core.models import CombineJob, Job, JobTrack, OAIEndpoint, Transformation, PublishedRecords
 
 
 ####################################################################
@@ -72,7 +76,8 @@ class CombineRecordSchema(object):
 				StructField('unique', BooleanType(), False),
 				StructField('job_id', IntegerType(), False),
 				StructField('oai_set', StringType(), True),
-				StructField('success', BooleanType(), False)				
+				StructField('success', BooleanType(), False),
+				StructField('document_hash', StringType(), True)
 			]
 		)
 
@@ -80,6 +85,29 @@ class CombineRecordSchema(object):
 		self.field_names = [f.name for f in self.schema.fields if f.name != 'id']
 
 
+# schema for records harvested by native OAI harvester, as JSON lines
+OAIHarvestRecordSchema = StructType([
+		StructField('id', StringType(), True),
+		StructField('setIds', ArrayType(StringType()), True),
+		StructField('document', StringType(), True),
+		StructField('deleted', BooleanType(), True)
+	]
+)
+
+
+# Row and schema for transformed records, ordered positionally to skip schema inference
+TransformedRecord = Row('record_id', 'document', 'error', 'job_id', 'oai_set', 'success')
+TransformedRecordSchema = StructType([
+		StructField('record_id', StringType(), True),
+		StructField('document', StringType(), True),
+		StructField('error', StringType(), True),
+		StructField('job_id', IntegerType(), False),
+		StructField('oai_set', StringType(), True),
+		StructField('success', IntegerType(), False)
+	]
+)
+
+
 ####################################################################
 # Django DB Connection 											   #
 ####################################################################
@@ -106,6 +134,258 @@ def refresh_django_db_connection():
 	connection.connect()
 
 
+####################################################################
+# Accumulators 													   #
+####################################################################
+
+class EngineMetricsAccumulatorParam(AccumulatorParam):
+
+	'''
+	Accumulator to aggregate rows processed and elapsed seconds, per engine, from Spark partitions
+
+	e.g.
+		{
+			'lxml':{'rows':250, 'elapsed':1.2},
+			'pyjxslt':{'rows':0, 'elapsed':0.0}
+		}
+	'''
+
+	def zero(self, value):
+		return {}
+
+
+	def addInPlace(self, metrics_a, metrics_b):
+		for engine, metrics in metrics_b.items():
+			if engine not in metrics_a.keys():
+				metrics_a[engine] = {'rows':0, 'elapsed':0.0}
+			metrics_a[engine]['rows'] += metrics['rows']
+			metrics_a[engine]['elapsed'] += metrics['elapsed']
+		return metrics_a
+
+
+def engine_metrics_summary(engine_metrics, stage_elapsed):
+
+	'''
+	Function to derive rows per second for each engine from accumulated engine metrics
+
+	Args:
+		engine_metrics (dict): value of EngineMetricsAccumulatorParam accumulator
+		stage_elapsed (float): wall clock seconds for the stage, as measured from the driver
+
+	Returns:
+		(dict): engine metrics, with rows per second of summed partition time for each engine
+	'''
+
+	summary = {
+		'stage_elapsed':round(stage_elapsed, 3),
+		'engines':{}
+	}
+	for engine, metrics in engine_metrics.items():
+		summary['engines'][engine] = {
+			'rows':metrics['rows'],
+			'elapsed':round(metrics['elapsed'], 3),
+			'rows_per_second':round(metrics['rows'] / metrics['elapsed'], 1) if metrics['elapsed'] > 0 else None
+		}
+	return summary
+
+
+####################################################################
+# XSLT Transformations 											   #
+####################################################################
+
+class XSLTransformer(object):
+
+	'''
+	Stylesheet compiled once, ready to transform any number of documents
+
+	Stylesheets declaring XSLT 1.0 are compiled with lxml's etree.XSLT, all others (XSLT 2.0+), or 1.0 stylesheets
+	that lxml cannot compile, are registered once with the pyjxslt gateway pooled by XSLTransformerCache.
+
+	Args:
+		xslt_string (str): XSLT stylesheet
+		xslt_hash (str): md5 hash of stylesheet, used as key for pyjxslt gateway
+	'''
+
+	def __init__(self, xslt_string, xslt_hash):
+
+		self.xslt_hash = xslt_hash
+		self.xslt_version = self.get_xslt_version(xslt_string)
+		self.engine = None
+
+		# XSLT 1.0, attempt compile with lxml
+		if self.xslt_version is not None and self.xslt_version.startswith('1.'):
+			try:
+				self.xsl_transform = etree.XSLT(etree.fromstring(xslt_string.encode('utf-8')))
+				self.engine = 'lxml'
+			except etree.XSLTParseError:
+				pass
+
+		# XSLT 2.0+, or lxml unable to compile, register with gateway
+		if self.engine is None:
+			self.gw = XSLTransformerCache.get_gateway()
+			self.gw.add_transform(self.xslt_hash, xslt_string)
+			self.engine = 'pyjxslt'
+
+
+	@staticmethod
+	def get_xslt_version(xslt_string):
+
+		'''
+		Return XSLT version declared by stylesheet, also checking xsl:version for simplified stylesheets
+
+		Args:
+			xslt_string (str): XSLT stylesheet
+
+		Returns:
+			(str, None): version declared, or None if not found
+		'''
+
+		xslt_root = etree.fromstring(xslt_string.encode('utf-8'))
+		return xslt_root.get('version', xslt_root.get('{http://www.w3.org/1999/XSL/Transform}version'))
+
+
+	def transform(self, document):
+
+		'''
+		Transform document
+
+		Args:
+			document (str): XML document
+
+		Returns:
+			(str): transformed document
+		'''
+
+		if self.engine == 'lxml':
+			return str(self.xsl_transform(etree.fromstring(document.encode('utf-8'))))
+
+		elif self.engine == 'pyjxslt':
+			return self.gw.transform(self.xslt_hash, document)
+
+
+	def release(self):
+
+		'''
+		Drop stylesheet from pyjxslt gateway, if registered there
+		'''
+
+		if self.engine == 'pyjxslt':
+			self.gw.drop_transform(self.xslt_hash)
+
+
+
+class XSLTransformerCache(object):
+
+	'''
+	LRU cache of compiled stylesheets, keyed by md5 hash of stylesheet content.
+
+	As class attributes, the cache and pyjxslt gateway persist for the life of the python worker on each executor,
+	such that a stylesheet is compiled once per executor, not once per record or partition.
+	'''
+
+	transformers = OrderedDict()
+	gateway = None
+
+
+	@classmethod
+	def get_gateway(cls):
+
+		'''
+		Return pyjxslt gateway shared by all transformers in this python worker
+		'''
+
+		if cls.gateway is None:
+			cls.gateway = pyjxslt.Gateway(6767)
+		return cls.gateway
+
+
+	@classmethod
+	def get_transformer(cls, xslt_string):
+
+		'''
+		Return compiled XSLTransformer for stylesheet, compiling and caching if not yet seen
+
+		Args:
+			xslt_string (str): XSLT stylesheet
+
+		Returns:
+			(XSLTransformer)
+		'''
+
+		xslt_hash = hashlib.md5(xslt_string.encode('utf-8')).hexdigest()
+
+		# cache hit, mark as most recently used
+		if xslt_hash in cls.transformers:
+			cls.transformers.move_to_end(xslt_hash)
+			return cls.transformers[xslt_hash]
+
+		# compile and cache
+		transformer = XSLTransformer(xslt_string, xslt_hash)
+		cls.transformers[xslt_hash] = transformer
+
+		# evict least recently used
+		while len(cls.transformers) > settings.SPARK_XSLT_CACHE_SIZE:
+			evicted_hash, evicted = cls.transformers.popitem(last=False)
+			evicted.release()
+
+		return transformer
+
+
+def transform_xml_partition(job_id, rows, xslt_string, engine_metrics):
+
+	'''
+	Transform partition of records with XSLT stylesheet, compiled once per executor via XSLTransformerCache
+
+	Args:
+		job_id (int): Job ID
+		rows (iterator): partition of records as pyspark Rows
+		xslt_string (str): XSLT stylesheet
+		engine_metrics (pyspark.Accumulator): accumulator, with EngineMetricsAccumulatorParam, for rows per engine
+
+	Returns:
+		(generator): TransformedRecord Rows
+	'''
+
+	stime = time.time()
+
+	# get compiled stylesheet, capturing error for all rows if stylesheet cannot compile
+	try:
+		transformer = XSLTransformerCache.get_transformer(xslt_string)
+		engine = transformer.engine
+		compile_error = None
+	except Exception as e:
+		engine = 'failed'
+		compile_error = 'could not compile XSLT stylesheet: %s' % str(e)
+
+	row_count = 0
+	for row in rows:
+
+		# attempt transformation and save output to 'document'
+		if compile_error is None:
+			try:
+				trans_result = (transformer.transform(row.document), '', 1)
+
+			# catch transformation exception and save exception to 'error'
+			except Exception as e:
+				trans_result = ('', str(e), 0)
+		else:
+			trans_result = ('', compile_error, 0)
+
+		row_count += 1
+		yield TransformedRecord(
+			row.record_id,
+			trans_result[0],
+			trans_result[1],
+			int(job_id),
+			row.oai_set,
+			trans_result[2]
+		)
+
+	# report rows and elapsed for engine
+	engine_metrics.add({engine:{'rows':row_count, 'elapsed':time.time() - stime}})
+
+
+
 ####################################################################
 # Spark Jobs           											   #
 ####################################################################
@@ -139,6 +419,9 @@ class HarvestOAISpark(object):
 				scope_type (str): [setList, whiteList, blackList, harvestAllSets], used by DPLA Ingestion3
 				scope_value (str): value for scope_type
 				index_mapper (str): class name from core.spark.es, extending BaseMapper
+				oai_endpoint_id (str): OAIEndpoint ID, updated with datestamp of successful harvest
+				from_date (str): incremental harvest, OAI-PMH datestamp to harvest records changed since
+				previous_job_id (str): incremental harvest, Job ID of previous harvest to compare against
 
 		Returns:
 			None:
@@ -159,16 +442,94 @@ class HarvestOAISpark(object):
 		)
 		job_track.save()
 
-		# harvest OAI records via Ingestion3
-		df = spark.read.format("dpla.ingestion3.harvesters.oai")\
-		.option("endpoint", kwargs['endpoint'])\
-		.option("verb", kwargs['verb'])\
-		.option("metadataPrefix", kwargs['metadataPrefix'])\
-		.option(kwargs['scope_type'], kwargs['scope_value'])\
-		.load()
+		# datestamp of harvest start, at day granularity, saved to OAI endpoint for next incremental harvest
+		harvest_datestamp = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+
+		# harvest records
+		records, harvested_records = HarvestOAISpark.harvest_records(spark, job, **kwargs)
+
+		# index records to DB and index to ElasticSearch
+		db_records = save_records(
+			spark=spark,
+			kwargs=kwargs,
+			job=job,
+			records_df=records
+		)
+
+		# run record validation scnearios if requested, using db_records from save_records() output
+		vs = ValidationScenarioSpark(
+			spark=spark,
+			job=job,
+			records_df=db_records,
+			validation_scenarios = ast.literal_eval(kwargs['validation_scenarios'])
+		)
+		vs.run_record_validation_scenarios()
+
+		# release job working set
+		db_records.unpersist()
+
+		# remove harvested shards, and record successful harvest on OAI endpoint
+		HarvestOAISpark.finish_harvest(job, harvested_records, harvest_datestamp, **kwargs)
+
+		# finally, update finish_timestamp of job_track instance
+		job_track.finish_timestamp = datetime.datetime.now()
+		job_track.save()
+
+
+	@staticmethod
+	def harvest_records(spark, job, **kwargs):
 
-		# select records with content
-		records = df.select("record.*").where("record is not null")
+		'''
+		Harvest OAI records as DataFrame of records for Job, not yet saved
+
+		Args:
+			spark (pyspark.sql.session.SparkSession): provided by pyspark context
+			job (core.models.Job): Job instance
+			kwargs: see HarvestOAISpark.spark_function
+
+		Returns:
+			(tuple): records (pyspark.sql.DataFrame), and records as harvested, persisted for incremental
+			harvest, else None
+		'''
+
+		from_date = kwargs.get('from_date') or None
+		previous_job_id = kwargs.get('previous_job_id') or None
+		deleted_ids = None
+
+		# harvest OAI records via native harvester, resuming from checkpoints if job previously interrupted
+		if settings.OAI_HARVEST_MODE == 'native':
+			harvest_dir = get_oai_harvest_dir(job)
+			harvest_summary = OAIHarvester(
+				endpoint=kwargs['endpoint'],
+				metadataPrefix=kwargs['metadataPrefix'],
+				scope_type=kwargs['scope_type'],
+				scope_value=kwargs['scope_value'],
+				output_dir=harvest_dir,
+				from_date=from_date
+			).harvest()
+			job.update_job_details({'oai_harvest':{ k:v for k,v in harvest_summary.items() if k != 'shards' }})
+
+			# read shards of harvested records, setting aside identifiers of deleted records
+			records = spark.read.schema(OAIHarvestRecordSchema).json('file://%s/*.jsonl' % harvest_dir)
+			deleted_ids = records.filter(records.deleted == True).select(records.id.alias('record_id'))
+			records = records.filter(records.deleted.isNull() | (records.deleted == False)).drop('deleted')
+
+		# harvest OAI records via Ingestion3, which harvests in full, though records are still compared to previous
+		elif settings.OAI_HARVEST_MODE == 'ingestion3':
+			if from_date is not None:
+				print("Ingestion3 OAI harvest does not support from, harvesting in full")
+			df = spark.read.format("dpla.ingestion3.harvesters.oai")\
+			.option("endpoint", kwargs['endpoint'])\
+			.option("verb", kwargs['verb'])\
+			.option("metadataPrefix", kwargs['metadataPrefix'])\
+			.option(kwargs['scope_type'], kwargs['scope_value'])\
+			.load()
+
+			# select records with content
+			records = df.select("record.*").where("record is not null")
+
+		else:
+			raise Exception('OAI_HARVEST_MODE not recognized: %s' % settings.OAI_HARVEST_MODE)
 
 		# repartition
 		records = records.repartition(settings.SPARK_REPARTITION)
@@ -212,26 +573,46 @@ class HarvestOAISpark(object):
 		error = udf(lambda id: '', StringType())
 		records = records.withColumn('error', error(records.id))
 
-		# index records to DB and index to ElasticSearch
-		db_records = save_records(
-			spark=spark,
-			kwargs=kwargs,
-			job=job,
-			records_df=records
-		)
+		# incremental harvest, keeping only new or changed records and carrying forward others from previous harvest
+		harvested_records = None
+		if previous_job_id is not None:
+			harvested_records = records.persist(getattr(StorageLevel, settings.SPARK_WORKING_SET_STORAGE_LEVEL))
+			records = merge_incremental_harvest(spark, job, harvested_records, int(previous_job_id), deleted_ids, from_date)
 
-		# run record validation scnearios if requested, using db_records from save_records() output
-		vs = ValidationScenarioSpark(
-			spark=spark,
-			job=job,
-			records_df=db_records,
-			validation_scenarios = ast.literal_eval(kwargs['validation_scenarios'])
-		)
-		vs.run_record_validation_scenarios()
+		return (records, harvested_records)
 
-		# finally, update finish_timestamp of job_track instance
-		job_track.finish_timestamp = datetime.datetime.now()
-		job_track.save()
+
+	@staticmethod
+	def finish_harvest(job, harvested_records, harvest_datestamp, **kwargs):
+
+		'''
+		Release harvested records, remove harvested shards and checkpoints, and record successful harvest on OAI
+		endpoint, as starting point for next incremental harvest.  Called once records are saved.
+
+		Args:
+			job (core.models.Job): Job instance
+			harvested_records (pyspark.sql.DataFrame): records as harvested, from HarvestOAISpark.harvest_records
+			harvest_datestamp (str): datestamp of harvest start
+			kwargs: see HarvestOAISpark.spark_function
+
+		Returns:
+			None
+		'''
+
+		# release harvested records
+		if harvested_records is not None:
+			harvested_records.unpersist()
+
+		# remove harvested shards and checkpoints
+		if settings.OAI_HARVEST_MODE == 'native':
+			shutil.rmtree(get_oai_harvest_dir(job))
+
+		# record successful harvest on OAI endpoint
+		if kwargs.get('oai_endpoint_id'):
+			OAIEndpoint.objects.filter(pk=int(kwargs['oai_endpoint_id'])).update(
+				last_harvest_datestamp=harvest_datestamp,
+				last_harvest_job=job
+			)
 		
 
 
@@ -247,12 +628,17 @@ class HarvestStaticXMLSpark(object):
 		'''
 		Harvest static XML records provided by user.
 
-		Expected input structure:
+		Expected input structure, for payload_format 'files':
 			/foo/bar <-- self.static_payload
 				baz1.xml <-- record at self.xpath_query within file
 				baz2.xml
 				baz3.xml
 
+		or, for payload_format 'jsonl', shards written by core.models.StaticXMLSplitter:
+			/foo/bar <-- self.static_payload
+				records_00000.jsonl <-- one record per line, as JSON string
+				records_00001.jsonl
+
 		As a harvest type job, unlike other jobs, this introduces various fields to the Record for the first time:
 			- record_id 
 			- job_id
@@ -265,6 +651,7 @@ class HarvestStaticXMLSpark(object):
 			kwargs:
 				job_id (int): Job ID
 				static_payload (str): path of static payload on disk
+				payload_format (str)['files','jsonl']: one record per file, or shards of JSON lines
 				index_mapper (str): class name from core.spark.es, extending BaseMapper
 
 		Returns:
@@ -286,11 +673,19 @@ class HarvestStaticXMLSpark(object):
 		)
 		job_track.save()
 
-		# read directory of static files
-		static_rdd = spark.sparkContext.wholeTextFiles(
-				'file://%s' % kwargs['static_payload'],
-				minPartitions=settings.SPARK_REPARTITION
-			)
+		# read shards of JSON lines, one record per line, as (shard, document) tuples
+		if kwargs.get('payload_format', 'files') == 'jsonl':
+			static_rdd = spark.sparkContext.textFile(
+					'file://%s/*.jsonl' % kwargs['static_payload'].rstrip('/'),
+					minPartitions=settings.SPARK_REPARTITION
+				).map(lambda line: (None, json.loads(line)))
+
+		# read directory of static files, one record per file, as (filename, document) tuples
+		else:
+			static_rdd = spark.sparkContext.wholeTextFiles(
+					'file://%s' % kwargs['static_payload'],
+					minPartitions=settings.SPARK_REPARTITION
+				)
 
 
 		# parse namespaces
@@ -402,6 +797,9 @@ class HarvestStaticXMLSpark(object):
 		)
 		vs.run_record_validation_scenarios()
 
+		# release job working set
+		db_records.unpersist()
+
 		# remove temporary payload directory if static job was upload based, not location on disk
 		if kwargs['static_type'] == 'upload':
 			shutil.rmtree(kwargs['static_payload'])
@@ -451,69 +849,12 @@ class TransformSpark(object):
 		)
 		job_track.save()
 
-		# read output from input job, filtering by job_id, grabbing Combine Record schema fields
+		# read output from input job, from record store
 		input_job = Job.objects.get(pk=int(kwargs['input_job_id']))
-		bounds = get_job_db_bounds(input_job)
-		sqldf = spark.read.jdbc(
-				settings.COMBINE_DATABASE['jdbc_url'],
-				'core_record',
-				properties=settings.COMBINE_DATABASE,
-				column='id',
-				lowerBound=bounds['lowerBound'],
-				upperBound=bounds['upperBound'],
-				numPartitions=settings.JDBC_NUMPARTITIONS
-			)
-		records = sqldf.filter(sqldf.job_id == int(kwargs['input_job_id']))
-
-		# repartition
-		records = records.repartition(settings.SPARK_REPARTITION)
-
-		# get transformation
-		transformation = Transformation.objects.get(pk=int(kwargs['transformation_id']))
-
-		# if xslt type transformation
-		if transformation.transformation_type == 'xslt':
-
-			# define udf function for transformation
-			def transform_xml_udf(job_id, row, xslt_string):
-
-				# attempt transformation and save out put to 'document'
-				try:
-					
-					# transform with pyjxslt gateway
-					gw = pyjxslt.Gateway(6767)
-					gw.add_transform('xslt_transform', xslt_string)
-					result = gw.transform('xslt_transform', row.document)
-					gw.drop_transform('xslt_transform')
-
-					# set trans_result tuple
-					trans_result = (result, '', 1)
+		records = read_job_records(spark, [input_job.id])
 
-				# catch transformation exception and save exception to 'error'
-				except Exception as e:
-					# set trans_result tuple
-					trans_result = ('', str(e), 0)
-
-				# return Row
-				return Row(
-						record_id = row.record_id,
-						document = trans_result[0],
-						error = trans_result[1],
-						job_id = int(job_id),
-						oai_set = row.oai_set,
-						success = trans_result[2]
-					)
-
-			# open XSLT transformation, pass to map as string
-			with open(transformation.filepath,'r') as f:
-				xslt_string = f.read()
-
-			# transform via rdd.map
-			job_id = job.id			
-			records_trans = records.rdd.map(lambda row: transform_xml_udf(job_id, row, xslt_string))
-
-		# back to DataFrame
-		records_trans = records_trans.toDF()
+		# transform records
+		records_trans = TransformSpark.transform_records(spark, job, records, kwargs['transformation_id'])
 
 		# index records to DB and index to ElasticSearch
 		db_records = save_records(
@@ -532,11 +873,63 @@ class TransformSpark(object):
 		)
 		vs.run_record_validation_scenarios()
 
+		# release job working set
+		db_records.unpersist()
+
+		# release transformed records
+		records_trans.unpersist()
+
 		# finally, update finish_timestamp of job_track instance
 		job_track.finish_timestamp = datetime.datetime.now()
 		job_track.save()
 
 
+	@staticmethod
+	def transform_records(spark, job, records, transformation_id):
+
+		'''
+		Transform records, not yet saved, reporting rows per second for each engine to Job
+
+		Args:
+			spark (pyspark.sql.session.SparkSession): provided by pyspark context
+			job (core.models.Job): Job instance
+			records (pyspark.sql.DataFrame): input records
+			transformation_id (int): Transformation ID
+
+		Returns:
+			(pyspark.sql.DataFrame): transformed records, persisted, caller is responsible for unpersisting
+		'''
+
+		# repartition
+		records = records.repartition(settings.SPARK_REPARTITION)
+
+		# get transformation
+		transformation = Transformation.objects.get(pk=int(transformation_id))
+
+		# if xslt type transformation
+		if transformation.transformation_type == 'xslt':
+
+			# open XSLT transformation, pass to partitions as string
+			with open(transformation.filepath,'r') as f:
+				xslt_string = f.read()
+
+			# transform via rdd.mapPartitions, compiling stylesheet once per executor
+			job_id = job.id
+			engine_metrics = spark.sparkContext.accumulator({}, EngineMetricsAccumulatorParam())
+			records_trans = records.rdd.mapPartitions(
+				lambda rows: transform_xml_partition(job_id, rows, xslt_string, engine_metrics))
+
+		# back to DataFrame, persisted so transformation runs once for all writes
+		records_trans = spark.createDataFrame(records_trans, schema=TransformedRecordSchema).persist()
+
+		# materialize transformation, report rows per second for each engine to Job
+		stime = time.time()
+		records_trans.count()
+		job.update_job_details({'transform_metrics':engine_metrics_summary(engine_metrics.value, time.time() - stime)})
+
+		return records_trans
+
+
 
 class MergeSpark(object):
 
@@ -580,41 +973,15 @@ class MergeSpark(object):
 		# rehydrate list of input jobs
 		input_jobs_ids = ast.literal_eval(kwargs['input_jobs_ids'])
 
-		# get total range of id's from input jobs to help partition jdbc reader
-		records_ids = []
-		for input_job_id in input_jobs_ids:
-			input_job_temp = Job.objects.get(pk=int(input_job_id))
-			records = input_job_temp.get_records().order_by('id')
-			start_id = records.first().id
-			end_id = records.last().id
-			records_ids += [start_id, end_id]
-		records_ids.sort()		
-
-		# get list of RDDs from input jobs
-		sqldf = spark.read.jdbc(
-				settings.COMBINE_DATABASE['jdbc_url'],
-				'core_record',
-				properties=settings.COMBINE_DATABASE,
-				column='id',
-				lowerBound=records_ids[0],
-				upperBound=records_ids[-1],
-				numPartitions=settings.JDBC_NUMPARTITIONS
-			)
-
-		input_jobs_dfs = []		
-		for input_job_id in input_jobs_ids:
-
-			# db
-			job_df = sqldf.filter(sqldf.job_id == int(input_job_id))
-			input_jobs_dfs.append(job_df)
-
-		# create aggregate rdd of frames
-		agg_rdd = sc.union([ df.rdd for df in input_jobs_dfs ])
-		agg_df = spark.createDataFrame(agg_rdd, schema=input_jobs_dfs[0].schema)
+		# read records from all input jobs, from record store
+		agg_df = read_job_records(spark, input_jobs_ids)
 
 		# repartition
 		agg_df = agg_df.repartition(settings.SPARK_REPARTITION)
 
+		# drop records identical across input jobs
+		agg_df = dedupe_identical_records(agg_df)
+
 		# update job column, overwriting job_id from input jobs in merge
 		job_id = job.id
 		job_id_udf = udf(lambda record_id: job_id, IntegerType())
@@ -642,6 +1009,9 @@ class MergeSpark(object):
 		)
 		vs.run_record_validation_scenarios()
 
+		# release job working set
+		db_records.unpersist()
+
 		# finally, update finish_timestamp of job_track instance
 		job_track.finish_timestamp = datetime.datetime.now()
 		job_track.save()
@@ -681,19 +1051,34 @@ class PublishSpark(object):
 		)
 		job_track.save()
 
-		# read output from input job, filtering by job_id, grabbing Combine Record schema fields
+		# read output from input job, from record store
 		input_job = Job.objects.get(pk=int(kwargs['input_job_id']))
-		bounds = get_job_db_bounds(input_job)
-		sqldf = spark.read.jdbc(
-				settings.COMBINE_DATABASE['jdbc_url'],
-				'core_record',
-				properties=settings.COMBINE_DATABASE,
-				column='id',
-				lowerBound=bounds['lowerBound'],
-				upperBound=bounds['upperBound'],
-				numPartitions=settings.JDBC_NUMPARTITIONS
-			)
-		records = sqldf.filter(sqldf.job_id == int(kwargs['input_job_id']))
+		records = read_job_records(spark, [input_job.id])
+
+		# publish records, copying index from input job
+		PublishSpark.publish_records(spark, job, records, kwargs, source_index='j%s' % input_job.id)
+
+		# finally, update finish_timestamp of job_track instance
+		job_track.finish_timestamp = datetime.datetime.now()
+		job_track.save()
+
+
+	@staticmethod
+	def publish_records(spark, job, records, kwargs, source_index=None):
+
+		'''
+		Publish records: write Avro output symlinked to /published, save records, and index to /published
+
+		Args:
+			spark (pyspark.sql.session.SparkSession): provided by pyspark context
+			job (core.models.Job): Job instance
+			records (pyspark.sql.DataFrame): input records
+			kwargs (dict): dictionary of args sent to Job spark method
+			source_index (str): ES index of input records, copied to Job index, or None to index records of Job
+
+		Returns:
+			None
+		'''
 
 		# repartition
 		records = records.repartition(settings.SPARK_REPARTITION)
@@ -701,13 +1086,26 @@ class PublishSpark(object):
 		# get rows with document content
 		records = records[records['document'] != '']
 
+		# drop records identical to another in input job
+		records = dedupe_identical_records(with_document_hash(records))
+
+		# check uniqueness, if input records not yet saved, persisting records read by aggregation and join
+		unique_records = None
+		if 'unique' not in records.columns:
+			records = records.persist(getattr(StorageLevel, settings.SPARK_WORKING_SET_STORAGE_LEVEL))
+			unique_records = mark_unique_records(spark, job, records)
+			records.unpersist()
+			records = unique_records
+
 		# update job column, overwriting job_id from input jobs in merge
 		job_id = job.id
 		job_id_udf = udf(lambda record_id: job_id, IntegerType())
-		records = records.withColumn('job_id', job_id_udf(records.record_id))
+		records = records.withColumn('job_id', job_id_udf(records.record_id))\
+			.persist(getattr(StorageLevel, settings.SPARK_WORKING_SET_STORAGE_LEVEL))
 
-		# write job output to avro
+		# write job output to avro, with manifest of record count
 		records.select(CombineRecordSchema().field_names).write.format("com.databricks.spark.avro").save(job.job_output)
+		write_job_output_manifest(job, records.count())
 
 		# confirm directory exists
 		published_dir = '%s/published' % (settings.BINARY_STORAGE.split('file://')[-1].rstrip('/'))
@@ -720,29 +1118,46 @@ class PublishSpark(object):
 		for avro in avros:
 			os.symlink(os.path.join(job_output_dir, avro), os.path.join(published_dir, avro))
 
-		# index records to DB and index to ElasticSearch
+		# index records to DB, and to ElasticSearch only if no index to copy from
 		db_records = save_records(
 			spark=spark,
 			kwargs=kwargs,
 			job=job,
 			records_df=records,
 			write_avro=False,
-			index_records=False
+			index_records=source_index is None
 		)
 
-		# copy index from input job to new Publish job
-		index_to_job_index = ESIndex.copy_es_index(
-			source_index = 'j%s' % input_job.id,
-			target_index = 'j%s' % job.id,
-			wait_for_completion=False
-		)
+		# release job working set, not used further by Publish
+		db_records.unpersist()
+		records.unpersist()
+		if unique_records is not None:
+			unique_records.unpersist()
+
+		# records indexed for new Publish job, copy index to /published index
+		if source_index is None:
+			ESIndex.copy_es_index(
+				source_index = 'j%s' % job.id,
+				target_index = 'published',
+				wait_for_completion = False,
+				add_copied_from = job_id
+			)
+			index_to_job_index = None
+
+		# else, copy index from input job to new Publish job
+		else:
+			index_to_job_index = ESIndex.copy_es_index(
+				source_index = source_index,
+				target_index = 'j%s' % job.id,
+				wait_for_completion=False
+			)
 
 		# copy index from new Publish Job to /published index
 		# NOTE: because back to back reindexes, and problems with timeouts on requests,
 		# wait on task from previous reindex
 		es_handle_temp = Elasticsearch(hosts=[settings.ES_HOST])
 		retry = 1
-		while retry <= 100:
+		while index_to_job_index is not None and retry <= 100:
 
 			# get task
 			task = es_handle_temp.tasks.get(index_to_job_index['task'])
@@ -771,12 +1186,142 @@ class PublishSpark(object):
 		# set records from job as published		
 		pr.set_published_field(job_id)
 
+		# index published records of job by publish set, for OAI set filters and ListSets
+		pr.update_set_index([job_id])
+
 		# update uniqueness of all published records
 		pr.update_published_uniqueness()
 
-		# finally, update finish_timestamp of job_track instance
-		job_track.finish_timestamp = datetime.datetime.now()
-		job_track.save()
+
+
+class PipelineSpark(object):
+
+	'''
+	Spark code for pipelines of stages, see core.models.PipelineJob
+	'''
+
+	@staticmethod
+	def spark_function(spark, **kwargs):
+
+		'''
+		Run stages of pipeline in order, passing records of each stage to the next as a cached DataFrame, instead of
+		reading them back from the record store
+
+		Args:
+			spark (pyspark.sql.session.SparkSession): provided by pyspark context
+			kwargs:
+				stages (str): JSON list of stages, each with:
+					job_type (str)['HarvestOAIJob','TransformJob','PublishJob']: Job type of stage
+					persist (bool): save records of stage to record store
+					index (bool): index records of stage to ES, if saved
+					kwargs (dict): args of Spark job for stage, see HarvestOAISpark, TransformSpark, PublishSpark
+
+		Returns:
+			None
+			- runs stages, saving and indexing records of stages as set
+			- records count of stages not saved to Job
+		'''
+
+		# refresh Django DB Connection
+		refresh_django_db_connection()
+
+		stages = json.loads(kwargs['stages'])
+
+		# records passed to next stage, and ES index of them, if saved and indexed
+		records = None
+		source_index = None
+		harvest = None
+
+		for stage in stages:
+
+			stage_kwargs = stage['kwargs']
+
+			# get job
+			job = Job.objects.get(pk=int(stage_kwargs['job_id']))
+
+			# start job_track instance, marking job start
+			job_track = JobTrack(
+				job_id = job.id
+			)
+			job_track.save()
+
+			# first stage not a harvest, read output from input job, from record store
+			if records is None and stage_kwargs.get('input_job_id'):
+				records = read_job_records(spark, [int(stage_kwargs['input_job_id'])])
+				source_index = 'j%s' % stage_kwargs['input_job_id']
+			input_records = records
+
+			# harvest, finished once all stages are run, as records may be recomputed from harvested shards
+			if stage['job_type'] == 'HarvestOAIJob':
+				harvest_datestamp = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+				records, harvested_records = HarvestOAISpark.harvest_records(spark, job, **stage_kwargs)
+				harvest = (job, harvested_records, harvest_datestamp, stage_kwargs)
+
+			# transform, persisted and counted by transform_records
+			elif stage['job_type'] == 'TransformJob':
+				records = TransformSpark.transform_records(spark, job, records, stage_kwargs['transformation_id'])
+
+			# publish, always saved, as last stage
+			elif stage['job_type'] == 'PublishJob':
+				PublishSpark.publish_records(spark, job, records, stage_kwargs, source_index=source_index)
+				records = None
+
+			else:
+				raise Exception('job type not supported as pipeline stage: %s' % stage['job_type'])
+
+			if records is not None:
+
+				# cache records for next stage
+				if not records.is_cached:
+					records = records.persist(getattr(StorageLevel, settings.SPARK_WORKING_SET_STORAGE_LEVEL))
+
+				# index records to DB and index to ElasticSearch, if set
+				if stage['persist']:
+					db_records = save_records(
+						spark=spark,
+						kwargs=stage_kwargs,
+						job=job,
+						records_df=records,
+						index_records=stage['index']
+					)
+
+					# run record validation scnearios if requested, using db_records from save_records() output
+					vs = ValidationScenarioSpark(
+						spark=spark,
+						job=job,
+						records_df=db_records,
+						validation_scenarios = ast.literal_eval(stage_kwargs['validation_scenarios'])
+					)
+					vs.run_record_validation_scenarios()
+
+					# release job working set
+					db_records.unpersist()
+
+				# else, count records only
+				else:
+					Job.objects.filter(pk=job.id).update(record_count=records.count())
+
+				# next stage may copy ES index, if indexed
+				if stage['persist'] and stage['index']:
+					source_index = 'j%s' % job.id
+				else:
+					source_index = None
+
+			# release records of previous stage, materialized by this stage
+			if input_records is not None:
+				input_records.unpersist()
+
+			# finally, update finish_timestamp of job_track instance
+			job_track.finish_timestamp = datetime.datetime.now()
+			job_track.save()
+
+		# release records of last stage
+		if records is not None:
+			records.unpersist()
+
+		# remove harvested shards, and record successful harvest on OAI endpoint
+		if harvest is not None:
+			HarvestOAISpark.finish_harvest(*harvest[:3], **harvest[3])
 
 
 
@@ -797,49 +1342,83 @@ def save_records(spark=None, kwargs=None, job=None, records_df=None, write_avro=
 		write_avro (bool): boolean to write avro files to disk after DB indexing 
 
 	Returns:
-		None
+		(pyspark.sql.DataFrame): job working set, successful records with DB ids, persisted
 			- determines if record_id unique among records DataFrame
+			- computes document_hash, MD5 of document
 			- selects only columns that match CombineRecordSchema
 			- writes to DB, writes to avro files
 	'''
 
-	# check uniqueness (overwrites if column already exists)
-	'''
-	What is the performance hit of this uniqueness check?
-	'''
-	records_df = records_df.withColumn("unique", (
-		pyspark_sql_functions.count('record_id')\
-		.over(Window.partitionBy('record_id')) == 1)\
-		.cast('integer'))
+	# persist input records, read by both aggregation and join of uniqueness check, unless persisted by caller
+	input_df = None
+	if not records_df.is_cached:
+		input_df = records_df = records_df.persist(getattr(StorageLevel, settings.SPARK_WORKING_SET_STORAGE_LEVEL))
+
+	# check uniqueness (overwrites if column already exists), records returned persisted, and reused by all writes
+	records_df = mark_unique_records(spark, job, records_df)
+	unique_df = records_df
+	if input_df is not None:
+		input_df.unpersist()
+
+	# fingerprint documents (overwrites if column already exists)
+	records_df = records_df.withColumn('document_hash', pyspark_sql_functions.md5(records_df.document))
 
 	# ensure columns to avro and DB
 	records_df_combine_cols = records_df.select(CombineRecordSchema().field_names)
 
-	# write avro, coalescing for output
-	if write_avro:
-		records_df_combine_cols.coalesce(settings.SPARK_REPARTITION)\
-		.write.format("com.databricks.spark.avro").save(job.job_output)
-
-	# write records to DB
-	records_df_combine_cols.write.jdbc(
-		settings.COMBINE_DATABASE['jdbc_url'],
-		'core_record',
-		properties=settings.COMBINE_DATABASE,
-		mode='append')
-
-	# read rows from DB for indexing to ES and writing avro
-	bounds = get_job_db_bounds(job)
-	sqldf = spark.read.jdbc(
+	# pre-assign DB ids, writing them explicitly, such that records need not be read back from DB
+	if settings.SPARK_PREASSIGN_RECORD_IDS or settings.RECORD_STORAGE_BACKEND == 'parquet':
+
+		# reserve block of ids, and assign with zipWithIndex plus offset, positions stable as records are persisted
+		record_count = records_df_combine_cols.count()
+		start_id = reserve_record_ids(record_count)
+		records_df_with_ids = spark.createDataFrame(
+			records_df_combine_cols.rdd.zipWithIndex().map(lambda row: (start_id + row[1],) + tuple(row[0])),
+			schema=StructType([StructField('id', LongType(), False)] + records_df_combine_cols.schema.fields)
+		)
+
+		# write avro, coalescing for output, with manifest of record count
+		if write_avro:
+			records_df_with_ids.select(CombineRecordSchema().field_names).coalesce(settings.SPARK_REPARTITION)\
+			.write.format("com.databricks.spark.avro").save(job.job_output)
+			write_job_output_manifest(job, record_count)
+
+		# parquet record store, write records partitioned by job, and only slim index of records to DB
+		if settings.RECORD_STORAGE_BACKEND == 'parquet':
+			records_df_with_ids.write.partitionBy('job_id').parquet(settings.RECORD_STORAGE_PARQUET_PATH, mode='append')
+			db_index_df = records_df_with_ids.select(['id','record_id','job_id','success','unique','document_hash'])
+		else:
+			db_index_df = records_df_with_ids
+
+		# write records to DB, with ids, once
+		append_records_jdbc(job, db_index_df, record_count)
+
+		# persist successful records as job working set for indexing to ES and validation
+		db_records = records_df_with_ids.filter(records_df_with_ids.success == 1)\
+			.persist(getattr(StorageLevel, settings.SPARK_WORKING_SET_STORAGE_LEVEL))
+		db_records.count()
+		unique_df.unpersist()
+
+	else:
+
+		# write avro, coalescing for output, with manifest of record count
+		if write_avro:
+			records_df_combine_cols.coalesce(settings.SPARK_REPARTITION)\
+			.write.format("com.databricks.spark.avro").save(job.job_output)
+			write_job_output_manifest(job, records_df_combine_cols.count())
+
+		# write records to DB
+		records_df_combine_cols.write.jdbc(
 			settings.COMBINE_DATABASE['jdbc_url'],
 			'core_record',
 			properties=settings.COMBINE_DATABASE,
-			column='id',
-			lowerBound=bounds['lowerBound'],
-			upperBound=bounds['upperBound'],
-			numPartitions=settings.SPARK_REPARTITION
-		)
-	job_id = job.id
-	db_records = sqldf.filter(sqldf.job_id == job_id).filter(sqldf.success == 1)
+			mode='append')
+
+		# read rows from DB once, with DB assigned ids, as job working set for indexing to ES and validation
+		sqldf = read_jdbc_records(spark, [job.id])
+		db_records = sqldf.filter(sqldf.success == 1)\
+			.persist(getattr(StorageLevel, settings.SPARK_WORKING_SET_STORAGE_LEVEL))
+		unique_df.unpersist()
 
 	# index to ElasticSearch
 	if index_records and settings.INDEX_TO_ES:
@@ -850,25 +1429,606 @@ def save_records(spark=None, kwargs=None, job=None, records_df=None, write_avro=
 			index_mapper=kwargs['index_mapper']
 		)
 
-	# return db_records for later use
+	# return db_records for later use, caller is responsible for unpersisting when job finishes
 	return db_records
 
 
-def get_job_db_bounds(job):
+def mark_unique_records(spark, job, records_df):
+
+	'''
+	Function to set 'unique' column, 1 if record_id occurs once among records, 0 otherwise
+
+	Only the record_id column is aggregated, to the set of duplicate keys, which is broadcast when its size in bytes
+	is at or below SPARK_UNIQUENESS_BROADCAST_BYTES, and joined back to records on key.  Elapsed time and shuffle bytes
+	of the aggregation are saved to job_details as 'uniqueness_metrics'.  Records should be persisted by caller, as
+	they are read by both the aggregation and the join.
+
+	Args:
+		spark (pyspark.sql.session.SparkSession): spark instance from static job methods
+		job (core.models.Job): Job instance
+		records_df (pyspark.sql.DataFrame): records as pyspark DataFrame
+
+	Returns:
+		(pyspark.sql.DataFrame): records with 'unique' column, persisted, caller is responsible for unpersisting
+	'''
+
+	sc = spark.sparkContext
+	job_group = 'combine_uniqueness_j%s' % job.id
+	stime = time.time()
+
+	# aggregate duplicate record_ids, tagging Spark jobs with group to retrieve metrics
+	sc.setJobGroup(job_group, 'uniqueness check for Job %s' % job.id)
+	dup_ids = records_df.groupBy('record_id').count()\
+		.filter(pyspark_sql_functions.col('count') > 1)\
+		.select(pyspark_sql_functions.col('record_id').alias('dup_record_id'))\
+		.persist()
+
+	# count duplicate keys and their size in UTF-8 bytes, materializing persisted keys
+	dup_count, dup_bytes = dup_ids.agg(
+		pyspark_sql_functions.count(pyspark_sql_functions.lit(1)),
+		pyspark_sql_functions.sum(pyspark_sql_functions.length(pyspark_sql_functions.encode('dup_record_id', 'UTF-8')))
+	).first()
+	dup_bytes = dup_bytes or 0
+	sc.setLocalProperty('spark.jobGroup.id', None)
+
+	# broadcast duplicate keys when small in bytes
+	broadcast = dup_bytes <= settings.SPARK_UNIQUENESS_BROADCAST_BYTES
+	if broadcast:
+		dup_ids_join = pyspark_sql_functions.broadcast(dup_ids)
+	else:
+		dup_ids_join = dup_ids
+
+	# join back on key, null safe to match previous grouping of null record_ids
+	if 'unique' in records_df.columns:
+		records_df = records_df.drop('unique')
+	records_df = records_df.join(dup_ids_join, records_df.record_id.eqNullSafe(dup_ids_join.dup_record_id), 'left')
+	records_df = records_df.withColumn('unique', records_df.dup_record_id.isNull().cast('integer')).drop('dup_record_id')
+
+	# save metrics to job
+	uniqueness_metrics = {
+		'elapsed':round(time.time() - stime, 3),
+		'duplicate_record_ids':dup_count,
+		'duplicate_record_id_bytes':dup_bytes,
+		'broadcast':broadcast
+	}
+	uniqueness_metrics.update(get_spark_job_group_metrics(spark, job_group))
+	job.update_job_details({'uniqueness_metrics':uniqueness_metrics})
+
+	# materialize records with join, before releasing duplicate keys
+	records_df = records_df.persist(getattr(StorageLevel, settings.SPARK_WORKING_SET_STORAGE_LEVEL))
+	records_df.count()
+	dup_ids.unpersist()
+
+	return records_df
+
+
+def get_spark_job_group_metrics(spark, job_group):
+
+	'''
+	Function to sum shuffle metrics of all stages run for a Spark job group, from Spark's monitoring REST API
+
+	Args:
+		spark (pyspark.sql.session.SparkSession): spark instance from static job methods
+		job_group (str): Spark job group id
+
+	Returns:
+		(dict): shuffle_read_bytes and shuffle_write_bytes, or empty dict if Spark UI not available
+	'''
+
+	sc = spark.sparkContext
+
+	try:
+
+		api_url = '%s/api/v1/applications/%s' % (sc.uiWebUrl.rstrip('/'), sc.applicationId)
+
+		# get stage ids for job group
+		stage_ids = set()
+		for spark_job in requests.get('%s/jobs' % api_url, timeout=10).json():
+			if spark_job.get('jobGroup') == job_group:
+				stage_ids.update(spark_job['stageIds'])
+
+		# sum shuffle bytes across stage attempts
+		metrics = {
+			'shuffle_read_bytes':0,
+			'shuffle_write_bytes':0
+		}
+		for stage_id in stage_ids:
+			for stage_attempt in requests.get('%s/stages/%s' % (api_url, stage_id), timeout=10).json():
+				metrics['shuffle_read_bytes'] += stage_attempt.get('shuffleReadBytes', 0)
+				metrics['shuffle_write_bytes'] += stage_attempt.get('shuffleWriteBytes', 0)
+		return metrics
+
+	except Exception as e:
+		print('could not retrieve metrics for Spark job group %s: %s' % (job_group, str(e)))
+		return {}
+
+
+def read_job_records(spark, input_job_ids):
+
+	'''
+	Function to read records from one or more input jobs, from the record store set by RECORD_STORAGE_BACKEND.
+	With MySQL backend, input jobs are read from their Avro output when verified complete against the job's
+	manifest, falling back to JDBC otherwise.
+
+	Args:
+		spark (pyspark.sql.session.SparkSession): spark instance from static job methods
+		input_job_ids (list): list of input Job ids
+
+	Returns:
+		(pyspark.sql.DataFrame): records from input jobs
+	'''
+
+	input_job_ids = [ int(input_job_id) for input_job_id in input_job_ids ]
+
+	# parquet, filter on partition column prunes read to directories of input jobs
+	if settings.RECORD_STORAGE_BACKEND == 'parquet':
+		records = spark.read.option('mergeSchema', 'true').parquet(settings.RECORD_STORAGE_PARQUET_PATH)
+		return with_document_hash(records.filter(records.job_id.isin(input_job_ids)))
+
+	# Avro output of input jobs, where present and verified against manifest
+	input_jobs_dfs = []
+	jdbc_job_ids = []
+	for input_job_id in input_job_ids:
+		avro_files = None
+		if settings.SPARK_READ_AVRO_INPUT:
+			avro_files = get_verified_job_output_files(Job.objects.get(pk=input_job_id))
+		if avro_files:
+			input_jobs_dfs.append(spark.read.format('com.databricks.spark.avro').load(avro_files))
+		else:
+			jdbc_job_ids.append(input_job_id)
+
+	# MySQL, for remaining input jobs
+	if len(jdbc_job_ids) > 0:
+		input_jobs_dfs.append(read_jdbc_records(spark, jdbc_job_ids))
+
+	# align to Combine Record schema, such that Avro and DB sources union by position
+	combine_schema = CombineRecordSchema().schema
+	input_jobs_dfs = [ with_document_hash(df) for df in input_jobs_dfs ]
+	input_jobs_dfs = [
+		df.select([ df[f.name].cast(f.dataType).alias(f.name) for f in combine_schema.fields ])
+		for df in input_jobs_dfs
+	]
+	return reduce(lambda df_a, df_b: df_a.union(df_b), input_jobs_dfs)
+
+
+def merge_incremental_harvest(spark, job, records_df, previous_job_id, deleted_ids_df=None, from_date=None):
+
+	'''
+	Function to compare records of an incremental OAI harvest against records of the previous harvest, by MD5 hash
+	of document per record_id.  Only new or changed records are kept from the harvest.  If
+	OAI_HARVEST_INCREMENTAL_CARRY_FORWARD, all other records of the previous harvest, less those reported deleted,
+	are copied from the previous job's record store, such that the job remains a complete snapshot of the endpoint.
+	Counts are saved to job_details as 'incremental_harvest'.  Caller should persist records_df, as it is read
+	more than once.
+
+	Args:
+		spark (pyspark.sql.session.SparkSession): spark instance from static job methods
+		job (core.models.Job): Job instance
+		records_df (pyspark.sql.DataFrame): harvested records, with record_id and document
+		previous_job_id (int): Job ID of previous harvest
+		deleted_ids_df (pyspark.sql.DataFrame): record_ids reported deleted by harvest, or None
+		from_date (str): OAI-PMH datestamp harvested from, for job_details
+
+	Returns:
+		(pyspark.sql.DataFrame): records to save for job, with columns of records_df
+	'''
+
+	# document hashes of previous harvest, successful records only
+	previous_df = read_job_records(spark, [previous_job_id])
+	previous_df = previous_df.filter(previous_df.success == True)
+	previous_hashes = previous_df.select(
+		previous_df.record_id.alias('previous_record_id'),
+		previous_df.document_hash.alias('previous_hash'))
+
+	# classify harvested records as new, changed, or unchanged
+	harvested = records_df.withColumn('document_hash', pyspark_sql_functions.md5(records_df.document))
+	harvested = harvested.join(
+		previous_hashes,
+		harvested.record_id == previous_hashes.previous_record_id,
+		'left')
+	harvested = harvested.withColumn('incremental_status',
+		pyspark_sql_functions.when(harvested.previous_hash.isNull(), 'new')\
+		.when(harvested.previous_hash != harvested.document_hash, 'changed')\
+		.otherwise('unchanged'))
+	incremental_counts = { row['incremental_status']:row['count'] for row in harvested.groupBy('incremental_status').count().collect() }
+
+	# keep only new or changed records from harvest
+	changed = harvested.filter(harvested.incremental_status != 'unchanged').select(records_df.columns)
+
+	# carry forward all other records from previous harvest, less those deleted, as records of this job
+	deleted_count = 0
+	if settings.OAI_HARVEST_INCREMENTAL_CARRY_FORWARD:
+		carried = previous_df.join(
+			changed.select(changed.record_id.alias('changed_record_id')),
+			previous_df.record_id == pyspark_sql_functions.col('changed_record_id'),
+			'left_anti')
+		if deleted_ids_df is not None:
+			deleted_count = deleted_ids_df.count()
+			carried = carried.join(
+				deleted_ids_df.select(deleted_ids_df.record_id.alias('deleted_record_id')),
+				carried.record_id == pyspark_sql_functions.col('deleted_record_id'),
+				'left_anti')
+		carried = carried.withColumn('job_id', pyspark_sql_functions.lit(job.id))
+
+		# align to harvested records, by name and type
+		changed_types = dict(changed.dtypes)
+		carried = carried.select([
+			pyspark_sql_functions.col(col).cast(changed_types[col]).alias(col) if col in carried.columns
+			else pyspark_sql_functions.lit(None).cast(changed_types[col]).alias(col)
+			for col in changed.columns
+		])
+		records_df = changed.union(carried)
+	else:
+		records_df = changed
+
+	# save counts to job details
+	job.update_job_details({'incremental_harvest':{
+		'previous_job_id':previous_job_id,
+		'from_date':from_date,
+		'new':incremental_counts.get('new', 0),
+		'changed':incremental_counts.get('changed', 0),
+		'unchanged':incremental_counts.get('unchanged', 0),
+		'deleted':deleted_count,
+		'carry_forward':settings.OAI_HARVEST_INCREMENTAL_CARRY_FORWARD
+	}})
+
+	return records_df
+
+
+def with_document_hash(records_df):
+
+	'''
+	Function to ensure document_hash column, computing MD5 of document for records written before the column
+	existed, or not yet backfilled
+
+	Args:
+		records_df (pyspark.sql.DataFrame): records
+
+	Returns:
+		(pyspark.sql.DataFrame): records with document_hash column
+	'''
+
+	document_md5 = pyspark_sql_functions.md5(records_df.document)
+	if 'document_hash' in records_df.columns:
+		return records_df.withColumn('document_hash', pyspark_sql_functions.coalesce(records_df.document_hash, document_md5))
+	return records_df.withColumn('document_hash', document_md5)
+
+
+def dedupe_identical_records(records_df):
+
+	'''
+	Function to drop records identical to another, by record_id, document_hash, and success, when
+	SPARK_DEDUPE_IDENTICAL_RECORDS, such that overlapping input jobs do not produce duplicate records
+
+	Args:
+		records_df (pyspark.sql.DataFrame): records, with document_hash
+
+	Returns:
+		(pyspark.sql.DataFrame): records without identical duplicates
+	'''
+
+	if not settings.SPARK_DEDUPE_IDENTICAL_RECORDS:
+		return records_df
+	return records_df.dropDuplicates(['record_id','document_hash','success'])
+
+
+def get_oai_harvest_dir(job):
+
+	'''
+	Function to return location on disk of native OAI harvester shards and checkpoints for job, such that a
+	re-run of an interrupted job resumes the harvest
+	'''
+
+	return '%s/oai_harvest/j%s' % (settings.BINARY_STORAGE.split('file://')[-1].rstrip('/'), job.id)
 
+
+def write_job_output_manifest(job, record_count):
+
+	'''
+	Function to write manifest of Avro files and record count to job output, such that downstream jobs
+	can verify the Avro output is complete before reading it as input
+
+	Args:
+		job (core.models.Job): Job instance
+		record_count (int): count of records written to Avro
+
+	Returns:
+		None
 	'''
-	Function to determine lower and upper bounds for job IDs, for more efficient MySQL retrieval
-	'''	
 
-	records = job.get_records()
-	records = records.order_by('id')
-	start_id = records.first().id
-	end_id = records.last().id
+	# only local filesystem output supported
+	if not job.job_output.startswith('file://'):
+		return None
 
-	return {
-		'lowerBound':start_id,
-		'upperBound':end_id
+	manifest = {
+		'job_id':job.id,
+		'record_count':record_count,
+		'files':sorted([ os.path.basename(f) for f in job.get_output_files() ]),
+		'timestamp':datetime.datetime.now().isoformat()
 	}
+	with open(os.path.join(job.job_output_as_filesystem(), '_combine_manifest.json'), 'w') as f:
+		f.write(json.dumps(manifest))
+
+
+def get_verified_job_output_files(job):
+
+	'''
+	Function to return Avro files from job output, if complete:
+		- Spark _SUCCESS marker and manifest present
+		- Avro files match those listed in manifest
+		- records counted from Avro block headers match record count in manifest
+
+	Args:
+		job (core.models.Job): Job instance
+
+	Returns:
+		(list, None): list of Avro file paths, prefixed with file://, or None if not present or not complete
+	'''
+
+	# only local filesystem output supported
+	if job.job_output is None or not job.job_output.startswith('file://'):
+		return None
+
+	output_dir = job.job_output_as_filesystem()
+	manifest_path = os.path.join(output_dir, '_combine_manifest.json')
+	if not os.path.exists(os.path.join(output_dir, '_SUCCESS')) or not os.path.exists(manifest_path):
+		return None
+
+	try:
+
+		# read manifest
+		with open(manifest_path, 'r') as f:
+			manifest = json.loads(f.read())
+
+		# confirm files match
+		avro_files = sorted(job.get_output_files())
+		if [ os.path.basename(f) for f in avro_files ] != manifest['files']:
+			return None
+
+		# confirm record count
+		if sum([ count_avro_records(f) for f in avro_files ]) != manifest['record_count']:
+			return None
+
+	except Exception as e:
+		print('could not verify avro output for job %s: %s' % (job.id, str(e)))
+		return None
+
+	return [ 'file://%s' % f for f in avro_files ]
+
+
+def count_avro_records(filepath):
+
+	'''
+	Function to count records in Avro container file from block headers, without decoding records
+
+	Args:
+		filepath (str): location of Avro file on disk
+
+	Returns:
+		(int): count of records
+	'''
+
+	def read_long(f):
+
+		# zig-zag encoded variable length long, None at end of file
+		b = f.read(1)
+		if b == b'':
+			return None
+		b = ord(b)
+		n = b & 0x7f
+		shift = 7
+		while b & 0x80:
+			b = ord(f.read(1))
+			n |= (b & 0x7f) << shift
+			shift += 7
+		return (n >> 1) ^ -(n & 1)
+
+	with open(filepath, 'rb') as f:
+
+		# header: magic, metadata map, sync marker
+		if f.read(4) != b'Obj\x01':
+			raise Exception('not an Avro container file: %s' % filepath)
+		while True:
+			map_count = read_long(f)
+			if map_count == 0:
+				break
+			if map_count < 0:
+				read_long(f)
+				map_count = -map_count
+			for i in range(map_count):
+				f.seek(read_long(f), 1) # key
+				f.seek(read_long(f), 1) # value
+		f.seek(16, 1)
+
+		# data blocks: record count, byte size, data, sync marker
+		record_count = 0
+		while True:
+			block_count = read_long(f)
+			if block_count is None:
+				break
+			record_count += block_count
+			f.seek(read_long(f) + 16, 1)
+
+	return record_count
+
+
+def reserve_record_ids(count):
+
+	'''
+	Function to reserve a contiguous block of ids from core_record, such that records can be written with ids
+	assigned in Spark.
+
+	Blocks are allocated from the single row of core_record_id_seq, in one atomic UPDATE that also moves past the
+	highest id written, such that concurrent jobs never receive overlapping blocks.  The row lock is held only for
+	the statement, and core_record itself is not locked or altered.  Ids written explicitly move InnoDB's
+	AUTO_INCREMENT past them, but rows inserted without ids while a block is reserved and not yet written may claim
+	ids in the block, so all writes to core_record should pre-assign ids when SPARK_PREASSIGN_RECORD_IDS is set.
+
+	Args:
+		count (int): number of ids to reserve
+
+	Returns:
+		(int): first id of reserved block, block spanning [start_id, start_id + count)
+	'''
+
+	with connection.cursor() as cursor:
+
+		# move next id past block, from greater of next id and highest id written
+		cursor.execute(
+			'UPDATE core_record_id_seq SET next_id = LAST_INSERT_ID(GREATEST(next_id, (SELECT COALESCE(MAX(id), 0) + 1 FROM core_record)) + %s)',
+			[count])
+		if cursor.rowcount != 1:
+			raise Exception('could not reserve core_record ids, core_record_id_seq is not initialized')
+
+		# next id after block, from this connection's LAST_INSERT_ID()
+		cursor.execute('SELECT LAST_INSERT_ID()')
+		start_id = cursor.fetchone()[0] - count
+
+	return start_id
+
+
+def append_records_jdbc(job, records_df, record_count, batch_size=100000):
+
+	'''
+	Function to write records with pre-assigned ids to core_record once, such that Spark task retries do not
+	write rows twice.
+
+	Records are appended through JDBC to a staging table without keys, where rows of a retried task may repeat,
+	then copied to core_record in ranges of ids with INSERT ... SELECT, skipping ids already written.
+
+	Args:
+		job (core.models.Job): Job instance
+		records_df (pyspark.sql.DataFrame): records, with ids, in columns of core_record
+		record_count (int): count of records, to confirm each id was written once
+		batch_size (int): ids copied per INSERT ... SELECT
+
+	Returns:
+		None
+	'''
+
+	stage_table = 'core_record_stage_j%s' % job.id
+	columns = ', '.join([ '`%s`' % column for column in records_df.columns ])
+
+	# create staging table with columns of core_record, without keys, indexed on id for copy
+	with connection.cursor() as cursor:
+		cursor.execute('DROP TABLE IF EXISTS %s' % stage_table)
+		cursor.execute('CREATE TABLE %s AS SELECT %s FROM core_record LIMIT 0' % (stage_table, columns))
+		cursor.execute('ALTER TABLE %s ADD INDEX (id)' % stage_table)
+
+	try:
+
+		# append records to staging table
+		records_df.write.jdbc(
+			settings.COMBINE_DATABASE['jdbc_url'],
+			stage_table,
+			properties=settings.COMBINE_DATABASE,
+			mode='append')
+
+		# copy to core_record by id range, repeated rows updating nothing
+		with connection.cursor() as cursor:
+			cursor.execute('SELECT MIN(id), MAX(id) FROM %s' % stage_table)
+			min_id, max_id = cursor.fetchone()
+			written = 0
+			if min_id is not None:
+				for lower in range(min_id, max_id + 1, batch_size):
+					cursor.execute(
+						'INSERT INTO core_record (%s) SELECT %s FROM %s WHERE id >= %s AND id < %s ON DUPLICATE KEY UPDATE core_record.id = core_record.id' % (
+							columns, columns, stage_table, lower, lower + batch_size))
+
+				# count rows of job in id range
+				cursor.execute('SELECT COUNT(*) FROM core_record WHERE id BETWEEN %s AND %s AND job_id = %s', [min_id, max_id, job.id])
+				written = cursor.fetchone()[0]
+
+	finally:
+		with connection.cursor() as cursor:
+			cursor.execute('DROP TABLE IF EXISTS %s' % stage_table)
+
+	# ids already present in core_record would be skipped, fail loudly
+	if written != record_count:
+		raise Exception('wrote %s of %s records to core_record, ids of reserved block were already taken' % (written, record_count))
+
+
+def read_jdbc_records(spark, job_ids):
+
+	'''
+	Function to read records of one or more jobs from core_record, partitioned by plan_jdbc_partitions()
+
+	Args:
+		spark (pyspark.sql.session.SparkSession): spark instance from static job methods
+		job_ids (list): list of Job ids
+
+	Returns:
+		(pyspark.sql.DataFrame): records from jobs
+	'''
+
+	return spark.read.jdbc(
+			settings.COMBINE_DATABASE['jdbc_url'],
+			'core_record',
+			predicates=plan_jdbc_partitions(job_ids),
+			properties=settings.COMBINE_DATABASE
+		)
+
+
+def plan_jdbc_partitions(job_ids, histogram_buckets=1000):
+
+	'''
+	Function to plan balanced partitions of core_record for jdbc reader, from the actual ids of the jobs' records.
+
+	Ids of jobs are often interleaved with other jobs, such that equal width ranges between min and max id return
+	empty or skewed partitions.  Instead, a single MIN/MAX/COUNT aggregate sizes the partition count from the record
+	count, and a histogram of record counts per id bucket, read in one pass over the job_id index, places partition
+	boundaries at roughly equal counts.  Each partition predicate includes job_id, such that MySQL filters rows,
+	not Spark.
+
+	Args:
+		job_ids (list): list of Job ids
+		histogram_buckets (int): approximate number of id buckets counted, setting precision of boundaries
+
+	Returns:
+		(list): WHERE clause predicates, one per partition
+	'''
+
+	job_ids_sql = ','.join([ str(int(job_id)) for job_id in job_ids ])
+	job_predicate = 'job_id IN (%s)' % job_ids_sql
+
+	with connection.cursor() as cursor:
+
+		# single aggregate for bounds and count
+		cursor.execute('SELECT MIN(id), MAX(id), COUNT(*) FROM core_record WHERE %s' % job_predicate)
+		min_id, max_id, record_count = cursor.fetchone()
+
+		# size partition count from record count, bounded by JDBC_NUMPARTITIONS
+		num_partitions = max(1, min(settings.JDBC_NUMPARTITIONS, -(-record_count // settings.JDBC_RECORDS_PER_PARTITION)))
+		if num_partitions == 1:
+			return [job_predicate]
+
+		# histogram of record counts per id bucket, in one pass
+		bucket_width = max(1, (max_id - min_id + 1) // histogram_buckets)
+		cursor.execute('SELECT id DIV %s AS bucket, COUNT(*) FROM core_record WHERE %s GROUP BY bucket ORDER BY bucket' % (
+			bucket_width, job_predicate))
+		histogram = cursor.fetchall()
+
+	# boundaries at start of bucket where cumulative count reaches next quantile
+	boundaries = []
+	cumulative = 0
+	for bucket, bucket_count in histogram:
+		if cumulative >= (record_count * (len(boundaries) + 1)) // num_partitions:
+			boundary = bucket * bucket_width
+			if boundary > min_id and (len(boundaries) == 0 or boundary > boundaries[-1]):
+				boundaries.append(boundary)
+		cumulative += bucket_count
+		if len(boundaries) == num_partitions - 1:
+			break
+
+	# predicates, ranges spanning min to max id
+	predicates = []
+	lower = min_id
+	for boundary in boundaries:
+		predicates.append('%s AND id >= %s AND id < %s' % (job_predicate, lower, boundary))
+		lower = boundary
+	predicates.append('%s AND id >= %s AND id <= %s' % (job_predicate, lower, max_id))
+
+	return predicates
 
 
 
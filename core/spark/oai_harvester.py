@@ -0,0 +1,475 @@
+# imports
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import datetime
+import django
+import hashlib
+import json
+from lxml import etree
+import os
+import requests
+from requests.adapters import HTTPAdapter
+import sys
+import threading
+from urllib3.util.retry import Retry
+
+# check for registered apps signifying readiness, if not, run django.setup() to run as standalone
+if not hasattr(django, 'apps'):
+	os.environ['DJANGO_SETTINGS_MODULE'] = 'combine.settings'
+	sys.path.append('/opt/combine')
+	django.setup()
+
+# import django settings
+from django.conf import settings
+
+
+# OAI-PMH namespace
+OAI_NS = '{http://www.openarchives.org/OAI/2.0/}'
+
+
+
+class OAIHarvestError(Exception):
+	pass
+
+
+
+class OAIHarvester(object):
+
+	'''
+	Native, parallel, resumable OAI-PMH harvester, as an alternative to the DPLA Ingestion3 OAI data source.
+
+	Harvesting is planned as tasks, one per OAI set in scope, and run with a bounded thread pool sharing a
+	pooled HTTP session.  When the first page of a set reports a completeListSize above OAI_HARVEST_WINDOW_THRESHOLD,
+	the set is split into date windows, from from_date or the repository's earliestDatestamp to the current UTC date,
+	each harvested as its own task, with the last window open-ended to include records dated later.
+
+	Each task writes records to its own shard of JSON lines in output_dir, one line per record with keys 'id',
+	'setIds', and 'document' (the OAI <record> element), and checkpoints the resumption token and shard offset to
+	disk after each page.  Running the harvester again with the same output_dir resumes, skipping completed tasks
+	and continuing interrupted tasks from their last checkpointed resumption token.
+
+	When from_date is set, as for incremental harvests, only records changed since from_date are requested, and
+	deleted records are written to shards with 'deleted' true and no document, such that they may be removed
+	from records carried forward from a previous harvest.
+
+	Args:
+		endpoint (str): OAI endpoint
+		metadataPrefix (str): metadataPrefix for OAI harvest
+		scope_type (str): [setList, whiteList, blackList, harvestAllSets]
+		scope_value (str): comma separated sets for scope_type
+		output_dir (str): directory on disk for shards and checkpoints
+		from_date (str): optional OAI-PMH datestamp, harvesting only records changed since
+		thread_count (int): concurrent requests, defaults to settings.OAI_HARVEST_THREAD_COUNT
+		window_threshold (int): completeListSize above which sets are split into date windows,
+			defaults to settings.OAI_HARVEST_WINDOW_THRESHOLD, 0 to never split
+		windows_per_set (int): date windows per split set, defaults to settings.OAI_HARVEST_WINDOWS_PER_SET
+		timeout (int): seconds for each request, defaults to settings.OAI_HARVEST_TIMEOUT
+		retries (int): retries for failed requests, defaults to settings.OAI_HARVEST_RETRIES
+	'''
+
+	def __init__(self,
+		endpoint=None,
+		metadataPrefix=None,
+		scope_type=None,
+		scope_value=None,
+		output_dir=None,
+		from_date=None,
+		thread_count=None,
+		window_threshold=None,
+		windows_per_set=None,
+		timeout=None,
+		retries=None):
+
+		self.endpoint = endpoint
+		self.metadataPrefix = metadataPrefix
+		self.scope_type = scope_type
+		self.scope_value = scope_value
+		self.output_dir = output_dir
+		self.from_date = from_date
+		self.checkpoint_dir = os.path.join(self.output_dir, '_checkpoints')
+
+		# tuning, defaulting to settings
+		self.thread_count = thread_count if thread_count is not None else settings.OAI_HARVEST_THREAD_COUNT
+		self.window_threshold = window_threshold if window_threshold is not None else settings.OAI_HARVEST_WINDOW_THRESHOLD
+		self.windows_per_set = windows_per_set if windows_per_set is not None else settings.OAI_HARVEST_WINDOWS_PER_SET
+		self.timeout = timeout if timeout is not None else settings.OAI_HARVEST_TIMEOUT
+		retries = retries if retries is not None else settings.OAI_HARVEST_RETRIES
+
+		# pooled HTTP session, shared by all threads
+		self.session = requests.Session()
+		adapter = HTTPAdapter(
+			pool_connections=1,
+			pool_maxsize=self.thread_count,
+			max_retries=Retry(
+				total=retries,
+				backoff_factor=1,
+				status_forcelist=[500, 502, 503, 504],
+				respect_retry_after_header=True))
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+		# plan of tasks, keyed by task key
+		self.plan = {}
+		self.plan_lock = threading.Lock()
+		self.identify = None
+
+
+	def harvest(self):
+
+		'''
+		Run harvest, resuming from checkpoints in output_dir if present
+
+		Args:
+			None
+
+		Returns:
+			(dict): summary of harvest, with count of tasks, records, deleted records, and shard files
+		'''
+
+		os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+		# load plan if resuming, else plan tasks from scope
+		plan_path = os.path.join(self.output_dir, '_plan.json')
+		if os.path.exists(plan_path):
+			with open(plan_path, 'r') as f:
+				self.plan = json.loads(f.read())
+		else:
+			for oai_set in self.get_scope_sets():
+				self.add_task(oai_set, self.from_date)
+
+		# run tasks with bounded thread pool, submitting date window tasks as sets are split
+		with ThreadPoolExecutor(max_workers=self.thread_count) as pool:
+			pending = { pool.submit(self.harvest_task, task_key) for task_key in list(self.plan.keys()) }
+			while len(pending) > 0:
+				done, pending = wait(pending, return_when=FIRST_COMPLETED)
+				for future in done:
+					for task_key in future.result():
+						pending.add(pool.submit(self.harvest_task, task_key))
+
+		# summarize from checkpoints
+		summary = {
+			'tasks':0,
+			'records':0,
+			'deleted':0,
+			'shards':[]
+		}
+		for task_key in self.plan.keys():
+			checkpoint = self.load_checkpoint(task_key)
+			if checkpoint['split']:
+				continue
+			summary['tasks'] += 1
+			summary['records'] += checkpoint['records']
+			summary['deleted'] += checkpoint['deleted']
+			summary['shards'].append(self.shard_path(task_key))
+		return summary
+
+
+	def get_scope_sets(self):
+
+		'''
+		Return list of OAI sets to harvest for scope_type and scope_value, None harvesting without a set
+
+		Returns:
+			(list)
+		'''
+
+		scope_sets = [ s.strip() for s in (self.scope_value or '').split(',') if s.strip() != '' ]
+
+		if self.scope_type in ['setList', 'whiteList']:
+			return scope_sets
+
+		elif self.scope_type in ['blackList', 'harvestAllSets']:
+			all_sets = self.list_sets()
+
+			# repository without sets, harvest all records
+			if all_sets is None:
+				return [None]
+
+			if self.scope_type == 'blackList':
+				return [ s for s in all_sets if s not in scope_sets ]
+			return all_sets
+
+		else:
+			raise OAIHarvestError('scope_type not recognized: %s' % self.scope_type)
+
+
+	def list_sets(self):
+
+		'''
+		Return all setSpecs from ListSets, following resumption tokens, or None if repository has no sets
+		'''
+
+		all_sets = []
+		params = {'verb':'ListSets'}
+		while True:
+			root, error_code = self.request(params)
+			if error_code == 'noSetHierarchy':
+				return None
+			all_sets.extend([ s.text for s in root.iter('%ssetSpec' % OAI_NS) ])
+			token = self.get_resumption_token(root)
+			if token is None:
+				return all_sets
+			params = {'verb':'ListSets', 'resumptionToken':token}
+
+
+	def request(self, params):
+
+		'''
+		Issue OAI-PMH request
+
+		Args:
+			params (dict): OAI-PMH request parameters
+
+		Returns:
+			(tuple): parsed response root, OAI-PMH error code or None
+		'''
+
+		response = self.session.get(self.endpoint, params=params, timeout=self.timeout)
+		response.raise_for_status()
+		root = etree.fromstring(response.content)
+
+		# check for OAI-PMH error
+		error_node = root.find('%serror' % OAI_NS)
+		if error_node is not None:
+			error_code = error_node.attrib.get('code')
+			if error_code not in ['noRecordsMatch', 'noSetHierarchy', 'badResumptionToken']:
+				raise OAIHarvestError('OAI-PMH error %s: %s' % (error_code, error_node.text))
+			return (root, error_code)
+
+		return (root, None)
+
+
+	@staticmethod
+	def get_resumption_token(root):
+
+		'''
+		Return resumption token from response, or None if list is complete
+		'''
+
+		token_node = root.find('.//%sresumptionToken' % OAI_NS)
+		if token_node is not None and token_node.text and token_node.text.strip() != '':
+			return token_node.text.strip()
+		return None
+
+
+	@staticmethod
+	def get_complete_list_size(root):
+
+		'''
+		Return completeListSize from response resumption token, or None if not reported
+		'''
+
+		token_node = root.find('.//%sresumptionToken' % OAI_NS)
+		if token_node is not None and token_node.attrib.get('completeListSize', '').isdigit():
+			return int(token_node.attrib['completeListSize'])
+		return None
+
+
+	def add_task(self, oai_set, from_date=None, until_date=None, windowed=False):
+
+		'''
+		Add task to plan, saving plan to disk
+
+		Args:
+			oai_set (str): OAI set, or None for all records
+			from_date (str): optional from datestamp
+			until_date (str): optional until datestamp
+			windowed (bool): task is a date window of a split set, and is not split again
+
+		Returns:
+			(str): task key
+		'''
+
+		task = {'set':oai_set, 'from':from_date, 'until':until_date, 'windowed':windowed}
+		task_key = hashlib.md5(json.dumps(task, sort_keys=True).encode('utf-8')).hexdigest()
+		with self.plan_lock:
+			self.plan[task_key] = task
+			self.write_json(os.path.join(self.output_dir, '_plan.json'), self.plan)
+		return task_key
+
+
+	def shard_path(self, task_key):
+		return os.path.join(self.output_dir, 'records_%s.jsonl' % task_key)
+
+
+	def load_checkpoint(self, task_key):
+
+		'''
+		Return checkpoint for task, or new checkpoint if not yet started
+		'''
+
+		checkpoint_path = os.path.join(self.checkpoint_dir, '%s.json' % task_key)
+		if os.path.exists(checkpoint_path):
+			with open(checkpoint_path, 'r') as f:
+				return json.loads(f.read())
+		return {'token':None, 'offset':0, 'records':0, 'deleted':0, 'complete':False, 'split':False}
+
+
+	def save_checkpoint(self, task_key, checkpoint):
+		self.write_json(os.path.join(self.checkpoint_dir, '%s.json' % task_key), checkpoint)
+
+
+	@staticmethod
+	def write_json(path, data):
+
+		'''
+		Write JSON atomically, such that an interrupted write does not corrupt checkpoint or plan
+		'''
+
+		with open('%s.tmp' % path, 'w') as f:
+			f.write(json.dumps(data))
+		os.replace('%s.tmp' % path, path)
+
+
+	def harvest_task(self, task_key):
+
+		'''
+		Harvest all pages for task, checkpointing after each page written to shard
+
+		Args:
+			task_key (str): key of task in plan
+
+		Returns:
+			(list): keys of new tasks, if task was split into date windows
+		'''
+
+		task = self.plan[task_key]
+		checkpoint = self.load_checkpoint(task_key)
+		if checkpoint['complete'] or checkpoint['split']:
+			return []
+
+		# open shard, truncating anything written after last checkpoint
+		shard_path = self.shard_path(task_key)
+		with open(shard_path, 'a+b') as shard:
+			shard.truncate(checkpoint['offset'])
+			shard.seek(checkpoint['offset'])
+
+			# resume from token, or begin list
+			if checkpoint['token'] is not None:
+				params = {'verb':'ListRecords', 'resumptionToken':checkpoint['token']}
+			else:
+				params = self.list_records_params(task)
+
+			while True:
+
+				root, error_code = self.request(params)
+
+				# expired token on resume, restart task
+				if error_code == 'badResumptionToken':
+					if checkpoint['token'] is None:
+						raise OAIHarvestError('badResumptionToken for task %s' % task)
+					checkpoint = {'token':None, 'offset':0, 'records':0, 'deleted':0, 'complete':False, 'split':False}
+					shard.truncate(0)
+					shard.seek(0)
+					params = self.list_records_params(task)
+					continue
+
+				# first page of large set, split into date windows
+				if checkpoint['token'] is None and checkpoint['offset'] == 0 and not task.get('windowed'):
+					new_task_keys = self.split_task(task, root)
+					if len(new_task_keys) > 0:
+						checkpoint['split'] = True
+						self.save_checkpoint(task_key, checkpoint)
+						return new_task_keys
+
+				# write page of records, with deleted records flagged and without document
+				page_count = 0
+				page_deleted = 0
+				if error_code != 'noRecordsMatch':
+					for record in root.iter('%srecord' % OAI_NS):
+						header = record.find('%sheader' % OAI_NS)
+						if header is None:
+							continue
+						line = {
+							'id':header.findtext('%sidentifier' % OAI_NS),
+							'setIds':[ s.text for s in header.findall('%ssetSpec' % OAI_NS) ]
+						}
+						if header.attrib.get('status') == 'deleted':
+							line.update({'document':None, 'deleted':True})
+							page_deleted += 1
+						else:
+							line['document'] = etree.tostring(record).decode('utf-8')
+							page_count += 1
+						shard.write(json.dumps(line).encode('utf-8'))
+						shard.write(b'\n')
+				shard.flush()
+
+				# checkpoint
+				token = self.get_resumption_token(root) if error_code is None else None
+				checkpoint['token'] = token
+				checkpoint['offset'] = shard.tell()
+				checkpoint['records'] += page_count
+				checkpoint['deleted'] += page_deleted
+				checkpoint['complete'] = token is None
+				self.save_checkpoint(task_key, checkpoint)
+
+				if token is None:
+					return []
+				params = {'verb':'ListRecords', 'resumptionToken':token}
+
+
+	def list_records_params(self, task):
+
+		'''
+		Return ListRecords request parameters for task
+		'''
+
+		params = {'verb':'ListRecords', 'metadataPrefix':self.metadataPrefix}
+		if task['set'] is not None:
+			params['set'] = task['set']
+		if task['from'] is not None:
+			params['from'] = task['from']
+		if task['until'] is not None:
+			params['until'] = task['until']
+		return params
+
+
+	def split_task(self, task, root):
+
+		'''
+		If first page reports completeListSize above threshold, split set into from/until date windows,
+		from task's from date, or else repository's earliestDatestamp, through the current UTC date, at day granularity.
+		The last window has no until, such that records dated after the current UTC date, or changed during
+		the harvest, are not missed.
+
+		Args:
+			task (dict): task to split
+			root (lxml.etree._Element): first page of task
+
+		Returns:
+			(list): keys of new tasks, empty if not split
+		'''
+
+		complete_list_size = self.get_complete_list_size(root)
+		if not self.window_threshold or complete_list_size is None or complete_list_size <= self.window_threshold:
+			return []
+
+		# start from task's from date, else earliestDatestamp from Identify, requested once
+		start_datestamp = task['from']
+		if start_datestamp is None:
+			with self.plan_lock:
+				if self.identify is None:
+					identify_root, error_code = self.request({'verb':'Identify'})
+					self.identify = {'earliestDatestamp':identify_root.findtext('.//%searliestDatestamp' % OAI_NS)}
+			start_datestamp = self.identify['earliestDatestamp']
+		if not start_datestamp:
+			return []
+
+		# windows of equal days
+		start = datetime.datetime.strptime(start_datestamp[:10], '%Y-%m-%d').date()
+		end = datetime.datetime.utcnow().date()
+		total_days = (end - start).days + 1
+		window_count = max(1, min(self.windows_per_set, total_days))
+		if window_count == 1:
+			return []
+		window_days = -(-total_days // window_count)
+
+		new_task_keys = []
+		window_start = start
+		while window_start <= end:
+			window_end = min(window_start + datetime.timedelta(days=window_days - 1), end)
+
+			# last window open-ended
+			until_date = window_end.isoformat() if window_end < end else None
+			new_task_keys.append(self.add_task(task['set'], window_start.isoformat(), until_date, windowed=True))
+			window_start = window_end + datetime.timedelta(days=1)
+		return new_task_keys
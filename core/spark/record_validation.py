@@ -1,4 +1,5 @@
 # imports
+import copy
 import django
 import hashlib
 from inspect import isfunction, signature
@@ -10,8 +11,9 @@ import sys
 from types import ModuleType
 
 # import Row from pyspark
+from pyspark import StorageLevel
 from pyspark.sql import Row
-from pyspark.sql.types import StringType, IntegerType
+from pyspark.sql.types import StringType, IntegerType, StructField, StructType
 from pyspark.sql.functions import udf
 
 # init django settings file to retrieve settings
@@ -22,7 +24,24 @@ from django.conf import settings
 from django.db import connection
 
 # import select models from Core
-from core.models import Job, ValidationScenario
+from core.models import Job, JobLineageGraph, JobValidation, ValidationScenario
+
+
+
+####################################################################
+# Dataframe Schemas 											   #
+####################################################################
+
+# Row and schema for validation failures, ordered positionally to skip schema inference
+RecordValidationRow = Row('record_id', 'validation_scenario_id', 'valid', 'results_payload', 'fail_count')
+RecordValidationSchema = StructType([
+		StructField('record_id', IntegerType(), False),
+		StructField('validation_scenario_id', IntegerType(), False),
+		StructField('valid', IntegerType(), False),
+		StructField('results_payload', StringType(), True),
+		StructField('fail_count', IntegerType(), True)
+	]
+)
 
 
 
@@ -81,6 +100,10 @@ class ValidationScenarioSpark(object):
 		Function to run validation scenarios
 		Results are written to RecordValidation table, one result, per record, per failed validation test.
 
+		All requested validation scenarios are run in a single pass over the records, with each scenario compiled
+		once per executor, and each record document parsed once and shared by all scenarios.  Python scenarios
+		validate their own copy of the parsed document, such that changes they make do not reach other scenarios.
+
 		Validation tests may be of type:
 			- 'sch': Schematron based validation, performed with lxml etree
 			- 'python': custom python code snippets
@@ -96,144 +119,226 @@ class ValidationScenarioSpark(object):
 		# refresh Django DB Connection
 		refresh_django_db_connection()
 
-		# loop through validation scenarios and fire validation type specific method
-		for vs_id in self.validation_scenarios:
+		# if no validation scenarios requested, skip
+		if len(self.validation_scenarios) == 0:
+			return None
+
+		# prepare validation scenarios as tuples, broadcast to executors
+		scenarios = [
+			(vs.id, vs.validation_type, vs.payload)
+			for vs in ValidationScenario.objects.filter(pk__in=self.validation_scenarios)
+		]
+		scenarios_bc = self.spark.sparkContext.broadcast(scenarios)
+
+		# run validation scenarios via mapPartitions, persisting failures such that records are validated once
+		validate_partition = self.validate_partition # must pass static method not attached to self
+		validation_fails_rdd = self.records_df.rdd.\
+			mapPartitions(lambda rows: validate_partition(rows, scenarios_bc.value))
+		validation_fails_df = self.spark.createDataFrame(validation_fails_rdd, schema=RecordValidationSchema)\
+			.persist(getattr(StorageLevel, settings.SPARK_WORKING_SET_STORAGE_LEVEL))
+
+		# write all validation failures to DB with single, batched append
+		validation_fails_df.write.jdbc(
+			settings.COMBINE_DATABASE['jdbc_url'],
+			'core_recordvalidation',
+			properties=dict(settings.COMBINE_DATABASE, batchsize=str(settings.JDBC_WRITE_BATCHSIZE)),
+			mode='append')
+
+		# count failed records per validation scenario, from persisted failures
+		failure_counts = { row['validation_scenario_id']:row['count'] for row in
+			validation_fails_df.groupBy('validation_scenario_id').count().collect() }
+		validation_fails_df.unpersist()
+
+		# set failure counts for JobValidations, avoiding later counts from RecordValidation table
+		for vs_id, vs_type, vs_payload in scenarios:
+			JobValidation.objects.filter(job=self.job, validation_scenario_id=vs_id)\
+			.update(failure_count=failure_counts.get(vs_id, 0))
+
+		# bulk updates do not send signals, invalidate job lineage graph
+		JobLineageGraph.invalidate()
 
-			# get validation scenario
-			vs = ValidationScenario.objects.get(pk=vs_id)
-			vs_id = vs.id
-			vs_filepath = vs.filepath
 
-			# schematron based validation scenario
-			if vs.validation_type == 'sch':
+	@staticmethod
+	def validate_partition(rows, scenarios):
 
-				# run udf map
-				udf_func = self.validate_schematron_udf # must pass static method not attached to self
-				validation_fails_rdd = self.records_df.rdd.\
-					map(lambda row: udf_func(vs_id, vs_filepath, row))\
-					.filter(lambda row: row is not None)
+		'''
+		Validate partition of records against all validation scenarios
 
+		Args:
+			rows (iterator): partition of records as pyspark Rows
+			scenarios (list): list of tuples of (validation scenario id, validation type, payload)
+
+		Returns:
+			(generator): Rows of validation failures, one per record, per failed validation scenario
+		'''
 
-			# python based validation scenario
-			elif vs.validation_type == 'python':
+		# get compiled validation scenarios
+		validators = [ ValidationScenarioCache.get_validator(*scenario) for scenario in scenarios ]
 
-				# parse user defined functions from validation scenario payload
-				temp_pyvs = ModuleType('temp_pyvs')
-				exec(vs.payload, temp_pyvs.__dict__)
+		for row in rows:
 
-				# get defined functions
-				pyvs_funcs = []
-				test_labeled_attrs = [ attr for attr in dir(temp_pyvs) if attr.lower().startswith('test') ]
-				for attr in test_labeled_attrs:
-					attr = getattr(temp_pyvs, attr)
-					if isfunction(attr):
-						pyvs_funcs.append(attr)
+			# parse document once for all validation scenarios
+			try:
+				record_xml = etree.fromstring(row.document.encode('utf-8'))
+				parse_error = None
+			except Exception as e:
+				record_xml = None
+				parse_error = 'could not parse record document: %s' % str(e)
 
-				udf_func = self.validate_python_udf # must pass static method not attached to self				
-				validation_fails_rdd = self.records_df.rdd.\
-					map(lambda row: udf_func(vs_id, pyvs_funcs, row))\
-					.filter(lambda row: row is not None)
+			for validator in validators:
 
+				# validate, python validators with own copy of document, as they may modify it
+				if parse_error is None:
+					if isinstance(validator, PythonValidator):
+						results_dict = validator.validate(row, copy.deepcopy(record_xml))
+					else:
+						results_dict = validator.validate(row, record_xml)
+				else:
+					results_dict = {
+						'fail_count':1,
+						'failed':[parse_error]
+					}
 
-			# finally, write to DB if validation failures
-			if not validation_fails_rdd.isEmpty():
-				validation_fails_rdd.toDF().write.jdbc(
-					settings.COMBINE_DATABASE['jdbc_url'],
-					'core_recordvalidation',
-					properties=settings.COMBINE_DATABASE,
-					mode='append')
+				# if failed, yield Row
+				if results_dict['fail_count'] > 0:
+					yield RecordValidationRow(
+						int(row.id),
+						int(validator.vs_id),
+						0,
+						json.dumps(results_dict),
+						results_dict['fail_count']
+					)
 
 
-	@staticmethod
-	def validate_schematron_udf(vs_id, vs_filepath, row):
 
-			# parse schematron
-			sct_doc = etree.parse(vs_filepath)
-			validator = isoschematron.Schematron(sct_doc, store_report=True)
+class ValidationScenarioCache(object):
 
-			# get document xml
-			record_xml = etree.fromstring(row.document.encode('utf-8'))
+	'''
+	Cache of compiled validation scenarios, keyed by validation scenario id and hash of payload.
 
-			# validate
-			is_valid = validator.validate(record_xml)
+	As a class attribute, the cache persists for the life of the python worker on each executor,
+	such that each validation scenario is compiled once per executor, not once per record.
+	'''
 
-			# if not valid, prepare Row
-			if not is_valid:
+	validators = {}
 
-				# prepare results_dict
-				results_dict = {
-					'fail_count':0,
-					'failed':[]
-				}
 
-				# get failed
-				report_root = validator.validation_report.getroot()
-				fails = report_root.findall('svrl:failed-assert', namespaces=report_root.nsmap)
+	@classmethod
+	def get_validator(cls, vs_id, validation_type, payload):
 
-				# log fail_count
-				results_dict['fail_count'] = len(fails)
+		'''
+		Return compiled validator for validation scenario, compiling if not yet seen
 
-				# loop through fails and add to dictionary
-				for fail in fails:
-					fail_text_elem = fail.find('svrl:text', namespaces=fail.nsmap)
-					results_dict['failed'].append(fail_text_elem.text)
-				
-				return Row(
-					record_id=int(row.id),
-					validation_scenario_id=int(vs_id),
-					valid=0,
-					results_payload=json.dumps(results_dict),
-					fail_count=results_dict['fail_count']
-				)
+		Args:
+			vs_id (int): validation scenario id
+			validation_type (str)['sch','python']: validation scenario type
+			payload (str): validation scenario payload
 
+		Returns:
+			(SchematronValidator, PythonValidator)
+		'''
+
+		key = (vs_id, hashlib.md5(payload.encode('utf-8')).hexdigest())
+		if key not in cls.validators:
+			if validation_type == 'sch':
+				cls.validators[key] = SchematronValidator(vs_id, payload)
+			elif validation_type == 'python':
+				cls.validators[key] = PythonValidator(vs_id, payload)
+		return cls.validators[key]
+
+
+
+class SchematronValidator(object):
+
+	'''
+	Schematron validation scenario, compiled once to XSLT by lxml isoschematron
+	'''
+
+	def __init__(self, vs_id, payload):
+
+		self.vs_id = vs_id
+
+		# parse and compile schematron
+		sct_doc = etree.fromstring(payload.encode('utf-8'))
+		self.validator = isoschematron.Schematron(sct_doc, store_report=True)
 
-	@staticmethod
-	def validate_python_udf(vs_id, pyvs_funcs, row):
+
+	def validate(self, row, record_xml):
 
 		'''
-		Loop through test functions and aggregate in fail_dict to return with Row
+		Validate parsed record document
 
 		Args:
-			vs_id (int): integer of validation scenario
-			pyvs_funcs (list): list of functions imported from user created python validation scenario payload
-			row (): 
+			row (pyspark.sql.Row): record
+			record_xml (lxml.etree._Element): parsed record document
+
+		Returns:
+			(dict): results dictionary with fail_count and failed tests
 		'''
 
-		# locally define class to be used
-		class PythonRecordValidationBase(object):
+		# prepare results_dict
+		results_dict = {
+			'fail_count':0,
+			'failed':[]
+		}
+
+		# validate, and if not valid, get failed
+		if not self.validator.validate(record_xml):
 
-			'''
-			Simple class to provide an object with parsed metadata for user defined functions
-			'''
+			report_root = self.validator.validation_report.getroot()
+			fails = report_root.findall('svrl:failed-assert', namespaces=report_root.nsmap)
 
-			def __init__(self, row):
+			# log fail_count
+			results_dict['fail_count'] = len(fails)
+
+			# loop through fails and add to dictionary
+			for fail in fails:
+				fail_text_elem = fail.find('svrl:text', namespaces=fail.nsmap)
+				results_dict['failed'].append(fail_text_elem.text)
+
+		return results_dict
+
+
+
+class PythonValidator(object):
+
+	'''
+	Python validation scenario, with user defined test functions imported once from payload
+	'''
 
-				# row
-				self._row = row
+	def __init__(self, vs_id, payload):
 
-				# get combine id
-				self.id = row.id
+		self.vs_id = vs_id
 
-				# get record id
-				self.record_id = row.record_id
+		# parse user defined functions from validation scenario payload
+		temp_pyvs = ModuleType('temp_pyvs')
+		exec(payload, temp_pyvs.__dict__)
 
-				# document string
-				self.document = row.document.encode('utf-8')
+		# get defined functions, and their test messages
+		self.pyvs_funcs = []
+		test_labeled_attrs = [ attr for attr in dir(temp_pyvs) if attr.lower().startswith('test') ]
+		for attr in test_labeled_attrs:
+			attr = getattr(temp_pyvs, attr)
+			if isfunction(attr):
+				self.pyvs_funcs.append((attr, signature(attr).parameters['test_message'].default))
 
-				# parse XML string, save
-				self.xml = etree.fromstring(self.document)
 
-				# get namespace map, popping None values
-				_nsmap = self.xml.nsmap.copy()
-				try:
-					_nsmap.pop(None)
-				except:
-					pass
-				self.nsmap = _nsmap
+	def validate(self, row, record_xml):
+
+		'''
+		Loop through test functions and aggregate in results_dict
+
+		Args:
+			row (pyspark.sql.Row): record
+			record_xml (lxml.etree._Element): parsed record document
+
+		Returns:
+			(dict): results dictionary with fail_count and failed tests
+		'''
 
 		# prvb
-		prvb = PythonRecordValidationBase(row)
-		
+		prvb = PythonRecordValidationBase(row, record_xml)
+
 		# prepare results_dict
 		results_dict = {
 			'fail_count':0,
@@ -241,11 +346,7 @@ class ValidationScenarioSpark(object):
 		}
 
 		# loop through functions
-		for func in pyvs_funcs:
-
-			# get func test message
-			func_signature = signature(func)
-			t_msg = func_signature.parameters['test_message'].default
+		for func, t_msg in self.pyvs_funcs:
 
 			# attempt to run user-defined validation function
 			try:
@@ -268,29 +369,37 @@ class ValidationScenarioSpark(object):
 				results_dict['fail_count'] += 1
 				results_dict['failed'].append("test '%s' had exception: %s" % (func.__name__, str(e)))
 
-		# if failed, return Row
-		if results_dict['fail_count'] > 0:
-			# return row
-			return Row(
-				record_id=int(row.id),
-				validation_scenario_id=int(vs_id),
-				valid=0,
-				results_payload=json.dumps(results_dict),
-				fail_count=results_dict['fail_count']
-			)
-
-
-
-
-
+		return results_dict
 
 
 
+class PythonRecordValidationBase(object):
 
+	'''
+	Simple class to provide an object with parsed metadata for user defined functions
+	'''
 
+	def __init__(self, row, record_xml):
 
+		# row
+		self._row = row
 
+		# get combine id
+		self.id = row.id
 
+		# get record id
+		self.record_id = row.record_id
 
+		# document string
+		self.document = row.document.encode('utf-8')
 
+		# parsed XML, shared across validation scenarios
+		self.xml = record_xml
 
+		# get namespace map, popping None values
+		_nsmap = self.xml.nsmap.copy()
+		try:
+			_nsmap.pop(None)
+		except:
+			pass
+		self.nsmap = _nsmap
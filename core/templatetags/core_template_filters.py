@@ -1,4 +1,5 @@
 
+import json
 import logging
 import re
 from django import template
@@ -37,5 +38,15 @@ def get_dict_value(dictionary, key):
 	return dictionary.get(key)
 
 
+def to_json(value):
+
+	'''
+	Return value serialized as JSON, e.g. for use as javascript value
+	'''
+
+	return json.dumps(value, default=str)
+
+
 register.filter('get_obj_attr', get_obj_attr)
-register.filter('get_dict_value', get_dict_value)
\ No newline at end of file
+register.filter('get_dict_value', get_dict_value)
+register.filter('to_json', to_json)
\ No newline at end of file
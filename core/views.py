@@ -19,7 +19,7 @@ from django.core import serializers
 from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
 from django.core.urlresolvers import reverse
 from django.db.models import Q
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.views import View
 
@@ -315,11 +315,7 @@ def record_group(request, org_id, record_group_id):
 	# get all currently applied publish set ids
 	publish_set_ids = models.PublishedRecords.get_publish_set_ids()
 
-	# loop through jobs
-	for job in jobs:
-
-		# update status
-		job.update_status()
+	# job status is updated from Livy by background poller, see core.models.LivyStatusPoller
 
 	# render page 
 	return render(request, 'core/record_group.html', {
@@ -383,9 +379,7 @@ def all_jobs(request):
 	else:
 		ld = models.Job.get_all_jobs_lineage(directionality='downstream', exclude_analysis_jobs=True)
 
-	# loop through jobs and update status
-	for job in jobs:
-		job.update_status()
+	# job status is updated from Livy by background poller, see core.models.LivyStatusPoller
 
 	# render page 
 	return render(request, 'core/all_jobs.html', {
@@ -601,6 +595,9 @@ def job_harvest_oai(request, org_id, record_group_id):
 		# get requested validation scenarios
 		validation_scenarios = request.POST.getlist('validation_scenario', [])
 
+		# full harvest, ignoring incremental harvest setting of OAI endpoint
+		full_harvest = request.POST.get('full_harvest') == 'true'
+
 		# initiate job
 		cjob = models.HarvestOAIJob(			
 			job_name=job_name,
@@ -610,7 +607,8 @@ def job_harvest_oai(request, org_id, record_group_id):
 			oai_endpoint=oai_endpoint,
 			overrides=overrides,
 			index_mapper=index_mapper,
-			validation_scenarios=validation_scenarios
+			validation_scenarios=validation_scenarios,
+			full_harvest=full_harvest
 		)
 		
 		# start job and update status
@@ -688,8 +686,10 @@ def job_harvest_static_xml(request, org_id, record_group_id, hash_payload_filena
 			else:
 				payload_dict['payload_filename'] = payload_file.name
 			
+			# write in chunks, as aggregate XML files may be large
 			with open(os.path.join(payload_dict['payload_dir'], payload_dict['payload_filename']), 'wb') as f:
-				f.write(payload_file.read())
+				for chunk in payload_file.chunks():
+					f.write(chunk)
 				payload_file.close()
 
 		# include xpath queries
@@ -1497,7 +1497,9 @@ def oai(request):
 	# get OAIProvider instance
 	op = OAIProvider(request.GET)
 
-	# return XML
+	# return XML, streamed as written if set
+	if settings.OAI_STREAM_RESPONSE:
+		return StreamingHttpResponse(op.generate_response_stream(), content_type='text/xml')
 	return HttpResponse(op.generate_response(), content_type='text/xml')
 
 
@@ -1525,10 +1527,7 @@ def analysis(request):
 			exclude_analysis_jobs = False
 		)
 
-	# loop through jobs
-	for job in analysis_jobs:
-		# update status
-		job.update_status()
+	# job status is updated from Livy by background poller, see core.models.LivyStatusPoller
 
 	# render page 
 	return render(request, 'core/analysis.html', {
@@ -1680,6 +1679,23 @@ class DTRecordsJson(BaseDatatableView):
 				return models.Record.objects
 
 
+		def get_order_columns(self):
+
+			# with Parquet record store, documents are not in DB, order by id instead
+			if settings.RECORD_STORAGE_BACKEND == 'parquet':
+				return [ 'id' if column == 'document' else column for column in self.order_columns ]
+			return self.order_columns
+
+
+		def prepare_results(self, qs):
+
+			# with Parquet record store, load documents of page once, not per row
+			if settings.RECORD_STORAGE_BACKEND == 'parquet':
+				qs = list(qs)
+				models.Record.load_documents(qs)
+			return super(DTRecordsJson, self).prepare_results(qs)
+
+
 		def render_column(self, row, column):
 
 			# handle record_id
@@ -1733,7 +1749,12 @@ class DTRecordsJson(BaseDatatableView):
 			# handle search
 			search = self.request.GET.get(u'search[value]', None)
 			if search:
-				qs = qs.filter(Q(record_id__contains=search) | Q(document__contains=search))
+
+				# with Parquet record store, documents are not in DB to search
+				if settings.RECORD_STORAGE_BACKEND == 'parquet':
+					qs = qs.filter(Q(record_id__contains=search))
+				else:
+					qs = qs.filter(Q(record_id__contains=search) | Q(document__contains=search))
 
 			# return
 			return qs
@@ -1787,6 +1808,23 @@ class DTPublishedJson(BaseDatatableView):
 			return pr.records
 
 
+		def get_order_columns(self):
+
+			# with Parquet record store, documents are not in DB, order by id instead
+			if settings.RECORD_STORAGE_BACKEND == 'parquet':
+				return [ 'id' if column == 'document' else column for column in self.order_columns ]
+			return self.order_columns
+
+
+		def prepare_results(self, qs):
+
+			# with Parquet record store, load documents of page once, not per row
+			if settings.RECORD_STORAGE_BACKEND == 'parquet':
+				qs = list(qs)
+				models.Record.load_documents(qs)
+			return super(DTPublishedJson, self).prepare_results(qs)
+
+
 		def render_column(self, row, column):
 			
 			# handle document metadata
@@ -1850,6 +1888,12 @@ class DTPublishedJson(BaseDatatableView):
 					qs = qs.filter(
 						Q(id=search)						
 					)
+				# with Parquet record store, documents are not in DB to search
+				elif settings.RECORD_STORAGE_BACKEND == 'parquet':
+					qs = qs.filter(
+						Q(record_id__contains=search) | 
+						Q(job__record_group__publish_set_id=search)
+					)
 				else:
 					qs = qs.filter(
 						Q(record_id__contains=search) | 
@@ -0,0 +1,84 @@
+# imports
+import argparse
+from lxml import etree
+import os
+import sys
+import time
+
+# init django settings file to retrieve settings
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'combine.settings'
+import django
+django.setup()
+
+from core.spark.es import GenericMapper
+
+
+
+'''
+Micro-benchmark of GenericMapper flattening engines, against MODS records from tests/data/mods_250.xml
+	- legacy: flatten_record() and format_record(), xpath per element
+	- walk: walk_record(), single recursive walk with memoized field names
+
+Documents are parsed once, up front, such that only flattening is timed.  Output of both engines is
+confirmed identical before timing.
+
+Usage, from root directory of Combine:
+	python tests/benchmark_generic_mapper.py --iterations 20
+'''
+
+
+def get_mods_documents():
+
+	'''
+	Return parsed MODS documents from tests/data/mods_250.xml
+	'''
+
+	mods_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'mods_250.xml')
+	oai_root = etree.parse(mods_path).getroot()
+	return [ etree.fromstring(etree.tostring(mods)) for mods in oai_root.iter('{http://www.loc.gov/mods/v3}mods') ]
+
+
+def run_legacy(mapper, xml_root):
+	mapper.xml_root = xml_root
+	mapper.xml_tree = xml_root.getroottree()
+	mapper.flatten_record()
+	mapper.format_record()
+	return mapper.formatted_elems
+
+
+def run_walk(mapper, xml_root):
+	mapper.xml_root = xml_root
+	mapper.xml_tree = xml_root.getroottree()
+	mapper.walk_record()
+	return mapper.formatted_elems
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--iterations', type=int, default=20)
+	args = parser.parse_args()
+
+	docs = get_mods_documents()
+
+	# confirm identical output
+	legacy_mapper = GenericMapper()
+	walk_mapper = GenericMapper()
+	for xml_root in docs:
+		legacy = run_legacy(legacy_mapper, xml_root)
+		walk = run_walk(walk_mapper, xml_root)
+		if legacy != walk:
+			raise Exception('flattening engines differ for document: %s' % etree.tostring(xml_root)[:200])
+	print('output identical for %s documents' % len(docs))
+
+	# time engines, one mapper per engine as with one mapper per partition
+	for engine, run in [('legacy', run_legacy), ('walk', run_walk)]:
+		mapper = GenericMapper()
+		stime = time.time()
+		for i in range(args.iterations):
+			for xml_root in docs:
+				run(mapper, xml_root)
+		elapsed = time.time() - stime
+		print('%s: %s records in %.3fs, %.1f records/s' % (
+			engine, len(docs) * args.iterations, elapsed, (len(docs) * args.iterations) / elapsed))
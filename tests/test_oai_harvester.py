@@ -0,0 +1,410 @@
+import datetime
+import django
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+from lxml import etree
+import os
+import pytest
+import sys
+import threading
+from unittest import mock
+import urllib.parse
+
+# setup django environment
+# init django settings file to retrieve settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'combine.settings'
+sys.path.append('/opt/combine')
+django.setup()
+from django.conf import settings
+
+# import core
+from core import oai
+from core.oai import OAIProvider
+from core.spark.oai_harvester import OAIHarvester
+
+
+
+#############################################################################
+# Stand-in OAI server
+#############################################################################
+
+class StandInRecord(object):
+
+	'''
+	Record served by stand-in OAI server, with attributes used by OAIProvider
+	'''
+
+	def __init__(self, id, record_id, document, publish_set_id, datestamp):
+		self.id = id
+		self.record_id = record_id
+		self.document = document
+		self.publish_set_id = publish_set_id
+		self.datestamp = datestamp
+
+
+class StandInQuerySet(object):
+
+	'''
+	Minimal stand-in for Django QuerySets used by OAIProvider
+	'''
+
+	def __init__(self, items):
+		self.items = items
+
+	def filter(self, publish_set_id=None, id__gt=None, id__in=None):
+		if publish_set_id is not None:
+			return StandInQuerySet([ i for i in self.items if i.publish_set_id == publish_set_id ])
+		if id__gt is not None:
+			return StandInQuerySet([ i for i in self.items if i.id > id__gt ])
+		if id__in is not None:
+			return StandInQuerySet([ i for i in self.items if i.id in id__in ])
+		return self
+
+	def order_by(self, field):
+		return StandInQuerySet(sorted(self.items, key=lambda i: getattr(i, field)))
+
+	def defer(self, *fields):
+		return self
+
+	def count(self):
+		return len(self.items)
+
+	def first(self):
+		return self.items[0] if len(self.items) > 0 else None
+
+	def __getitem__(self, k):
+		return self.items[k]
+
+	def __iter__(self):
+		return iter(self.items)
+
+
+class StandInPublishedRecords(object):
+
+	'''
+	In memory stand-in for core.models.PublishedRecords, honoring from and until of current request
+	'''
+
+	def __init__(self, provider, records):
+		self.provider = provider
+		self._records = records
+
+	@property
+	def set_ids(self):
+		return sorted(set([ r.publish_set_id for r in self._records ]))
+
+	@property
+	def records(self):
+		records = self._records
+		if 'from' in self.provider.args.keys():
+			records = [ r for r in records if r.datestamp >= self.provider.args['from'] ]
+		if 'until' in self.provider.args.keys():
+			records = [ r for r in records if r.datestamp <= self.provider.args['until'] ]
+		return StandInQuerySet(records)
+
+	def get_set_index(self, publish_set_id):
+		return self.records.filter(publish_set_id=publish_set_id).order_by('id')
+
+
+class StandInOAIProvider(OAIProvider):
+
+	'''
+	OAIProvider serving in memory records, standing in for a remote OAI-PMH server
+	'''
+
+	def __init__(self, args, server):
+		with mock.patch.object(oai.models, 'PublishedRecords'):
+			super().__init__(args)
+		self.published = StandInPublishedRecords(self, server.records)
+		self.chunk_size = server.chunk_size
+		self.earliest_datestamp = min([ r.datestamp for r in server.records ])
+
+
+	def _Identify(self):
+		super()._Identify()
+		earliest_node = etree.SubElement(self.verb_node, 'earliestDatestamp')
+		earliest_node.text = self.earliest_datestamp
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+
+class StandInOAIServer(object):
+
+	'''
+	HTTP server, on a free local port, answering requests with StandInOAIProvider
+	'''
+
+	def __init__(self, records, chunk_size=20):
+
+		self.records = records
+		self.chunk_size = chunk_size
+		self.requests = []
+		self.fail_resumption_after = None
+		server = self
+
+		class Handler(BaseHTTPRequestHandler):
+
+			def do_GET(self):
+				args = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+				server.requests.append(args)
+
+				# simulate interruption after number of resumption requests
+				if server.fail_resumption_after is not None and 'resumptionToken' in args:
+					if len([ r for r in server.requests if 'resumptionToken' in r ]) > server.fail_resumption_after:
+						self.send_response(500)
+						self.end_headers()
+						return
+
+				response = StandInOAIProvider(args, server).generate_response()
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/xml')
+				self.end_headers()
+				self.wfile.write(response)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+		self.thread.start()
+
+	@property
+	def endpoint(self):
+		return 'http://127.0.0.1:%s/oai' % self.httpd.server_address[1]
+
+	def shutdown(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+
+@pytest.fixture
+def oai_server():
+
+	'''
+	Stand-in OAI server with 250 MODS records from tests/data/mods_250.xml, across two sets
+	'''
+
+	oai_root = etree.parse(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'mods_250.xml')).getroot()
+	records = []
+	start_date = datetime.date(2017, 1, 1)
+	for i, mods in enumerate(oai_root.iter('{http://www.loc.gov/mods/v3}mods')):
+		records.append(StandInRecord(
+			i + 1,
+			'oai:test:%s' % i,
+			etree.tostring(mods).decode('utf-8'),
+			'set_a' if i % 2 == 0 else 'set_b',
+			(start_date + datetime.timedelta(days=i)).isoformat()
+		))
+
+	server = StandInOAIServer(records)
+	yield server
+	server.shutdown()
+
+
+def read_harvested_records(output_dir):
+
+	'''
+	Return harvested records from all shards
+	'''
+
+	records = []
+	for f in sorted(os.listdir(output_dir)):
+		if f.endswith('.jsonl'):
+			with open(os.path.join(output_dir, f), 'r') as shard:
+				records.extend([ json.loads(line) for line in shard ])
+	return records
+
+
+
+#############################################################################
+# Tests
+#############################################################################
+
+def test_native_oai_harvest_all_sets(oai_server, tmpdir):
+
+	harvester = OAIHarvester(
+		endpoint=oai_server.endpoint,
+		metadataPrefix='mods',
+		scope_type='harvestAllSets',
+		scope_value='',
+		output_dir=str(tmpdir),
+		thread_count=4,
+		window_threshold=0,
+		retries=0
+	)
+	summary = harvester.harvest()
+
+	records = read_harvested_records(str(tmpdir))
+	assert summary['tasks'] == 2
+	assert summary['records'] == 250
+	assert len(set([ r['id'] for r in records ])) == 250
+
+	# OAI record document with metadata, as expected by find_metadata_udf
+	record_root = etree.fromstring(records[0]['document'])
+	assert record_root.find('{http://www.openarchives.org/OAI/2.0/}metadata') is not None
+
+
+def test_native_oai_harvest_set_list(oai_server, tmpdir):
+
+	summary = OAIHarvester(
+		endpoint=oai_server.endpoint,
+		metadataPrefix='mods',
+		scope_type='setList',
+		scope_value='set_a',
+		output_dir=str(tmpdir),
+		window_threshold=0,
+		retries=0
+	).harvest()
+
+	records = read_harvested_records(str(tmpdir))
+	assert summary['records'] == 125
+	assert set([ r['setIds'][0] for r in records ]) == {'set_a'}
+
+
+def test_native_oai_harvest_date_windows(oai_server, tmpdir):
+
+	summary = OAIHarvester(
+		endpoint=oai_server.endpoint,
+		metadataPrefix='mods',
+		scope_type='harvestAllSets',
+		scope_value='',
+		output_dir=str(tmpdir),
+		thread_count=4,
+		window_threshold=50,
+		windows_per_set=4,
+		retries=0
+	).harvest()
+
+	# sets split into windows, with each record harvested once
+	records = read_harvested_records(str(tmpdir))
+	assert summary['tasks'] > 2
+	assert len([ r for r in oai_server.requests if 'from' in r ]) > 0
+	assert len(records) == 250
+	assert len(set([ r['id'] for r in records ])) == 250
+
+
+def test_native_oai_harvest_date_windows_future_datestamp(oai_server, tmpdir):
+
+	# record dated after current UTC date, as from repository ahead of harvester's clock
+	oai_server.records.append(StandInRecord(
+		251,
+		'oai:test:future',
+		oai_server.records[0].document,
+		'set_a',
+		(datetime.datetime.utcnow().date() + datetime.timedelta(days=2)).isoformat()
+	))
+
+	summary = OAIHarvester(
+		endpoint=oai_server.endpoint,
+		metadataPrefix='mods',
+		scope_type='harvestAllSets',
+		scope_value='',
+		output_dir=str(tmpdir),
+		thread_count=4,
+		window_threshold=50,
+		windows_per_set=4,
+		retries=0
+	).harvest()
+
+	# last window open-ended, harvesting record dated after today
+	records = read_harvested_records(str(tmpdir))
+	assert summary['tasks'] > 2
+	assert len([ r for r in oai_server.requests if 'from' in r and 'until' not in r ]) > 0
+	assert 'oai:test:future' in [ r['id'] for r in records ]
+	assert len(set([ r['id'] for r in records ])) == 251
+
+
+def test_native_oai_harvest_resume(oai_server, tmpdir):
+
+	harvester_kwargs = {
+		'endpoint':oai_server.endpoint,
+		'metadataPrefix':'mods',
+		'scope_type':'setList',
+		'scope_value':'set_a',
+		'output_dir':str(tmpdir),
+		'thread_count':1,
+		'window_threshold':0,
+		'retries':0
+	}
+
+	# interrupt harvest mid-set
+	oai_server.fail_resumption_after = 3
+	with pytest.raises(Exception):
+		OAIHarvester(**harvester_kwargs).harvest()
+	assert 0 < len(read_harvested_records(str(tmpdir))) < 125
+
+	# resume, continuing from checkpointed resumption token
+	oai_server.fail_resumption_after = None
+	oai_server.requests = []
+	summary = OAIHarvester(**harvester_kwargs).harvest()
+
+	records = read_harvested_records(str(tmpdir))
+	assert 'resumptionToken' in oai_server.requests[0]
+	assert summary['records'] == 125
+	assert len(records) == 125
+	assert len(set([ r['id'] for r in records ])) == 125
+
+
+def test_native_oai_harvest_from_date(oai_server, tmpdir):
+
+	summary = OAIHarvester(
+		endpoint=oai_server.endpoint,
+		metadataPrefix='mods',
+		scope_type='harvestAllSets',
+		scope_value='',
+		output_dir=str(tmpdir),
+		from_date='2017-08-01',
+		window_threshold=0,
+		retries=0
+	).harvest()
+
+	# only records with datestamps since from_date, as for incremental harvest
+	records = read_harvested_records(str(tmpdir))
+	assert len([ r for r in oai_server.requests if r.get('from') == '2017-08-01' ]) == 2
+	assert summary['records'] == len(records) == 250 - 212
+
+
+def test_oai_provider_stream_response(oai_server):
+
+	def list_identifiers(generate):
+		identifiers = []
+		args = {'verb':'ListIdentifiers', 'metadataPrefix':'mods', 'set':'set_b'}
+		while True:
+			root = etree.fromstring(generate(StandInOAIProvider(args, oai_server)))
+			identifiers.extend([ e.text for e in root.iter('{http://www.openarchives.org/OAI/2.0/}identifier') ])
+			token = root.find('.//{http://www.openarchives.org/OAI/2.0/}resumptionToken')
+			if token is None:
+				return identifiers
+			args = {'verb':'ListIdentifiers', 'resumptionToken':token.text}
+
+	# streamed in batches smaller than page, same records as response built whole
+	with mock.patch.object(settings, 'OAI_STREAM_BATCH_SIZE', 7, create=True):
+		streamed = list_identifiers(lambda op: b''.join(op.generate_response_stream()))
+	assert streamed == list_identifiers(lambda op: op.generate_response())
+	assert len(streamed) == len(set(streamed)) == 125
+
+
+def test_oai_provider_resumption_token_expiry(oai_server):
+
+	def first_token(args):
+		root = etree.fromstring(StandInOAIProvider(args, oai_server).generate_response())
+		return root.find('.//{http://www.openarchives.org/OAI/2.0/}resumptionToken').text
+
+	def error_code(args):
+		root = etree.fromstring(StandInOAIProvider(args, oai_server).generate_response())
+		error = root.find('{http://www.openarchives.org/OAI/2.0/}error')
+		return error.attrib['code'] if error is not None else None
+
+	# signed tokens, followed without DB, rejected if altered, used with another verb, or expired
+	with mock.patch.object(settings, 'OAI_RESUMPTION_TOKENS', 'signed', create=True):
+		with mock.patch.object(settings, 'OAI_RESUMPTION_TOKEN_TTL', 3600, create=True):
+			token = first_token({'verb':'ListIdentifiers', 'metadataPrefix':'mods', 'set':'set_a'})
+		assert error_code({'verb':'ListIdentifiers', 'resumptionToken':token}) is None
+		assert error_code({'verb':'ListIdentifiers', 'resumptionToken':token[:-1]}) == 'badResumptionToken'
+		assert error_code({'verb':'ListRecords', 'resumptionToken':token}) == 'badResumptionToken'
+		with mock.patch.object(settings, 'OAI_RESUMPTION_TOKEN_TTL', -1, create=True):
+			token = first_token({'verb':'ListIdentifiers', 'metadataPrefix':'mods', 'set':'set_a'})
+		assert error_code({'verb':'ListIdentifiers', 'resumptionToken':token}) == 'badResumptionToken'